@@ -0,0 +1,111 @@
+
+'''Compressed sparse row adjacency between astrocytes and neurons
+
+Built once from the neuroglial edges, read in chunks of EDGE_CHUNK_SIZE edges.
+Each astrocyte-neuron pair is kept once, whatever its amount of synapses:
+
+    astrocyte_offsets: uint32 (A + 1,) first neuron of each astrocyte
+    astrocyte_neurons: uint32 (P,) neurons contacted by each astrocyte, sorted
+    neuron_offsets: uint32 (N + 1,) first astrocyte of each neuron
+    neuron_astrocytes: uint32 (P,) astrocytes contacting each neuron, sorted
+
+A and N are one more than the largest connected ids, ids past them have no
+neighbours. Queries take many ids at once, see neighbours and set_operation.
+'''
+
+import numpy as np
+
+EDGE_CHUNK_SIZE = 1000000
+ADJACENCY_ARRAYS = ['astrocyte_offsets', 'astrocyte_neurons', 'neuron_offsets', 'neuron_astrocytes']
+# the CSR of each side of the adjacency
+DIRECTIONS = {
+    'astrocytes': ('astrocyte_offsets', 'astrocyte_neurons'),
+    'neurons': ('neuron_offsets', 'neuron_astrocytes'),
+}
+OPERATIONS = ['neighbours', 'counts', 'union', 'intersection']
+
+
+def iter_edges(connectome, chunk_size=EDGE_CHUNK_SIZE):
+    '''(astrocytes, neurons) chunks of the neuroglial edges, astrocyte-neuron pairs deduplicated in a chunk'''
+    for start in range(0, connectome.size, chunk_size):
+        ids = np.arange(start, min(start + chunk_size, connectome.size))
+        edges = connectome.get(ids, ['@source_node', '@target_node'])
+        pairs = np.unique(np.stack([edges['@source_node'].to_numpy(dtype=np.int64),
+                                    edges['@target_node'].to_numpy(dtype=np.int64)], axis=1), axis=0)
+        yield pairs[:, 0], pairs[:, 1]
+
+
+def csr_offsets(sorted_ids, count):
+    return np.searchsorted(sorted_ids, np.arange(count + 1)).astype(np.uint32)
+
+
+def build_adjacency(connectome):
+    '''Adjacency of the neuroglial connectome, see the module docstring'''
+    chunks = list(iter_edges(connectome))
+    astrocytes = np.concatenate([chunk[0] for chunk in chunks] or [np.empty(0, dtype=np.int64)])
+    neurons = np.concatenate([chunk[1] for chunk in chunks] or [np.empty(0, dtype=np.int64)])
+    # pairs of different chunks can still be duplicates
+    pairs = np.unique(np.stack([astrocytes, neurons], axis=1), axis=0)
+    astrocytes, neurons = pairs[:, 0], pairs[:, 1]
+    astrocyte_count = int(astrocytes.max()) + 1 if len(pairs) else 0
+    neuron_count = int(neurons.max()) + 1 if len(pairs) else 0
+
+    # pairs are sorted by astrocyte then neuron, a stable sort by neuron keeps astrocytes sorted
+    order = np.argsort(neurons, kind='stable')
+    return {
+        'astrocyte_offsets': csr_offsets(astrocytes, astrocyte_count),
+        'astrocyte_neurons': neurons.astype(np.uint32),
+        'neuron_offsets': csr_offsets(neurons[order], neuron_count),
+        'neuron_astrocytes': astrocytes[order].astype(np.uint32),
+    }
+
+
+def slices(offsets, ids):
+    '''(starts, ends) of ids in a CSR, empty for ids past its end'''
+    ids = np.asarray(ids, dtype=np.int64)
+    valid = (ids >= 0) & (ids < len(offsets) - 1)
+    clipped = np.where(valid, ids, 0)
+    # clip mode: an empty CSR has no offsets[1], the invalid ids are masked anyway
+    starts = np.where(valid, offsets.take(clipped, mode='clip'), 0).astype(np.int64)
+    ends = np.where(valid, offsets.take(clipped + 1, mode='clip'), 0).astype(np.int64)
+    return starts, ends
+
+
+def neighbours(adjacency, direction, ids):
+    '''Neighbours of each of ids, as (offsets, neighbours) in the order of ids'''
+    offsets, values = (adjacency[name] for name in DIRECTIONS[direction])
+    starts, ends = slices(offsets, ids)
+    sizes = ends - starts
+    result_offsets = np.concatenate([[0], np.cumsum(sizes)])
+    # concatenated aranges of all the slices
+    shifts = np.repeat(starts - result_offsets[:-1], sizes)
+    return result_offsets.astype(np.uint32), values[np.arange(result_offsets[-1]) + shifts]
+
+
+def set_operation(adjacency, direction, ids, op):
+    '''Neighbours of many ids in one call
+
+    direction: 'astrocytes' for the neurons of astrocyte ids, 'neurons' for the astrocytes of neuron ids
+    op:
+        neighbours: offsets uint32 (len(ids) + 1,) and ids uint32 of the neighbours of each id
+        counts: counts uint32 (len(ids),) amount of neighbours of each id
+        union: ids uint32 neighbours of any of ids, and counts uint32 amount of ids they neighbour
+        intersection: ids uint32 neighbours of all of ids
+    '''
+    if direction not in DIRECTIONS:
+        raise ValueError('unknown direction {}, expected one of {}'.format(direction, list(DIRECTIONS)))
+    if op not in OPERATIONS:
+        raise ValueError('unknown operation {}, expected one of {}'.format(op, OPERATIONS))
+    if op == 'counts':
+        starts, ends = slices(adjacency[DIRECTIONS[direction][0]], ids)
+        return {'counts': (ends - starts).astype(np.uint32)}
+
+    unique_ids = np.unique(np.asarray(ids, dtype=np.int64))
+    offsets, values = neighbours(adjacency, direction, ids if op == 'neighbours' else unique_ids)
+    if op == 'neighbours':
+        return {'offsets': offsets, 'ids': values}
+    # neighbours are unique per id, so their count is the amount of ids they neighbour
+    union, counts = np.unique(values, return_counts=True)
+    if op == 'union':
+        return {'ids': union.astype(np.uint32), 'counts': counts.astype(np.uint32)}
+    return {'ids': union[counts == len(unique_ids)].astype(np.uint32)}
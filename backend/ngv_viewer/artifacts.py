@@ -0,0 +1,126 @@
+
+import os
+import json
+import fcntl
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+
+from .cache import build_hash
+from .config import WORKERS
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+# precomputed per circuit data, kept next to each other in a directory per circuit build
+ARTIFACT_DIR = os.getenv('ARTIFACT_DIR', os.path.expanduser('~/.cache/ngv-viewer'))
+# prebake circuits on first use, so that all the workers of a pre-forked server map the same arrays
+PREBAKE_ON_DEMAND = bool(int(os.getenv('PREBAKE_ON_DEMAND', int(WORKERS != 1))))
+
+
+def artifact_dir(circuit_path):
+    return os.path.join(ARTIFACT_DIR, build_hash(circuit_path))
+
+
+@contextmanager
+def artifact_lock(circuit_path):
+    '''Exclusive lock on the artifacts of a circuit, between the processes of a host'''
+    directory = artifact_dir(circuit_path)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_array(circuit_path, name, mmap_mode='r'):
+    '''Precomputed array of a circuit or None when it hasn't been built'''
+    path = os.path.join(artifact_dir(circuit_path), name + '.npy')
+    if not os.path.exists(path):
+        return None
+    L.debug('loading %s', path)
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def save_array(circuit_path, name, arr):
+    '''Persist arr atomically, so that concurrent readers never see a partial file'''
+    if arr.dtype == object:
+        L.warning('%s has object dtype, not persisted', name)
+        return
+    directory = artifact_dir(circuit_path)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name + '.npy')
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr, allow_pickle=False)
+    os.replace(tmp_path, path)
+    L.debug('saved %s', path)
+
+
+# bump when the layout of prebaked artifacts changes, older ones are then ignored
+PREBAKE_VERSION = 1
+MANIFEST = 'manifest.json'
+
+circuit_artifacts = {}
+
+
+class CircuitArtifacts():
+    '''Read access to a directory written by ngv_viewer.prebake
+
+    Arrays are memory-mapped, so worker processes share the same pages.
+    '''
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        self.arrays = {}
+
+    def array(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+        return self.arrays[name]
+
+    def has(self, name):
+        return name in self.arrays or os.path.exists(os.path.join(self.directory, name + '.npy'))
+
+
+def get_artifacts(circuit_path):
+    '''Prebaked artifacts of a circuit build, None when it hasn't been prebaked'''
+    directory = artifact_dir(circuit_path)
+    if directory in circuit_artifacts:
+        return circuit_artifacts[directory]
+
+    manifest_path = os.path.join(directory, MANIFEST)
+    artifacts = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('version') == PREBAKE_VERSION:
+            L.debug('using prebaked artifacts from %s', directory)
+            artifacts = CircuitArtifacts(directory, manifest)
+        else:
+            L.warning('ignoring artifacts of prebake version %s in %s', manifest.get('version'), directory)
+    # only complete artifacts are remembered, a prebake can still be running
+    if artifacts is not None:
+        circuit_artifacts[directory] = artifacts
+    return artifacts
+
+
+def save_manifest(circuit_path, manifest):
+    '''Written last by the prebake, its presence marks the artifacts as complete'''
+    directory = artifact_dir(circuit_path)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, MANIFEST)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(manifest, version=PREBAKE_VERSION), f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def remove_manifest(circuit_path):
+    path = os.path.join(artifact_dir(circuit_path), MANIFEST)
+    if os.path.exists(path):
+        os.remove(path)
+    circuit_artifacts.pop(artifact_dir(circuit_path), None)
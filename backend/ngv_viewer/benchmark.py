@@ -0,0 +1,373 @@
+
+'''Benchmarks of the storage methods and of the websocket commands on synthetic circuits
+
+    python -m ngv_viewer.benchmark [--cells 10000 100000 1000000] [--output results.json]
+    python -m ngv_viewer.benchmark --compare before.json after.json
+
+Every circuit size runs in a fresh process, on a synthetic circuit (see
+ngv_viewer.synthetic) with one astrocyte per ASTROCYTE_RATIO neurons. Storage
+methods are called directly, commands are sent over a local websocket to the
+viewer handler. Each case reports the latency of the first (cold) call, the
+median latency of the next (warm) ones, the payload bytes and the throughput.
+The caches and artifacts of the circuit are dropped before the websocket
+commands, so that their cold calls are not warmed up by the storage cases.
+Results are written as JSON, --compare prints the warm latency ratios of two
+result files and exits with 1 when one is above --threshold.
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import shutil
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import numpy as np
+
+from .version import VERSION
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+SIZES = [10000, 100000, 1000000]
+ASTROCYTE_RATIO = 10
+REPEATS = 5
+
+ASTROCYTE = 0
+MIN_COMPARED_SECONDS = 0.001
+REGION = {'box': {'min': [0, 0, 0], 'max': [200, 200, 200]}}
+QUERY = {'and': [{'prop': 'layer', 'in': ['2', '3']}, REGION]}
+EVERYWHERE = {'box': {'min': [-1e9] * 3, 'max': [1e9] * 3}}
+
+# (method, arguments after the circuit path), get_vasculature_tile gets the tile from vasculature_tile
+STORAGE_CASES = [
+    ('get_cell_table', ()),
+    ('get_circuit_metadata', ()),
+    ('get_circuit_cell_positions', ()),
+    ('get_circuit_prop_values', ('layer',)),
+    ('get_circuit_prop_index', ('layer',)),
+    ('get_full_vasculature_bounding_box', ()),
+    ('get_vasculature_tiles', ()),
+    ('get_vasculature_tile_index', ()),
+    ('query_vasculature_tiles', (REGION,)),
+    ('get_vasculature_tile', ()),
+    ('get_spatial_index', ('neurons',)),
+    ('query_region', ('neurons', REGION)),
+    ('query_cells', (QUERY,)),
+    ('get_packed_morphologies', (list(range(8)),)),
+    ('get_cell_morphology', ([0],)),
+    ('get_cell_morphologies', (list(range(8)), 1)),
+    ('get_astrocytes_layers', ()),
+    ('get_astrocytes_somas', ()),
+    ('get_astrocyte_props', (ASTROCYTE,)),
+    ('get_efferent_neurons', (ASTROCYTE,)),
+    ('get_neuroglial_adjacency', ()),
+    ('query_neuroglial', ('astrocytes', list(range(64)), 'union')),
+    ('get_astrocyte_morph', (ASTROCYTE,)),
+    ('get_astrocyte_morph_lod', (ASTROCYTE, 1)),
+    ('get_astrocyte_microdomain', (ASTROCYTE,)),
+    ('get_astrocyte_microdomain_meshes', (list(range(64)),)),
+    ('get_merged_microdomain_mesh', (list(range(64)),)),
+    ('get_astrocyte_synapse_index', (ASTROCYTE,)),
+]
+
+
+def streamed(messages):
+    '''Whether all the chunks of a stream (tagged with offset and total) have been received'''
+    chunks = [m for m in messages if isinstance(m['data'], dict) and 'total' in m['data']]
+    if not chunks:
+        return False
+    received = sum(chunk_size(chunk) for chunk in chunks)
+    return received >= chunks[0]['data']['total']
+
+
+def chunk_size(message):
+    data = message['data']
+    if 'shape' in data:
+        return data['shape'][0]
+    return len(data.get('values', data.get('positions', [])))
+
+
+def batches_received(messages):
+    return bool(messages) and len(messages) == messages[0]['data']['batches']
+
+
+def final_lod(messages):
+    return bool(messages) and messages[-1]['data']['final']
+
+
+def single(messages):
+    return len(messages) >= 1
+
+
+def tiles_received(messages):
+    return bool(messages) and len(messages) == messages[0]['data']['tiles']
+
+
+# (command, data, binary, whether the response is complete), 'command:variant' for other data of a command
+WS_CASES = [
+    ('get_server_status', None, False, single),
+    ('get_circuit_metadata', None, False, single),
+    ('get_circuit_prop_values', 'layer', False, streamed),
+    ('get_circuit_prop_index', 'layer', True, streamed),
+    ('get_circuit_cell_positions', None, True, streamed),
+    ('get_circuit_cells', None, True, streamed),
+    ('get_cell_morphology', [0], False, single),
+    ('get_cell_morphologies', {'gids': list(range(32)), 'lod': 1}, True, batches_received),
+    ('query_region', REGION, True, single),
+    ('query_cells', {'query': QUERY}, True, single),
+    ('get_vasculature_tile_index', None, False, single),
+    ('get_vasculature_tiles', dict(EVERYWHERE, lod=0), True, tiles_received),
+    ('get_astrocytes_somas', None, False, single),
+    ('get_astrocyte_props', ASTROCYTE, False, single),
+    ('get_efferent_neurons', ASTROCYTE, False, single),
+    ('query_neuroglial', {'from': 'astrocytes', 'ids': list(range(64)), 'op': 'union'}, True, single),
+    ('query_neuroglial:neurons', {'from': 'neurons', 'ids': list(range(256)), 'op': 'neighbours'}, True, single),
+    ('get_astrocyte_morph', ASTROCYTE, False, single),
+    ('get_astrocyte_morph_lod', {'astrocyte': ASTROCYTE, 'progressive': True}, True, final_lod),
+    ('get_astrocyte_microdomain', ASTROCYTE, False, single),
+    ('get_astrocyte_microdomains', {'astrocytes': list(range(128))}, True, batches_received),
+    ('get_astrocyte_microdomains:merged', {'astrocytes': list(range(128)), 'merged': True}, True, single),
+    ('get_astrocyte_synapses', {'astrocyte': ASTROCYTE, 'neuron': None}, False, single),
+    ('get_astrocyte_all_synapses', ASTROCYTE, True, single),
+]
+
+
+def peak_rss():
+    '''Peak resident memory of this process, in bytes'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def timings(durations, nbytes):
+    warm = float(np.median(durations[1:])) if len(durations) > 1 else durations[0]
+    return {
+        'cold_s': durations[0],
+        'warm_s': warm,
+        'bytes': nbytes,
+        'throughput_bps': nbytes / warm if warm else None,
+    }
+
+
+def payload_size(value):
+    from .serialization import dumps
+    try:
+        return len(dumps(value))
+    except TypeError:
+        return None
+
+
+def vasculature_tile(storage, circuit_path):
+    '''First non empty vasculature tile'''
+    return int(storage.get_vasculature_tile_index(circuit_path)['tiles'][0])
+
+
+def bench_storage(storage, circuit_path, repeats):
+    results = {}
+    for method, args in STORAGE_CASES:
+        if method == 'get_vasculature_tile':
+            args = (vasculature_tile(storage, circuit_path), *args)
+        durations = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            value = getattr(storage, method)(circuit_path, *args)
+            durations.append(time.perf_counter() - start)
+        results[method] = timings(durations, payload_size(value))
+        L.info('storage %s: %.4fs cold, %.4fs warm', method, durations[0], results[method]['warm_s'])
+    return results
+
+
+def drop_caches(circuit_path):
+    '''Forget everything loaded or computed for the circuit: in-process caches, redis entries and artifacts'''
+    from .artifacts import artifact_dir, circuit_artifacts
+    from .cache import circuit_key
+    from .payloads import payload_cache
+    from .redis_client import KEY_PREFIX
+    from . import storage
+
+    storage.circuit_cache.clear()
+    for client in [storage.circuit_data_cache, storage.cache]:
+        client.local_cache.clear()
+        if client.rc is not None:
+            for key in client.rc.scan_iter(match=KEY_PREFIX + circuit_key(circuit_path) + '*'):
+                client.rc.delete(key)
+    payload_cache.clear()
+    circuit_artifacts.clear()
+    shutil.rmtree(artifact_dir(circuit_path), ignore_errors=True)
+
+
+async def read_response(ws, done):
+    '''Messages of a response, a binary frame is merged into the message of its header'''
+    messages = []
+    frames = 0
+    nbytes = 0
+    header = None
+    while not done(messages):
+        frame = await ws.read_message()
+        if frame is None:
+            raise ConnectionError('websocket closed')
+        frames += 1
+        nbytes += len(frame)
+        if isinstance(frame, bytes):
+            messages.append({'cmd': header['cmd'], 'data': header})
+            continue
+        message = json.loads(frame)
+        if message['cmd'] == 'binary_header':
+            header = message['data']
+        else:
+            messages.append(message)
+    return frames, nbytes
+
+
+async def bench_ws(circuit_path, neuron, repeats):
+    import tornado.web
+    import tornado.httpserver
+    import tornado.websocket
+    from tornado.testing import bind_unused_port
+    from .main import WSHandler
+
+    sock, port = bind_unused_port()
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(r'/ws', WSHandler)]))
+    server.add_sockets([sock])
+    ws = await tornado.websocket.websocket_connect('ws://127.0.0.1:{}/ws'.format(port),
+                                                   max_message_size=2 ** 31)
+    results = {}
+    cmdid = 0
+    for case, data, binary, done in WS_CASES:
+        cmd = case.partition(':')[0]
+        if cmd == 'get_astrocyte_synapses':
+            data = dict(data, neuron=neuron)
+        durations = []
+        for _ in range(repeats):
+            cmdid += 1
+            start = time.perf_counter()
+            ws.write_message(json.dumps({
+                'cmd': cmd,
+                'cmdid': cmdid,
+                'data': data,
+                'binary': binary,
+                'context': {'circuitConfig': {'path': circuit_path}},
+            }))
+            frames, nbytes = await read_response(ws, done)
+            durations.append(time.perf_counter() - start)
+        results[case] = dict(timings(durations, nbytes), frames=frames)
+        L.info('ws %s: %.4fs cold, %.4fs warm, %s bytes', case, durations[0], results[case]['warm_s'], nbytes)
+    ws.close()
+    server.stop()
+    return results
+
+
+def run_size(cells, repeats, queue):
+    '''Benchmark a circuit of cells neurons, in a process of its own'''
+    logging.basicConfig(level=logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # fresh artifacts for the synthetic circuit, set before the storage reads it
+        os.environ['ARTIFACT_DIR'] = tmp_dir
+        from . import synthetic
+        from .storage import Storage
+        synthetic.use_synthetic_circuits()
+
+        circuit_path = synthetic.write_config(os.path.join(tmp_dir, 'synthetic_config.json'),
+                                              neurons=cells,
+                                              astrocytes=max(cells // ASTROCYTE_RATIO, 1),
+                                              vasculature_points=cells)
+        storage = Storage()
+        start = time.perf_counter()
+        storage_results = bench_storage(storage, circuit_path, repeats)
+        storage_rss = peak_rss()
+        neuron = int(storage.get_efferent_neurons(circuit_path, ASTROCYTE)[0])
+        drop_caches(circuit_path)
+        ws_results = asyncio.run(bench_ws(circuit_path, neuron, repeats))
+        queue.put({
+            'cells': cells,
+            'duration_s': time.perf_counter() - start,
+            'storage': storage_results,
+            'ws': ws_results,
+            'peak_rss_storage_bytes': storage_rss,
+            'peak_rss_bytes': peak_rss(),
+        })
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(__file__)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, repeats):
+    results = {
+        'version': VERSION,
+        'commit': git_commit(),
+        'host': socket.gethostname(),
+        'created': time.time(),
+        'repeats': repeats,
+        'sizes': {},
+    }
+    context = multiprocessing.get_context('spawn')
+    for cells in sizes:
+        queue = context.Queue()
+        process = context.Process(target=run_size, args=(cells, repeats, queue))
+        process.start()
+        results['sizes'][str(cells)] = queue.get()
+        process.join()
+    return results
+
+
+def compare(before, after, threshold):
+    '''Print the warm latency ratios of two results, returns the regressed cases'''
+    regressions = []
+    print('{:>8} {:<8} {:<36} {:>10} {:>10} {:>7}'.format('cells', 'kind', 'case', 'before', 'after', 'ratio'))
+    for cells, size_after in after['sizes'].items():
+        size_before = before['sizes'].get(cells)
+        if size_before is None:
+            continue
+        for kind in ['storage', 'ws']:
+            for case, case_after in size_after[kind].items():
+                case_before = size_before[kind].get(case)
+                if case_before is None or not case_before['warm_s']:
+                    continue
+                ratio = case_after['warm_s'] / case_before['warm_s']
+                # sub-millisecond cases are too noisy to be flagged
+                regressed = ratio > threshold and case_after['warm_s'] >= MIN_COMPARED_SECONDS
+                flag = ' !' if regressed else ''
+                print('{:>8} {:<8} {:<36} {:>10.4f} {:>10.4f} {:>7.2f}{}'.format(
+                    cells, kind, case, case_before['warm_s'], case_after['warm_s'], ratio, flag))
+                if regressed:
+                    regressions.append((cells, kind, case, ratio))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark ngv-viewer on synthetic circuits')
+    parser.add_argument('--cells', type=int, nargs='+', default=SIZES, help='circuit sizes, in neurons')
+    parser.add_argument('--repeats', type=int, default=REPEATS, help='calls of each case, the first one is cold')
+    parser.add_argument('--output', help='results JSON file, printed when not given')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two results files')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='warm latency ratio reported as a regression by --compare')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            regressions = compare(json.load(before), json.load(after), args.threshold)
+        return 1 if regressions else 0
+
+    results = run(args.cells, max(args.repeats, 1))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,163 @@
+
+import os
+import sys
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+# amount of archngv.NGVCircuit instances kept open
+CIRCUIT_CACHE_SIZE = int(os.getenv('CIRCUIT_CACHE_SIZE', 2))
+# budget for whole circuit data: cell tables, astrocyte somas, ...
+CIRCUIT_DATA_CACHE_BYTES = int(os.getenv('CIRCUIT_DATA_CACHE_BYTES', 4 * 1024 ** 3))
+# budget for per entity data: morphologies, microdomains, ...
+ENTITY_CACHE_BYTES = int(os.getenv('ENTITY_CACHE_BYTES', 1024 ** 3))
+# seconds the mtime of a circuit config is used before it is checked again
+CIRCUIT_MTIME_TTL = float(os.getenv('CIRCUIT_MTIME_TTL', 5))
+
+# circuit path -> (mtime in ns, time it was checked)
+circuit_mtimes = {}
+
+
+def sizeof(obj):
+    '''Approximate amount of memory held by obj, in bytes'''
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if hasattr(obj, 'memory_usage'):
+        # pandas DataFrame or Series
+        return int(np.sum(obj.memory_usage(deep=True)))
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sizeof(k) + sizeof(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(sizeof(item) for item in obj)
+    return sys.getsizeof(obj)
+
+
+def memoized_circuit_key(circuit_path):
+    '''circuit_key from a config mtime checked less than CIRCUIT_MTIME_TTL ago, None when it needs a stat'''
+    mtime, checked = circuit_mtimes.get(circuit_path, (None, None))
+    if checked is None or time.monotonic() - checked >= CIRCUIT_MTIME_TTL:
+        return None
+    return '{}@{}'.format(circuit_path, mtime)
+
+
+def circuit_key_fresh(circuit_path):
+    '''Whether circuit_key of the circuit can be computed without a stat of its config'''
+    return memoized_circuit_key(circuit_path) is not None
+
+
+def circuit_key(circuit_path):
+    '''Cache namespace of a circuit, changes when its config file is rebuilt
+
+    The config mtime is checked at most every CIRCUIT_MTIME_TTL seconds, see memoized_circuit_key.
+    '''
+    key = memoized_circuit_key(circuit_path)
+    if key is None:
+        mtime = os.stat(circuit_path).st_mtime_ns
+        circuit_mtimes[circuit_path] = (mtime, time.monotonic())
+        key = '{}@{}'.format(circuit_path, mtime)
+    return key
+
+
+def key_hash(key):
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def build_hash(circuit_path):
+    '''Short digest of circuit_key, names the artifacts and HTTP resources of a circuit build'''
+    return key_hash(circuit_key(circuit_path))
+
+
+def cache_key(circuit_path, *parts):
+    return ':'.join([circuit_key(circuit_path), *map(str, parts)])
+
+
+class LRUCache():
+    '''Thread safe LRU cache bounded by the amount of items and/or their size in bytes'''
+    def __init__(self, name, max_items=None, max_bytes=None):
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # called with the key of every evicted item
+        self.evict_listeners = []
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key][0]
+
+    def set(self, key, value, size=None):
+        size = sizeof(value) if size is None else size
+        if self.max_bytes is not None and size > self.max_bytes:
+            L.warning('%s cache: %s (%s bytes) exceeds the cache budget, not cached', self.name, key, size)
+            return
+        with self.lock:
+            self.pop(key)
+            self.items[key] = (value, size)
+            self.nbytes += size
+            self.evict()
+
+    def pop(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            value, size = self.items.pop(key)
+            self.nbytes -= size
+            return value
+
+    def evict(self):
+        with self.lock:
+            while self.items and (
+                (self.max_items is not None and len(self.items) > self.max_items)
+                or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+            ):
+                key, (_, size) = self.items.popitem(last=False)
+                self.nbytes -= size
+                self.evictions += 1
+                L.debug('%s cache: evicted %s (%s bytes)', self.name, key, size)
+                for listener in self.evict_listeners:
+                    listener(key)
+
+    def drop_prefix(self, prefix):
+        '''Remove all the items with a key starting with prefix'''
+        with self.lock:
+            for key in [key for key in self.items if key.startswith(prefix)]:
+                self.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            'items': len(self.items),
+            'bytes': self.nbytes,
+            'max_items': self.max_items,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,108 @@
+
+'''Compact columnar table of the circuit cells
+
+Positions are kept as float32 and every other property as integer codes into
+a per-property list of values, computed once per circuit:
+
+    count: amount of cells
+    columns: property names, in the order of the circuit cell frame
+    positions: float32 (N, 3)
+    props: {prop: {'values': list, 'codes': (N,) smallest integer dtype, -1 for missing}}
+
+The prebaked artifacts hold the same table, with memory-mapped arrays.
+'''
+
+import numpy as np
+
+POSITION_COLUMNS = ['x', 'y', 'z']
+
+
+def min_code_dtype(size, has_missing):
+    '''Smallest integer dtype for codes into size values, signed when -1 (missing) is used'''
+    for unsigned, signed in [(np.uint8, np.int8), (np.uint16, np.int16), (np.uint32, np.int32)]:
+        dtype = signed if has_missing else unsigned
+        if size <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def build_cell_table(cells):
+    '''Cell table of a cell frame, as loaded by storage.load_circuit_cells'''
+    props = {}
+    for prop in cells.columns:
+        if prop in POSITION_COLUMNS:
+            continue
+        codes, values = cells[prop].factorize()
+        props[prop] = {
+            'values': values.tolist(),
+            'codes': codes.astype(min_code_dtype(len(values), (codes < 0).any())),
+        }
+    return {
+        'count': len(cells),
+        'columns': cells.columns.tolist(),
+        'positions': cells[POSITION_COLUMNS].to_numpy(dtype=np.float32),
+        'props': props,
+    }
+
+
+def table_from_artifacts(artifacts):
+    '''Cell table backed by the memory-mapped arrays of prebaked artifacts'''
+    manifest = artifacts.manifest
+    return {
+        'count': manifest['count'],
+        'columns': manifest['columns'],
+        'positions': artifacts.array('positions'),
+        'props': {
+            prop: {'values': prop_info['values'], 'codes': artifacts.array(prop_info['codes'])}
+            for prop, prop_info in manifest['props'].items()
+        },
+    }
+
+
+def table_metadata(table):
+    return {
+        'prop': {
+            prop: {'size': len(prop_info['values'])}
+            for prop, prop_info in table['props'].items()
+        },
+        'props': list(table['props']),
+        'count': table['count'],
+    }
+
+
+def is_numeric(values):
+    return all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values)
+
+
+def table_frame(table):
+    '''pandas frame of the table, properties as categoricals'''
+    import pandas as pd
+    columns = {axis: table['positions'][:, i] for i, axis in enumerate(POSITION_COLUMNS)}
+    for prop, prop_info in table['props'].items():
+        columns[prop] = pd.Categorical.from_codes(prop_info['codes'], prop_info['values'])
+    return pd.DataFrame(columns, columns=table['columns'])
+
+
+def table_matrix(table):
+    '''float32 matrix of the table columns, non-numeric properties as codes
+
+    Returns the matrix and a dict with the values of each property sent as codes.
+    '''
+    columns = []
+    prop_values = {}
+    for prop in table['columns']:
+        if prop in POSITION_COLUMNS:
+            columns.append(table['positions'][:, POSITION_COLUMNS.index(prop)])
+            continue
+        prop_info = table['props'][prop]
+        codes = np.asarray(prop_info['codes'])
+        if is_numeric(prop_info['values']):
+            # missing values (code -1) pick the trailing nan
+            values = np.append(np.asarray(prop_info['values'], dtype=np.float32), np.nan)
+            columns.append(values[codes])
+        else:
+            columns.append(codes.astype(np.float32))
+            prop_values[prop] = prop_info['values']
+    if not columns:
+        return np.empty((table['count'], 0), np.float32), prop_values
+    return np.column_stack(columns).astype(np.float32, copy=False), prop_values
@@ -0,0 +1,26 @@
+
+import os
+import json
+
+
+CONFIG_PATH = os.getenv('CONFIG_PATH', 'config.json')
+# server processes sharing the port, 0 for one per CPU
+WORKERS = int(os.getenv('WORKERS', 1))
+
+
+def load_config():
+    if not os.path.exists(CONFIG_PATH):
+        return {}
+    with open(CONFIG_PATH) as config_file:
+        return json.load(config_file)
+
+
+def warmup_list():
+    '''(circuit path, astrocyte ids) loaded at startup, for the circuits with a "warmup" list of astrocytes'''
+    return [(circuit['path'], circuit['warmup']) for circuit in load_config().get('circuits', [])
+            if 'warmup' in circuit]
+
+
+def configured_circuits():
+    '''Paths of the circuits served in production, used to prebuild their data at deploy time'''
+    return [circuit['path'] for circuit in load_config().get('circuits', [])]
@@ -0,0 +1,85 @@
+
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import tornado.ioloop
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+# 'thread' or 'process'
+WORKER_POOL = os.getenv('WORKER_POOL', 'thread')
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', 4))
+# max amount of storage calls a single websocket connection can have running at once
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', 4))
+
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_WARN = 0.2
+
+
+worker_storage = None
+
+def call_storage(method, args):
+    '''Entry point of process pool workers, each of them has its own Storage instance'''
+    global worker_storage
+    if worker_storage is None:
+        from .storage import Storage
+        worker_storage = Storage()
+    return getattr(worker_storage, method)(*args)
+
+
+class Dispatcher():
+    '''Runs blocking Storage methods on a thread or process pool'''
+    def __init__(self, storage, pool=WORKER_POOL, workers=WORKER_COUNT):
+        self.storage = storage
+        self.pool = pool
+        if pool == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        elif pool == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='storage')
+        else:
+            raise ValueError('Unknown worker pool type: {}'.format(pool))
+        L.debug('created %s pool with %s workers', pool, workers)
+
+    async def call(self, method, *args):
+        ioloop = tornado.ioloop.IOLoop.current()
+        if self.pool == 'process':
+            return await ioloop.run_in_executor(self.executor, call_storage, method, args)
+        return await ioloop.run_in_executor(self.executor, getattr(self.storage, method), *args)
+
+
+class LoopLagMonitor():
+    '''Measures how late periodic callbacks are scheduled by the IOLoop'''
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.last = 0.
+        self.max = 0.
+        self.total = 0.
+        self.count = 0
+        self.expected = None
+        self.callback = None
+
+    def start(self):
+        self.expected = time.monotonic() + self.interval
+        self.callback = tornado.ioloop.PeriodicCallback(self.tick, self.interval * 1000)
+        self.callback.start()
+
+    def tick(self):
+        now = time.monotonic()
+        lag = max(now - self.expected, 0.)
+        self.expected = now + self.interval
+        self.last = lag
+        self.max = max(self.max, lag)
+        self.total += lag
+        self.count += 1
+        if lag > LOOP_LAG_WARN:
+            L.warning('IOLoop lag %.3fs', lag)
+
+    def stats(self):
+        return {
+            'last': self.last,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else 0.,
+        }
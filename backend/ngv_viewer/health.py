@@ -0,0 +1,138 @@
+
+'''Readiness checks and the scheduled circuit self-test
+
+Probes must stay cheap: /readyz only checks that the storage is loaded and
+that redis and the configured circuits are reachable. The deep self-test
+(tests.test_circuit) runs in the background every SELF_TEST_INTERVAL seconds,
+/status serves its last result. In a pre-forked server only one worker runs
+it, the others read the result it writes in result_path.
+'''
+
+import os
+import json
+import time
+import asyncio
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+import tornado.ioloop
+
+from .config import configured_circuits
+from .redis_client import rc
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+# seconds between self-test runs, 0 to disable them. Disabled by default: the test loads a production
+# circuit from GPFS, deployments next to it enable it
+SELF_TEST_INTERVAL = int(os.getenv('SELF_TEST_INTERVAL', 0))
+# seconds a readiness check can take
+READY_CHECK_TIMEOUT = float(os.getenv('READY_CHECK_TIMEOUT', 2))
+
+
+def check_redis():
+    if rc is None:
+        return 'disabled'
+    rc.ping()
+    return 'ok'
+
+
+def check_circuits():
+    '''Configured circuit configs are reachable, GPFS being mounted'''
+    for circuit_path in configured_circuits():
+        os.stat(circuit_path)
+    return 'ok'
+
+
+async def readiness(storage_ready):
+    '''(ready, {check: result}), checks run off the IOLoop with a timeout'''
+    checks = {'storage': 'ok' if storage_ready else 'loading'}
+    ready = storage_ready
+    ioloop = tornado.ioloop.IOLoop.current()
+    for name, check in [('redis', check_redis), ('circuits', check_circuits)]:
+        try:
+            checks[name] = await asyncio.wait_for(ioloop.run_in_executor(None, check), READY_CHECK_TIMEOUT)
+        except asyncio.TimeoutError:
+            checks[name] = 'timeout'
+            ready = False
+        except (OSError, redis.RedisError) as e:
+            checks[name] = 'error: {}'.format(e)
+            ready = False
+    return ready, checks
+
+
+class SelfTest():
+    '''Runs tests.test_circuit periodically on a thread of its own, keeps the last result'''
+    def __init__(self, interval=SELF_TEST_INTERVAL):
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='self-test')
+        self.result = {'status': 'pending'}
+        self.result_path = None
+        self.runner = True
+        self.callback = None
+        self.running = False
+
+    def start(self, get_storage, runner=True):
+        '''get_storage: coroutine function returning the storage to test
+
+        Without runner the test isn't run here, the result is read from result_path.
+        '''
+        self.get_storage = get_storage
+        self.runner = runner
+        if not self.interval:
+            self.result = {'status': 'disabled'}
+            return
+        if not runner:
+            return
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+        self.callback = tornado.ioloop.PeriodicCallback(self.run, self.interval * 1000)
+        self.callback.start()
+
+    async def run(self):
+        if self.running:
+            return
+        self.running = True
+        try:
+            storage = await self.get_storage()
+            self.result = await tornado.ioloop.IOLoop.current().run_in_executor(self.executor, self.test, storage)
+            if self.result_path is not None:
+                self.save_result()
+        finally:
+            self.running = False
+
+    def save_result(self):
+        tmp_path = '{}.{}.tmp'.format(self.result_path, os.getpid())
+        with open(tmp_path, 'w') as result_file:
+            json.dump(self.result, result_file)
+        os.replace(tmp_path, self.result_path)
+
+    def last_result(self):
+        if self.runner or self.result_path is None or not self.interval:
+            return self.result
+        try:
+            with open(self.result_path) as result_file:
+                return json.load(result_file)
+        except (OSError, ValueError):
+            return {'status': 'pending'}
+
+    def test(self, storage):
+        from .tests import test_circuit
+        timings = {}
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            message = test_circuit(storage, timings)
+            status = 'ok'
+        except Exception as e:
+            L.error('self-test failed: %s', e)
+            message = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            status = 'failed'
+        return {
+            'status': status,
+            'message': message,
+            'started': started,
+            'duration': time.perf_counter() - start,
+            'timings': timings,
+        }
@@ -0,0 +1,68 @@
+
+import os
+import sys
+import logging
+
+import numpy as np
+import pandas as pd
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+
+def layer_bounding_boxes(positions, layers):
+    '''Min and max points, (L, 3) each, of the positions of every layer
+
+    Layers are ordered by first appearance, as returned by pandas.unique.
+    '''
+    codes, layer_values = pd.factorize(layers)
+    order = np.argsort(codes, kind='stable')
+    sorted_positions = positions[order]
+    starts = np.searchsorted(codes[order], np.arange(len(layer_values)))
+    min_points = np.minimum.reduceat(sorted_positions, starts, axis=0)
+    max_points = np.maximum.reduceat(sorted_positions, starts, axis=0)
+    return layer_values, min_points, max_points
+
+
+def assign_layers(neuron_positions, neuron_layers, points):
+    '''Layer of each point: the first layer whose neuron bounding box contains it, NaN if none
+
+    Single vectorized pass over all the points and layers, boundaries are inclusive
+    up to np.isclose tolerance.
+    '''
+    layer_values, min_points, max_points = layer_bounding_boxes(np.asarray(neuron_positions),
+                                                                np.asarray(neuron_layers))
+    points = np.asarray(points)[:, np.newaxis, :]
+    greater_or_equal = (min_points < points) | np.isclose(min_points, points)
+    smaller_or_equal = (points < max_points) | np.isclose(max_points, points)
+    inside = np.all(greater_or_equal & smaller_or_equal, axis=2)
+
+    first_layer = np.argmax(inside, axis=1)
+    has_layer = inside.any(axis=1)
+
+    layer_values = np.asarray(layer_values)
+    if np.issubdtype(layer_values.dtype, np.number):
+        layers = np.full(len(points), np.nan)
+    else:
+        # as np.select with string layers, points outside of all layers get 'nan'
+        layer_values = layer_values.astype(str)
+        layers = np.full(len(points), 'nan', dtype=np.result_type(layer_values.dtype, '<U3'))
+    layers[has_layer] = layer_values[first_layer[has_layer]]
+    return layers
+
+
+def main(argv):
+    '''Prebuild astrocyte layers of the given circuit configs or of the configured circuits'''
+    from .config import configured_circuits
+    from .storage import Storage
+
+    logging.basicConfig(level=logging.INFO)
+    circuit_paths = argv or configured_circuits()
+    storage = Storage()
+    for circuit_path in circuit_paths:
+        L.info('building astrocyte layers for %s', circuit_path)
+        storage.get_astrocytes_layers(circuit_path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,247 @@
+
+'''Load test of concurrent websocket sessions against single and multi-worker servers
+
+    python -m ngv_viewer.loadtest [--workers 1 2 4] [--sessions 1 2 4 8 16] [--duration 10]
+    python -m ngv_viewer.loadtest --url ws://host:8000/ws --circuit ngv_config.json
+
+Without --url a server (python -m ngv_viewer.synthetic, the server of
+ngv_viewer.main on synthetic circuits) is started for each --workers value, on
+a synthetic circuit prebaked before the workers are forked. Each session sends
+the requests of REQUEST_MIX one after the other, each one once the previous
+response is complete. Sessions are spread over --clients processes so
+that the client side doesn't bound the throughput. For each amount of sessions
+the requests per second and the latency percentiles are reported, with the
+speedup relative to the first --workers value.
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import urllib.request
+import urllib.error
+
+import numpy as np
+
+from .benchmark import read_response, single, streamed
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+WORKERS = [1, 2, 4]
+SESSIONS = [1, 2, 4, 8, 16]
+DURATION = 10
+WARMUP = 3
+CLIENTS = 4
+NEURONS = 100000
+
+# um, edge of the query_region boxes
+QUERY_BOX_SIZE = 200
+SERVER_START_TIMEOUT = 600
+
+
+def query_region(rng, metadata):
+    bbox = metadata['bbox']
+    low = np.array([bbox['min'][axis] for axis in 'xyz'])
+    high = np.array([bbox['max'][axis] for axis in 'xyz'])
+    box_min = rng.uniform(low, np.maximum(high - QUERY_BOX_SIZE, low))
+    return {'box': {'min': box_min.tolist(), 'max': (box_min + QUERY_BOX_SIZE).tolist()}}
+
+
+def cell_morphology(rng, metadata):
+    return [int(rng.integers(0, metadata['count']))]
+
+
+# (command, data function of (rng, circuit metadata) or None, binary, whether the response is complete)
+REQUEST_MIX = [
+    ('query_region', query_region, True, single),
+    ('get_circuit_cell_positions', None, False, streamed),
+    ('get_cell_morphology', cell_morphology, False, single),
+    ('get_circuit_prop_index', lambda rng, metadata: metadata['props'][0], True, streamed),
+]
+
+
+async def session(url, circuit_path, deadline, seed):
+    '''Latencies of the requests of a session sent until deadline'''
+    import tornado.websocket
+    ws = await tornado.websocket.websocket_connect(url, max_message_size=2 ** 31)
+    context = {'circuitConfig': {'path': circuit_path}}
+    rng = np.random.default_rng(seed)
+
+    ws.write_message(json.dumps({'cmd': 'get_circuit_metadata', 'cmdid': 0, 'context': context}))
+    metadata = json.loads(await ws.read_message())['data']
+
+    latencies = []
+    cmdid = 0
+    while time.monotonic() < deadline:
+        cmd, data, binary, done = REQUEST_MIX[cmdid % len(REQUEST_MIX)]
+        cmdid += 1
+        start = time.perf_counter()
+        ws.write_message(json.dumps({
+            'cmd': cmd,
+            'cmdid': cmdid,
+            'data': data(rng, metadata) if data is not None else None,
+            'binary': binary,
+            'context': context,
+        }))
+        await read_response(ws, done)
+        latencies.append(time.perf_counter() - start)
+    ws.close()
+    return latencies
+
+
+def run_client(url, circuit_path, sessions, deadline, seed, queue):
+    '''Sessions of one client process'''
+    async def run():
+        return await asyncio.gather(*[session(url, circuit_path, deadline, seed + i) for i in range(sessions)])
+    latencies = asyncio.run(run())
+    queue.put([latency for session_latencies in latencies for latency in session_latencies])
+
+
+def measure(url, circuit_path, sessions, duration, clients):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    clients = min(clients, sessions)
+    # leaves time to the client processes to start before the sessions begin
+    deadline_offset = 2
+    deadline = time.monotonic() + deadline_offset + duration
+    processes = []
+    for client in range(clients):
+        client_sessions = sessions // clients + (client < sessions % clients)
+        process = context.Process(target=run_client,
+                                  args=(url, circuit_path, client_sessions, deadline, client * sessions, queue))
+        process.start()
+        processes.append(process)
+    latencies = np.concatenate([queue.get() for _ in processes])
+    for process in processes:
+        process.join()
+    return {
+        'sessions': sessions,
+        'requests': len(latencies),
+        'rps': len(latencies) / duration,
+        'p50_s': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p95_s': float(np.percentile(latencies, 95)) if len(latencies) else None,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers, circuit_path, tmp_dir):
+    '''Server process with workers, once it is ready'''
+    port = free_port()
+    config_path = os.path.join(tmp_dir, 'config.json')
+    with open(config_path, 'w') as config_file:
+        json.dump({'circuits': [{'name': 'loadtest', 'path': circuit_path}]}, config_file)
+    env = dict(os.environ,
+               WORKERS=str(workers),
+               PORT=str(port),
+               CONFIG_PATH=config_path,
+               ARTIFACT_DIR=os.path.join(tmp_dir, 'artifacts'),
+               SELF_TEST_INTERVAL='0')
+    env.pop('REDIS_HOST', None)
+    # in a session of its own, so that the forked workers are stopped with it
+    process = subprocess.Popen([sys.executable, '-m', 'ngv_viewer.synthetic'], env=env, start_new_session=True)
+    ready_url = 'http://127.0.0.1:{}/readyz'.format(port)
+    start = time.monotonic()
+    while time.monotonic() - start < SERVER_START_TIMEOUT:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with {}'.format(process.returncode))
+        try:
+            urllib.request.urlopen(ready_url, timeout=1)
+            return process, 'ws://127.0.0.1:{}/ws'.format(port)
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.5)
+    stop_server(process)
+    raise RuntimeError('server not ready after {}s'.format(SERVER_START_TIMEOUT))
+
+
+def stop_server(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    process.wait()
+
+
+def run_server(url, circuit_path, sessions, duration, clients):
+    L.info('warming up %s', url)
+    measure(url, circuit_path, max(sessions), WARMUP, clients)
+    results = []
+    for session_count in sessions:
+        result = measure(url, circuit_path, session_count, duration, clients)
+        L.info('%s sessions: %.1f requests/s, p50 %.4fs, p95 %.4fs', session_count, result['rps'],
+               result['p50_s'] or 0, result['p95_s'] or 0)
+        results.append(result)
+    return results
+
+
+def run(workers, sessions, duration, clients, neurons):
+    from . import synthetic
+    results = {'cpus': os.cpu_count(), 'duration_s': duration, 'workers': {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        circuit_path = synthetic.write_config(os.path.join(tmp_dir, 'synthetic_config.json'),
+                                              neurons=neurons, astrocytes=max(neurons // 10, 1),
+                                              vasculature_points=neurons)
+        for worker_count in workers:
+            L.info('starting server with %s workers', worker_count)
+            process, url = start_server(worker_count, circuit_path, tmp_dir)
+            try:
+                results['workers'][str(worker_count)] = run_server(url, circuit_path, sessions, duration, clients)
+            finally:
+                stop_server(process)
+    return results
+
+
+def print_scaling(results):
+    '''Requests per second of each amount of sessions, and the speedup relative to the first server'''
+    servers = list(results['workers'].items())
+    print('{:>8} {:>9} {:>10} {:>10} {:>10} {:>8}'.format('workers', 'sessions', 'req/s', 'p50', 'p95', 'speedup'))
+    baseline = {result['sessions']: result['rps'] for result in servers[0][1]}
+    for workers, server_results in servers:
+        for result in server_results:
+            base = baseline.get(result['sessions'])
+            speedup = result['rps'] / base if base else float('nan')
+            print('{:>8} {:>9} {:>10.1f} {:>10.4f} {:>10.4f} {:>8.2f}'.format(
+                workers, result['sessions'], result['rps'], result['p50_s'] or 0, result['p95_s'] or 0, speedup))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Load test ngv-viewer with concurrent websocket sessions')
+    parser.add_argument('--url', help='websocket url of a running server, one is started per --workers otherwise')
+    parser.add_argument('--circuit', help='circuit config, required with --url')
+    parser.add_argument('--workers', type=int, nargs='+', default=WORKERS, help='WORKERS of the started servers')
+    parser.add_argument('--sessions', type=int, nargs='+', default=SESSIONS, help='concurrent sessions')
+    parser.add_argument('--duration', type=float, default=DURATION, help='seconds of each measure')
+    parser.add_argument('--clients', type=int, default=CLIENTS, help='client processes running the sessions')
+    parser.add_argument('--neurons', type=int, default=NEURONS, help='size of the synthetic circuit')
+    parser.add_argument('--output', help='results JSON file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.url:
+        if not args.circuit:
+            parser.error('--circuit is required with --url')
+        results = {'cpus': None, 'duration_s': args.duration,
+                   'workers': {args.url: run_server(args.url, args.circuit, args.sessions, args.duration,
+                                                    args.clients)}}
+    else:
+        results = run(args.workers, args.sessions, args.duration, args.clients, args.neurons)
+
+    print_scaling(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,38 +1,222 @@
 
 import os
 import json
+import asyncio
 import logging
+import tempfile
+import threading
 
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 import tornado.websocket
 import numpy as np
 
 from tornado.log import enable_pretty_logging
 
-from .storage import Storage
-from .utils import NumpyAwareJSONEncoder
+from .cache import circuit_key, circuit_key_fresh
+from .config import WORKERS, configured_circuits
+from .dispatcher import Dispatcher, LoopLagMonitor, MAX_IN_FLIGHT
+from . import metrics, resources
+from .health import SelfTest, readiness
+from .prefetch import Prefetcher, warmup
+from .microdomain import concat_meshes, mesh_arrays
+from .morph_simplification import lod_for_distance, LOD_EPSILONS
+from .cell_table import table_frame, table_matrix
+from .query import bitset_ids, result_format
+from .payloads import (CMDID, binary_arrays_frames, message_frame, payload_key, render,
+                       get_frames, set_frames, drop_circuit, payload_stats)
+from .scheduler import BULK, Scheduler, current_priority, message_priority
+from .singleflight import flights
+from .streaming import Streams, iter_chunks
+from .utils import NumpyAwareJSONEncoder, pack_binary, to_binary
 
 enable_pretty_logging()
 L = logging.getLogger(__name__)
 L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
 
 
-L.debug('creating storage instance')
-STORAGE = Storage()
-L.debug('storage instance has been created')
+# created on first use, importing the storage loads archngv and its dependencies
+STORAGE = None
+DISPATCHER = None
+storage_lock = threading.Lock()
+
+LOOP_LAG = LoopLagMonitor()
+SELF_TEST = SelfTest()
+
+metrics.Gauge('ngv_viewer_loop_lag_seconds', 'IOLoop lag of periodic callbacks', ['stat'],
+              callback=lambda: {(stat, ): value for stat, value in LOOP_LAG.stats().items()})
 
 MAINTENANCE = os.getenv('MAINTENANCE', False)
 
-def generate_chunks(values, data_type=None):
-    current_index = 0
-    chunk_size = int(len(values) / 100 + 1)
-    while current_index < len(values):
-        data_chunk = values[current_index : current_index + chunk_size]
-        if data_type:
-            L.debug(f'{data_type} chunk {current_index}:{current_index + chunk_size} is ready to be sent')
-        yield data_chunk
-        current_index = current_index + chunk_size
+PORT = int(os.getenv('PORT', 8000))
+
+# amount of cells per streamed get_cell_morphologies batch
+MORPH_BATCH_SIZE = 8
+# amount of astrocytes per streamed get_astrocyte_microdomains batch
+MICRODOMAIN_BATCH_SIZE = 64
+
+PACKED_MORPH_DTYPES = {
+    'gids': 'uint32',
+    'points': 'float32',
+    'section_offsets': 'uint32',
+    'section_types': 'uint8',
+    'section_parents': 'int32',
+    'cell_offsets': 'uint32',
+    'orientations': 'float32',
+}
+
+PACKED_ASTROCYTE_MORPH_DTYPES = {
+    'points': 'float32',
+    'section_offsets': 'uint32',
+    'section_types': 'uint8',
+    'section_parents': 'int32',
+    'orientation': 'float32',
+    'position': 'float32',
+}
+
+SYNAPSE_INDEX_DTYPES = {
+    'target_nodes': 'uint32',
+    'target_offsets': 'uint32',
+    'ids': 'uint32',
+    'locations': 'float32',
+}
+
+# commands dispatched by WSHandler.handle_message, others are counted as 'unknown' in the metrics
+COMMANDS = frozenset([
+    'get_server_status', 'get_circuit_metadata', 'get_circuit_prop_values', 'get_circuit_prop_index',
+    'get_circuit_cell_positions', 'get_circuit_cells', 'get_cell_morphology', 'get_cell_morphologies',
+    'query_region', 'query_cells', 'get_vasculature_tile_index', 'get_vasculature_tiles',
+    'get_astrocytes_somas', 'get_astrocyte_props', 'get_efferent_neurons', 'query_neuroglial',
+    'get_astrocyte_morph', 'get_astrocyte_morph_lod', 'get_astrocyte_microdomain', 'get_astrocyte_microdomains',
+    'get_astrocyte_synapses', 'get_astrocyte_all_synapses', 'cancel',
+])
+
+# encodings of each kind of HTTP resource, see load_resource
+RESOURCE_KINDS = {
+    'astrocyte-morph': ['json', 'bin'],
+    'astrocyte-microdomain': ['json', 'bin'],
+    'cell-morph': ['json', 'bin'],
+    'cell-positions': ['json', 'bin'],
+    'prop-index': ['json', 'bin'],
+    'prop-values': ['json'],
+}
+
+
+def load_storage():
+    global STORAGE, DISPATCHER
+    with storage_lock:
+        if DISPATCHER is None:
+            L.debug('creating storage instance')
+            from .storage import Storage, circuit_cache
+            # responses of a circuit are dropped with it, they are rebuilt with its next version
+            circuit_cache.evict_listeners.append(drop_circuit)
+            STORAGE = Storage()
+            DISPATCHER = Dispatcher(STORAGE)
+            L.debug('storage instance has been created')
+    return DISPATCHER
+
+
+async def get_dispatcher():
+    '''Dispatcher of the storage, loaded off the IOLoop the first time'''
+    if DISPATCHER is not None:
+        return DISPATCHER
+    return await tornado.ioloop.IOLoop.current().run_in_executor(None, load_storage)
+
+
+async def refresh_circuit_key(circuit_path):
+    '''Check the config of a circuit off the IOLoop when its memoized mtime is stale, see cache.circuit_key'''
+    if not circuit_key_fresh(circuit_path):
+        try:
+            await tornado.ioloop.IOLoop.current().run_in_executor(None, circuit_key, circuit_path)
+        except OSError:
+            # raised again where the key is used, by the command
+            pass
+
+
+async def get_storage():
+    await get_dispatcher()
+    return STORAGE
+
+
+async def dispatch(method, *args):
+    '''Run a storage method on the dispatcher, loading it first'''
+    dispatcher = await get_dispatcher()
+    return await dispatcher.call(method, *args)
+
+
+def storage_cache_stats():
+    if DISPATCHER is None:
+        return None
+    from .storage import cache_stats
+    return cache_stats()
+
+
+async def load_resource(circuit_path, kind, entity, encoding):
+    '''(body, headers) of an HTTP resource, raises KeyError, IndexError or ValueError for unknown entities
+
+    bin astrocyte morphologies are packed at the finest level of detail, cell positions have the id 'all'
+    and the circuit prop values and index the id of the prop.
+    '''
+    dispatcher = await get_dispatcher()
+    binary = encoding == 'bin'
+    if kind == 'astrocyte-morph':
+        astrocyte_id = int(entity)
+        if binary:
+            morph = await dispatcher.call('get_astrocyte_morph_lod', circuit_path, astrocyte_id, len(LOD_EPSILONS) - 1)
+            return resources.binary_body({
+                name: (morph[name], dtype) for name, dtype in PACKED_ASTROCYTE_MORPH_DTYPES.items()
+            })
+        return resources.json_body(await dispatcher.call('get_astrocyte_morph', circuit_path, astrocyte_id)), {}
+
+    if kind == 'astrocyte-microdomain':
+        astrocyte_id = int(entity)
+        if binary:
+            mesh = await dispatcher.call('get_astrocyte_microdomain_mesh', circuit_path, astrocyte_id)
+            return resources.binary_body(mesh_arrays(mesh))
+        return resources.json_body(await dispatcher.call('get_astrocyte_microdomain', circuit_path, astrocyte_id)), {}
+
+    if kind == 'cell-morph':
+        gid = int(entity)
+        if binary:
+            batch = await dispatcher.call('get_cell_morphologies', circuit_path, [gid])
+            return resources.binary_body({name: (batch[name], dtype) for name, dtype in PACKED_MORPH_DTYPES.items()})
+        return resources.json_body(await dispatcher.call('get_cell_morphology', circuit_path, [gid])), {}
+
+    if kind == 'cell-positions':
+        if entity != 'all':
+            raise KeyError(entity)
+        positions = await dispatcher.call('get_circuit_cell_positions', circuit_path)
+        if binary:
+            return resources.binary_body({'positions': (positions, 'float32')})
+        return resources.json_body(positions), {}
+
+    if kind == 'prop-index':
+        codes = await dispatcher.call('get_circuit_prop_index', circuit_path, entity)
+        if binary:
+            return resources.binary_body({'index': (codes, 'uint32')})
+        return resources.json_body(codes), {}
+
+    if kind == 'prop-values':
+        return resources.json_body(await dispatcher.call('get_circuit_prop_values', circuit_path, entity)), {}
+
+    raise KeyError(kind)
+
+
+def command_label(cmd):
+    '''Metrics label of a client supplied command, bounded to COMMANDS'''
+    return cmd if cmd in COMMANDS else 'unknown'
+
+
+def requested_lod(data):
+    '''Level of detail asked by the client, explicitly or by camera distance, clamped to LOD_EPSILONS'''
+    if data.get('lod') is not None:
+        return min(max(int(data['lod']), 0), len(LOD_EPSILONS) - 1)
+    if data.get('distance') is not None:
+        return lod_for_distance(data['distance'])
+    return None
 
 
 class WSHandler(tornado.websocket.WebSocketHandler):
@@ -42,26 +226,102 @@ class WSHandler(tornado.websocket.WebSocketHandler):
         L.debug('websocket client has been connected')
         return True
 
+    def open(self):
+        # header and binary frames are written back to back, don't let Nagle's algorithm hold the second one
+        self.set_nodelay(True)
+        self.streams = Streams()
+        self.scheduler = Scheduler(MAX_IN_FLIGHT, self.streams, command_label)
+        self.prefetcher = Prefetcher(self.bulk_storage_call)
+        metrics.connections.inc()
+
     def on_message(self, msg):
         msg = json.loads(msg)
         L.debug('got ws message: %s', msg)
+        if msg['cmd'] == 'batch':
+            # data: {commands: [message, ...]}, sub-commands inherit the context and binary of the envelope
+            defaults = {'context': msg.get('context', {}), 'binary': msg.get('binary', False)}
+            messages = [dict(defaults, **sub_msg) for sub_msg in msg['data']['commands']]
+        else:
+            messages = [msg]
+        # not awaited, so that slow commands don't hold back the next messages of this client
+        for message in messages:
+            self.scheduler.start(message, self.process_message(message))
+
+    async def storage_call(self, method, *args):
+        metrics.storage_in_flight.inc(method=method)
+        priority = current_priority.get()
+        try:
+            with metrics.phase('queue'):
+                await self.scheduler.slots.acquire(priority)
+            try:
+                with metrics.phase('compute'):
+                    dispatcher = await get_dispatcher()
+                    return await dispatcher.call(method, *args)
+            finally:
+                self.scheduler.slots.release(priority)
+        finally:
+            metrics.storage_in_flight.dec(method=method)
+
+    async def bulk_storage_call(self, method, *args):
+        '''storage_call at bulk priority, for the background work of the connection'''
+        token = current_priority.set(BULK)
+        try:
+            return await self.storage_call(method, *args)
+        finally:
+            current_priority.reset(token)
+
+    async def process_message(self, msg):
+        '''Handle a message within a trace of its phases
+
+        With a 'trace' id in the message (true for its cmdid), a trace message with the
+        timings of the request is sent back once it is complete, streams included.
+        '''
+        trace = metrics.Trace(command_label(msg['cmd']), msg.get('cmdid'),
+                              None if msg.get('trace') is True else msg.get('trace'))
+        if msg.get('trace'):
+            trace.on_finish.append(self.send_trace)
+        metrics.current_trace.set(trace)
+        current_priority.set(message_priority(msg))
+        metrics.requests_in_flight.inc(cmd=trace.cmd)
+        try:
+            await self.handle_message(msg)
+        finally:
+            metrics.requests_in_flight.dec(cmd=trace.cmd)
+            trace.release()
+
+    async def handle_message(self, msg):
         cmd = msg['cmd']
         cmdid = msg['cmdid']
         context = msg['context']
+        # opt-in: stream numeric arrays as raw little-endian binary frames
+        binary = msg.get('binary', False)
 
         if 'circuitConfig' in context:
             circuit_path = context['circuitConfig']['path']
+            # cache keys of the circuit are then computed on the IOLoop without touching GPFS
+            await refresh_circuit_key(circuit_path)
 
         if cmd == 'get_server_status':
             self.send_message('server_status', {
                 'status': 'maintenance' if MAINTENANCE else 'operational',
+                'loop_lag': LOOP_LAG.stats(),
+                'cache': storage_cache_stats(),
+                'singleflight': flights.stats(),
+                'payloads': payload_stats(),
+                'scheduler': self.scheduler.stats(),
+                'resources': resources.resource_cache.stats(),
                 'cmdid': cmdid
             })
 
         elif cmd == 'get_circuit_metadata':
-            # TODO: move logic to storage module
+            async def build():
+                circuit_metadata = await self.storage_call('get_circuit_metadata', circuit_path)
+                L.debug('sending circuit metadata to the client')
+                # build: hash of the circuit build in the URLs of its HTTP resources
+                return [message_frame('circuit_metadata', dict(circuit_metadata, build=resources.register(circuit_path),
+                                                               cmdid=CMDID))]
             try:
-                cells = STORAGE.get_circuit_cells(circuit_path)
+                await self.send_cached(payload_key(circuit_path, msg), cmdid, build)
             except FileNotFoundError as e:
                 self.send_message('circuit_metadata', {
                     'error': 'Error accessing a file in GPFS',
@@ -69,149 +329,302 @@ class WSHandler(tornado.websocket.WebSocketHandler):
                     'cmdid': cmdid
                 })
                 L.debug(e)
-                return
-
-            cell_count = len(cells)
-            full_vasculature_bounding_box = STORAGE.get_full_vasculature_bounding_box(circuit_path)
-            L.debug('sending full vasculaure bounding box to the client')
-            props = [
-                prop
-                for prop
-                in cells.columns.tolist()
-                if prop not in ['x', 'y', 'z']
-            ]
-
-            prop_meta = {
-                prop: {
-                    'size': len(cells[prop].unique())
-                }
-                for prop
-                in props
-            }
-            L.debug('sending circuit metadata to the client')
-            circuit_metadata = {
-                'prop': prop_meta,
-                'props': props,
-                'count': cell_count,
-                'cmdid': cmdid,
-                'bbox': full_vasculature_bounding_box,
-            }
-            self.send_message('circuit_metadata', circuit_metadata)
 
         elif cmd in ['get_circuit_prop_values', 'get_circuit_prop_index']:
             prop = msg['data']
-            cells = STORAGE.get_circuit_cells(circuit_path)
-
-            d_type, fctr_idx = ['index', 0] if cmd == 'get_circuit_prop_index' else ['values', 1]
-
-            values = cells[prop].factorize()[fctr_idx].tolist()
-            values_it = generate_chunks(values, data_type=f'{prop} {d_type}')
-            def send():
-                chunk = next(values_it, None)
-                if chunk is not None:
-                    self.send_message(f'circuit_prop_{d_type}', {
-                        'prop': prop,
-                        'values': chunk
-                    })
-                    tornado.ioloop.IOLoop.current().add_callback(send)
+            d_type = 'index' if cmd == 'get_circuit_prop_index' else 'values'
+            values = await self.storage_call(f'get_circuit_prop_{d_type}', circuit_path, prop)
 
-            tornado.ioloop.IOLoop.current().add_callback(send)
+            dtype = 'uint32' if binary and d_type == 'index' else None
+            self.streams.start(cmdid, self.stream(f'circuit_prop_{d_type}', values, cmdid, dtype,
+                                                  start=msg.get('offset', 0), prop=prop))
 
         elif cmd == 'get_circuit_cell_positions':
-            cells = STORAGE.get_circuit_cells(circuit_path)
-            positions = np.dstack((cells.x, cells.y, cells.z)).flatten()
-            positions_it = generate_chunks(positions, data_type='positions')
-            def send():
-                chunk = next(positions_it, None)
-                if chunk is not None:
-                    self.send_message('circuit_cell_positions', {
-                        'positions': chunk
-                    })
-                    tornado.ioloop.IOLoop.current().add_callback(send)
-
-            tornado.ioloop.IOLoop.current().add_callback(send)
+            positions = await self.storage_call('get_circuit_cell_positions', circuit_path)
+            self.streams.start(cmdid, self.stream('circuit_cell_positions', positions, cmdid,
+                                                  'float32' if binary else None, start=msg.get('offset', 0),
+                                                  key='positions'))
 
         elif cmd == 'get_circuit_cells':
-            cells = STORAGE.get_circuit_cells(circuit_path)
-            cell_count = len(cells)
-
-            prop_meta = {
-                prop: len(cells[prop].unique())
-                for prop
-                in cells.columns.tolist()
-                if prop not in ['x', 'y', 'z']
-            }
+            table = await self.storage_call('get_cell_table', circuit_path)
+            cell_count = table['count']
 
             L.debug('sending circuit cell properties to the client')
             circuit_info = {
-                'properties': cells.columns.tolist(),
-                'prop_meta': prop_meta,
+                'properties': table['columns'],
+                'prop_meta': {prop: len(prop_info['values']) for prop, prop_info in table['props'].items()},
                 'count': cell_count
             }
+            if binary:
+                # non-numeric columns are sent as codes into circuit_info['prop_values']
+                cells, circuit_info['prop_values'] = table_matrix(table)
+            else:
+                cells = table_frame(table).to_numpy()
             self.send_message('circuit_cell_info', circuit_info)
 
-            def generate_cell_chunks():
-                current_index = 0
-                chunk_size = int(cell_count / 100)
-                while current_index < cell_count:
-                    cell_data_chunk = cells[current_index : current_index + chunk_size]
-                    L.debug('cell data chunk for cells %s:%s is ready to be sent', current_index, current_index + chunk_size)
-                    yield cell_data_chunk
-                    current_index = current_index + chunk_size
-
-            cell_chunks_it = generate_cell_chunks()
-
-            def send():
-                cell_chunk = next(cell_chunks_it, None)
-                if cell_chunk is not None:
-                    self.send_message('circuit_cells_data', cell_chunk.values)
-                    tornado.ioloop.IOLoop.current().add_callback(send)
-
-            tornado.ioloop.IOLoop.current().add_callback(send)
+            self.streams.start(cmdid, self.stream('circuit_cells_data', cells, cmdid,
+                                                  'float32' if binary else None, start=msg.get('offset', 0)))
 
         elif cmd == 'get_cell_morphology':
             gids = msg['data']
-            cell_nm_morph = STORAGE.get_cell_morphology(circuit_path, gids)
+            cell_nm_morph = await self.storage_call('get_cell_morphology', circuit_path, gids)
             cell_nm_morph['cmdid'] = cmdid
 
             L.debug('sending cell morphology to the client')
             self.send_message('cell_morphology', cell_nm_morph)
 
+        elif cmd == 'get_cell_morphologies':
+            # list of gids or {'gids': [...], 'lod': level} / {'gids': [...], 'distance': um}
+            data = msg['data'] if isinstance(msg['data'], dict) else {'gids': msg['data']}
+            gids = data['gids']
+            lod = requested_lod(data)
+            batches = [gids[i : i + MORPH_BATCH_SIZE] for i in range(0, len(gids), MORPH_BATCH_SIZE)]
+            batch_futures = [
+                self.storage_call('get_cell_morphologies', circuit_path, batch, lod)
+                for batch in batches
+            ]
+            # batches are sent as soon as they are loaded, not in request order
+            for batch_future in asyncio.as_completed(batch_futures):
+                batch = await batch_future
+                L.debug('sending %s packed cell morphologies to the client', len(batch['gids']))
+                meta = {'cmdid': cmdid, 'batches': len(batches), 'lod': lod}
+                async with self.scheduler.turn():
+                    if binary:
+                        await self.send_binary_arrays('cell_morphologies', {
+                            name: (batch[name], dtype) for name, dtype in PACKED_MORPH_DTYPES.items()
+                        }, **meta)
+                    else:
+                        await self.send_message('cell_morphologies', dict(batch, **meta))
+
+        elif cmd == 'query_region':
+            # data: {kind: 'neurons' | 'astrocytes', box | sphere | frustum, sample}
+            data = msg['data']
+            kind = data.get('kind', 'neurons')
+            region = {shape: data[shape] for shape in ['box', 'sphere', 'frustum'] if shape in data}
+            cells = await self.storage_call('query_region', circuit_path, kind, region, data.get('sample'))
+            L.debug('sending %s %s in region to the client', len(cells['ids']), kind)
+            meta = {'cmdid': cmdid, 'kind': kind, 'count': len(cells['ids'])}
+            async with self.scheduler.turn():
+                if binary:
+                    await self.send_binary_arrays('region_cells', {
+                        'ids': (cells['ids'], 'uint32'),
+                        'positions': (cells['positions'], 'float32'),
+                    }, **meta)
+                else:
+                    await self.send_message('region_cells', dict(cells, **meta))
+
+        elif cmd == 'query_cells':
+            # data: {query: see the query module, format: 'ids' | 'bitset', the smaller one by default}
+            data = msg['data']
+            try:
+                selection = await self.storage_call('query_cells', circuit_path, data['query'])
+                result = result_format(selection['count'], selection['total'], data.get('format'))
+            except (KeyError, TypeError, ValueError) as e:
+                # normalize validates the query, this also covers storage lookups of invalid ids
+                self.send_message('cells_query', {
+                    'error': 'Invalid query',
+                    'description': str(e),
+                    'cmdid': cmdid
+                })
+                return
+            L.debug('sending %s cells matching the query to the client', selection['count'])
+            meta = {'cmdid': cmdid, 'count': selection['count'], 'total': selection['total'], 'format': result}
+            if result == 'bitset':
+                values, dtype = selection['bitset'], 'uint8'
+            else:
+                values, dtype = bitset_ids(selection['bitset'], selection['total']), 'uint32'
+            async with self.scheduler.turn():
+                if binary:
+                    await self.send_binary_arrays('cells_query', {result: (values, dtype)}, **meta)
+                else:
+                    await self.send_message('cells_query', dict(meta, **{result: values}))
+
+        elif cmd == 'get_vasculature_tile_index':
+            async def build():
+                index = await self.storage_call('get_vasculature_tile_index', circuit_path)
+                L.debug('sending vasculature tile index to the client')
+                return [message_frame('vasculature_tile_index', dict(index, cmdid=CMDID))]
+            await self.send_cached(payload_key(circuit_path, msg), cmdid, build)
+
+        elif cmd == 'get_vasculature_tiles':
+            # data: {tiles: [id, ...] or box | sphere | frustum, lod: level, the finest by default}
+            data = msg['data']
+            try:
+                if 'tiles' in data:
+                    tiles = [int(tile) for tile in data['tiles']]
+                else:
+                    region = {shape: data[shape] for shape in ['box', 'sphere', 'frustum'] if shape in data}
+                    tiles = (await self.storage_call('query_vasculature_tiles', circuit_path, region)).tolist()
+            except (KeyError, TypeError, ValueError) as e:
+                self.send_message('vasculature_tile', {
+                    'error': 'Invalid tile',
+                    'description': str(e),
+                    'cmdid': cmdid
+                })
+                return
+            self.streams.start(cmdid, self.stream_vasculature_tiles(circuit_path, tiles, data.get('lod'),
+                                                                    cmdid, binary))
+
         elif cmd == 'get_astrocytes_somas':
-            somas = STORAGE.get_astrocytes_somas(circuit_path)
-            somas['cmdid'] = cmdid
-            L.debug('sending astrocytes somas to the client')
-            self.send_message('astrocytes_somas', somas)
+            async def build():
+                somas = await self.storage_call('get_astrocytes_somas', circuit_path)
+                L.debug('sending astrocytes somas to the client')
+                return [message_frame('astrocytes_somas', dict(somas, cmdid=CMDID))]
+            await self.send_cached(payload_key(circuit_path, msg), cmdid, build)
 
         elif cmd == 'get_astrocyte_props':
-            astrocyte_id = msg['data']
-            props = STORAGE.get_astrocyte_props(circuit_path, astrocyte_id)
-            L.debug('sending astrocyte props to the client')
-            self.send_message('astrocyte_props', props)
+            # the client asks for the morphology, microdomain and efferent neurons next
+            self.prefetcher.astrocyte(circuit_path, msg['data'])
+            async def build():
+                props = await self.storage_call('get_astrocyte_props', circuit_path, msg['data'])
+                L.debug('sending astrocyte props to the client')
+                return [message_frame('astrocyte_props', props)]
+            await self.send_cached(payload_key(circuit_path, msg), cmdid, build)
 
         elif cmd == 'get_efferent_neurons':
-            astrocyte_id = msg['data']
-            efferent_neuron_ids = STORAGE.get_efferent_neurons(circuit_path, astrocyte_id)
-            L.debug('sending astrocyte efferent neurons to the client')
-            self.send_message('efferent_neuron_ids', efferent_neuron_ids)
+            self.prefetcher.astrocyte(circuit_path, msg['data'])
+            async def build():
+                efferent_neuron_ids = await self.storage_call('get_efferent_neurons', circuit_path, msg['data'])
+                L.debug('sending astrocyte efferent neurons to the client')
+                return [message_frame('efferent_neuron_ids', efferent_neuron_ids)]
+            await self.send_cached(payload_key(circuit_path, msg), cmdid, build)
+
+        elif cmd == 'query_neuroglial':
+            # data: {from: 'astrocytes' | 'neurons', ids: [id, ...], op: neighbours | counts | union | intersection}
+            data = msg['data']
+            direction, op = data.get('from', 'astrocytes'), data.get('op', 'union')
+            try:
+                result = await self.storage_call('query_neuroglial', circuit_path, direction,
+                                                 [int(cell_id) for cell_id in data['ids']], op)
+            except ValueError as e:
+                self.send_message('neuroglial', {
+                    'error': 'Invalid query',
+                    'description': str(e),
+                    'cmdid': cmdid
+                })
+                return
+            L.debug('sending neuroglial %s of %s %s to the client', op, len(data['ids']), direction)
+            meta = {'cmdid': cmdid, 'from': direction, 'op': op}
+            try:
+                async with self.scheduler.turn():
+                    if self.closed:
+                        return
+                    if binary:
+                        await self.send_binary_arrays('neuroglial', {
+                            name: (values, 'uint32') for name, values in result.items()
+                        }, **meta)
+                    else:
+                        await self.send_message('neuroglial', dict(meta, **result))
+            except tornado.websocket.WebSocketClosedError:
+                L.debug('connection closed while sending neuroglial %s', op)
 
         elif cmd == 'get_astrocyte_morph':
-            astrocyte_id = msg['data']
-            morph = STORAGE.get_astrocyte_morph(circuit_path, astrocyte_id)
-            L.debug('sending astrocyte morphology to the client')
-            self.send_message('astrocyte_morph', morph)
+            async def build():
+                morph = await self.storage_call('get_astrocyte_morph', circuit_path, msg['data'])
+                L.debug('sending astrocyte morphology to the client')
+                return [message_frame('astrocyte_morph', morph)]
+            try:
+                await self.send_cached(payload_key(circuit_path, msg), cmdid, build)
+            except ValueError as e:
+                self.send_message('astrocyte_morph', {
+                    'error': 'Invalid astrocyte',
+                    'description': str(e),
+                    'cmdid': cmdid
+                })
+
+        elif cmd == 'get_astrocyte_morph_lod':
+            # {'astrocyte': id, 'lod': level or 'distance': um, 'progressive': bool}
+            data = msg['data']
+            astrocyte_id = data['astrocyte']
+            lod = requested_lod(data)
+            lod = len(LOD_EPSILONS) - 1 if lod is None else lod
+            # progressive: coarse levels first, each one replacing the previous on the client
+            levels = range(lod + 1) if data.get('progressive') else [lod]
+            try:
+                for level in levels:
+                    morph = await self.storage_call('get_astrocyte_morph_lod', circuit_path, astrocyte_id, level)
+                    L.debug('sending astrocyte morphology lod %s to the client', level)
+                    meta = {'cmdid': cmdid, 'astrocyte': astrocyte_id, 'lod': level, 'final': level == lod}
+                    async with self.scheduler.turn():
+                        if self.closed:
+                            return
+                        if binary:
+                            await self.send_binary_arrays('astrocyte_morph_lod', {
+                                name: (morph[name], dtype) for name, dtype in PACKED_ASTROCYTE_MORPH_DTYPES.items()
+                            }, **meta)
+                        else:
+                            await self.send_message('astrocyte_morph_lod', dict(morph, **meta))
+            except tornado.websocket.WebSocketClosedError:
+                L.debug('connection closed while sending astrocyte morphology levels')
 
         elif cmd == 'get_astrocyte_microdomain':
-            astrocyte_id = msg['data']
-            microdomain = STORAGE.get_astrocyte_microdomain(circuit_path, astrocyte_id)
-            L.debug('sending astrocyte microdomain to the client')
-            self.send_message('astrocyte_microdomain', microdomain)
+            # binary: packed mesh with quantized vertices, see the microdomain module
+            async def build():
+                if binary:
+                    mesh = await self.storage_call('get_astrocyte_microdomain_mesh', circuit_path, msg['data'])
+                    L.debug('sending packed astrocyte microdomain to the client')
+                    return binary_arrays_frames('astrocyte_microdomain', mesh_arrays(mesh),
+                                                cmdid=CMDID, astrocyte=msg['data'])
+                microdomain = await self.storage_call('get_astrocyte_microdomain', circuit_path, msg['data'])
+                L.debug('sending astrocyte microdomain to the client')
+                return [message_frame('astrocyte_microdomain', microdomain)]
+            await self.send_cached(payload_key(circuit_path, msg), cmdid, build)
+
+        elif cmd == 'get_astrocyte_microdomains':
+            # data: {'astrocytes': [id, ...], 'merged': bool}
+            data = msg['data']
+            astrocyte_ids = [int(astrocyte_id) for astrocyte_id in data['astrocytes']]
+            if data.get('merged'):
+                async def build():
+                    mesh = await self.storage_call('get_merged_microdomain_mesh', circuit_path, astrocyte_ids)
+                    L.debug('sending merged mesh of %s microdomains to the client', len(mesh['astrocytes']))
+                    if binary:
+                        return binary_arrays_frames('astrocyte_microdomains_merged', mesh_arrays(mesh), cmdid=CMDID)
+                    return [message_frame('astrocyte_microdomains_merged', dict(mesh, cmdid=CMDID))]
+                await self.send_cached(payload_key(circuit_path, msg), cmdid, build)
+                return
+
+            batches = [
+                astrocyte_ids[i : i + MICRODOMAIN_BATCH_SIZE]
+                for i in range(0, len(astrocyte_ids), MICRODOMAIN_BATCH_SIZE)
+            ]
+            async def load(batch):
+                return batch, await self.storage_call('get_astrocyte_microdomain_meshes', circuit_path, batch)
+            # batches are sent as soon as they are loaded, not in request order
+            for batch_future in asyncio.as_completed([load(batch) for batch in batches]):
+                batch, meshes = await batch_future
+                L.debug('sending %s packed astrocyte microdomains to the client', len(batch))
+                packed = dict(concat_meshes(meshes), astrocytes=np.array(batch, dtype=np.uint32))
+                meta = {'cmdid': cmdid, 'batches': len(batches)}
+                async with self.scheduler.turn():
+                    if binary:
+                        await self.send_binary_arrays('astrocyte_microdomains', mesh_arrays(packed), **meta)
+                    else:
+                        await self.send_message('astrocyte_microdomains', dict(packed, **meta))
 
         elif cmd == 'get_astrocyte_synapses':
             data_dict = msg['data']
-            synapses = STORAGE.get_astrocyte_synapses(circuit_path, data_dict['astrocyte'], data_dict['neuron'])
-            L.debug('sending astrocyte synapses to the client')
-            self.send_message('synapses', synapses)
+            async def build():
+                synapses = await self.storage_call('get_astrocyte_synapses', circuit_path,
+                                                   data_dict['astrocyte'], data_dict['neuron'])
+                L.debug('sending astrocyte synapses to the client')
+                return [message_frame('synapses', synapses)]
+            await self.send_cached(payload_key(circuit_path, msg), cmdid, build)
+
+        elif cmd == 'get_astrocyte_all_synapses':
+            # synapses of all the efferent neurons, grouped by neuron with target_offsets
+            astrocyte_id = msg['data']
+            async def build():
+                index = await self.storage_call('get_astrocyte_synapse_index', circuit_path, astrocyte_id)
+                L.debug('sending all astrocyte synapses to the client')
+                return binary_arrays_frames('astrocyte_all_synapses', {
+                    name: (index[name], dtype) for name, dtype in SYNAPSE_INDEX_DTYPES.items()
+                }, cmdid=CMDID, astrocyte=astrocyte_id)
+            await self.send_cached(payload_key(circuit_path, msg), cmdid, build)
+
+        elif cmd == 'cancel':
+            # data: cmdid of the request or stream to stop
+            self.scheduler.cancel(msg['data'])
 
         else:
             L.debug('No command was found (%s)', cmd)
@@ -219,28 +632,299 @@ class WSHandler(tornado.websocket.WebSocketHandler):
 
 
 
+    async def stream(self, cmd, values, cmdid, dtype=None, start=0, key='values', **meta):
+        '''Send values in chunks tagged with their offset and the total size
+
+        Binary when dtype is given. Each chunk waits for its turn (see scheduler.Scheduler.turn) and
+        is flushed before the next one, start is the offset to resume an interrupted stream from.
+        '''
+        total = len(values)
+        try:
+            for offset, chunk in iter_chunks(values, dtype, start):
+                async with self.scheduler.turn():
+                    if self.closed:
+                        return
+                    if dtype is not None:
+                        await self.send_binary(cmd, chunk, dtype, offset, cmdid=cmdid, total=total, **meta)
+                    else:
+                        await self.send_message(cmd, dict(meta, cmdid=cmdid, offset=offset, total=total,
+                                                          **{key: chunk}))
+        except tornado.websocket.WebSocketClosedError:
+            L.debug('connection closed while streaming %s', cmd)
+
+    async def stream_vasculature_tiles(self, circuit_path, tiles, lod, cmdid, binary):
+        '''Send vasculature tiles one at a time, each once the previous one has been flushed'''
+        try:
+            for tile in tiles:
+                try:
+                    packed = await self.storage_call('get_vasculature_tile', circuit_path, tile, lod)
+                except (TypeError, ValueError) as e:
+                    # the tiles before it have been sent, the stream ends at the invalid one
+                    self.send_message('vasculature_tile', {
+                        'error': 'Invalid tile',
+                        'description': str(e),
+                        'cmdid': cmdid
+                    })
+                    return
+                if self.closed:
+                    return
+                meta = {'cmdid': cmdid, 'tile': tile, 'lod': lod, 'tiles': len(tiles)}
+                async with self.scheduler.turn():
+                    if binary:
+                        await self.send_binary_arrays('vasculature_tile', {
+                            'segments': (packed['segments'], 'float32'),
+                            'radii': (packed['radii'], 'float32'),
+                        }, **meta)
+                    else:
+                        await self.send_message('vasculature_tile', dict(packed, **meta))
+        except tornado.websocket.WebSocketClosedError:
+            L.debug('connection closed while streaming vasculature tiles')
+
+    async def send_cached(self, key, cmdid, build):
+        '''Send the frames of a response, encoded once by the build coroutine for all the connections'''
+        frames = get_frames(key)
+        cmd = metrics.current_trace.get().cmd
+        if frames is None:
+            metrics.cache_requests.inc(cache='payloads', family=cmd, result='miss')
+            frames = await build()
+            set_frames(key, frames)
+        else:
+            metrics.cache_requests.inc(cache='payloads', family=cmd, result='local_hit')
+            L.debug('using cached payload')
+        if not self.closed:
+            for payload, binary in render(frames, cmdid):
+                self.write_frame(payload, binary)
+
+    def send_trace(self, trace, total):
+        self.send_message('trace', {
+            'cmdid': trace.cmdid,
+            'trace': trace.trace_id,
+            'cmd': trace.cmd,
+            'total': total,
+            'phases': trace.phases,
+        })
+
+    def write_frame(self, payload, binary=False):
+        '''write_message, adding the time and size of the frame to the metrics of the current command'''
+        trace = metrics.current_trace.get()
+        with metrics.phase('send'):
+            future = self.write_message(payload, binary=binary)
+        metrics.sent_bytes.inc(len(payload), cmd=trace.cmd if trace is not None else '')
+        return future
+
     def send_message(self, cmd, data=None):
+        '''Returns the write future, None once the connection is closed'''
         if not self.closed:
-            payload = json.dumps({'cmd': cmd, 'data': data},
-                                 cls=NumpyAwareJSONEncoder)
-            self.write_message(payload)
+            with metrics.phase('serialize'):
+                payload = json.dumps({'cmd': cmd, 'data': data},
+                                     cls=NumpyAwareJSONEncoder)
+            return self.write_frame(payload)
+
+    def send_binary(self, cmd, values, dtype, offset=0, **meta):
+        '''Send a binary_header text frame followed by values as a raw binary frame
+
+        offset is the position of values[0] in the whole streamed array.
+        '''
+        if not self.closed:
+            header = dict(meta, cmd=cmd, dtype=dtype, shape=list(np.shape(values)), offset=offset)
+            self.send_message('binary_header', header)
+            with metrics.phase('serialize'):
+                data = to_binary(values, dtype)
+            return self.write_frame(data, binary=True)
+
+    def send_binary_arrays(self, cmd, arrays, **meta):
+        '''Send several named arrays, {name: (values, dtype)}, in a single binary frame'''
+        if not self.closed:
+            with metrics.phase('serialize'):
+                descriptions, data = pack_binary(arrays)
+            self.send_message('binary_header', dict(meta, cmd=cmd, arrays=descriptions))
+            return self.write_frame(data, binary=True)
 
     def on_close(self):
         self.closed = True
+        self.scheduler.cancel_all()
+        self.prefetcher.cancel()
+        metrics.connections.dec()
 
 
 class StatusHandler(tornado.web.RequestHandler):
     def get(self):
+        '''Last result of the scheduled self-test, see health.SelfTest'''
         L.debug('show status page')
-        from .tests import test_circuit
-        status = test_circuit(STORAGE)
+        status = SELF_TEST.last_result()
+        if status['status'] == 'failed':
+            self.set_status(500)
         self.write(status)
 
-if __name__ == '__main__':
-    app = tornado.web.Application([
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({'status': 'ok'})
+
+
+class ReadyHandler(tornado.web.RequestHandler):
+    async def get(self):
+        ready, checks = await readiness(DISPATCHER is not None)
+        if not ready:
+            self.set_status(503)
+        self.write(dict(checks, ready=ready))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.exposition())
+
+
+class ResourceHandler(tornado.web.RequestHandler):
+    '''Immutable per entity data of a circuit build, see the resources module
+
+    Conditional requests are answered from the URL alone. A single bytes range is
+    served from the identity body, whole bodies gzipped when the client accepts it.
+    '''
+    def set_default_headers(self):
+        self.set_header('Access-Control-Allow-Origin', '*')
+        self.set_header('Access-Control-Expose-Headers', 'ETag, Content-Range, Content-Length, X-Binary-Arrays')
+
+    def options(self, *args):
+        self.set_header('Access-Control-Allow-Methods', 'GET, HEAD, OPTIONS')
+        self.set_header('Access-Control-Allow-Headers', 'Range, If-Range, If-None-Match')
+        self.set_header('Access-Control-Max-Age', 86400)
+        self.set_status(204)
+
+    async def head(self, *args):
+        await self.get(*args, include_body=False)
+
+    def matching_etag(self, tags):
+        '''The one of tags in the If-None-Match header, if any'''
+        header = self.request.headers.get('If-None-Match', '')
+        for candidate in header.split(','):
+            candidate = candidate.strip()
+            if candidate.startswith('W/'):
+                candidate = candidate[2:]
+            if candidate == '*':
+                return tags[0]
+            if candidate in tags:
+                return candidate
+        return None
+
+    async def get(self, build, kind, entity, encoding, include_body=True):
+        if encoding not in RESOURCE_KINDS.get(kind, []):
+            raise tornado.web.HTTPError(404)
+        circuit_path = resources.resolved(build)
+        if circuit_path is None:
+            circuit_path = await tornado.ioloop.IOLoop.current().run_in_executor(None, resources.resolve, build)
+        if circuit_path is None:
+            raise tornado.web.HTTPError(404)
+
+        path = self.request.path
+        identity_tag, gzip_tag = resources.etags(path)
+        range_header = self.request.headers.get('Range')
+        # If-Range: the range only applies to the representation the client already has part of
+        if range_header and self.request.headers.get('If-Range', identity_tag) != identity_tag:
+            range_header = None
+
+        matching_tag = self.matching_etag([identity_tag, gzip_tag])
+        if matching_tag is not None:
+            metrics.cache_requests.inc(cache='resources', family=kind, result='not_modified')
+            self.set_header('Cache-Control', resources.IMMUTABLE)
+            self.set_header('Vary', 'Accept-Encoding')
+            self.set_header('ETag', matching_tag)
+            self.set_status(304)
+            return
+
+        resource = resources.get_resource(path)
+        if resource is None:
+            metrics.cache_requests.inc(cache='resources', family=kind, result='miss')
+            try:
+                body, headers = await load_resource(circuit_path, kind, entity, encoding)
+            except (KeyError, IndexError, ValueError) as e:
+                L.debug('no resource %s: %r', path, e)
+                raise tornado.web.HTTPError(404)
+            resource = await tornado.ioloop.IOLoop.current().run_in_executor(
+                None, resources.make_resource, body, encoding, headers)
+            resources.set_resource(path, resource)
+        else:
+            metrics.cache_requests.inc(cache='resources', family=kind, result='local_hit')
+
+        body = resource['body']
+        byte_range = None
+        if range_header:
+            try:
+                byte_range = resources.parse_range(range_header, len(body))
+            except ValueError:
+                self.set_status(416)
+                self.set_header('Content-Range', 'bytes */{}'.format(len(body)))
+                return
+
+        self.set_header('Cache-Control', resources.IMMUTABLE)
+        self.set_header('Vary', 'Accept-Encoding')
+        self.set_header('Accept-Ranges', 'bytes')
+        self.set_header('Content-Type', resource['content_type'])
+        for name, value in resource['headers'].items():
+            self.set_header(name, value)
+
+        if byte_range is not None:
+            start, end = byte_range
+            self.set_status(206)
+            self.set_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(body)))
+            self.set_header('ETag', identity_tag)
+            body = body[start:end]
+        elif resource['gzip'] is not None and 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            self.set_header('ETag', gzip_tag)
+            body = resource['gzip']
+        else:
+            self.set_header('ETag', identity_tag)
+
+        self.set_header('Content-Length', len(body))
+        if include_body:
+            self.write(body)
+
+
+def make_app():
+    return tornado.web.Application([
         (r'/ws', WSHandler),
         (r'/status', StatusHandler),
-    ], debug=os.getenv('DEBUG', False))
+        (r'/metrics', MetricsHandler),
+        (r'/healthz', HealthHandler),
+        (r'/readyz', ReadyHandler),
+        (r'/resources/([0-9a-f]+)/([a-z-]+)/([^/]+)\.(json|bin)', ResourceHandler),
+    ], debug=os.getenv('DEBUG', False), autoreload=bool(os.getenv('DEBUG', False)) and WORKERS == 1)
+
+
+def prebake_configured():
+    '''Prebake the configured circuits before forking, the workers then map the same artifacts'''
+    from .prebake import ensure_prebaked
+    from .storage import circuit_cache
+    for circuit_path in configured_circuits():
+        try:
+            ensure_prebaked(circuit_path)
+        except Exception as e:
+            L.error('can not prebake %s: %s', circuit_path, e)
+    # open circuits hold file handles, which must not be shared with the workers
+    circuit_cache.clear()
+
+
+def serve():
+    sockets = tornado.netutil.bind_sockets(PORT)
+    if WORKERS != 1:
+        prebake_configured()
+        # the parent only restarts workers which exit, each worker runs its own IOLoop
+        tornado.process.fork_processes(WORKERS)
+        SELF_TEST.result_path = os.path.join(tempfile.gettempdir(),
+                                             'ngv-viewer-self-test-{}.json'.format(os.getppid()))
+    worker = tornado.process.task_id()
+    server = tornado.httpserver.HTTPServer(make_app())
+    server.add_sockets(sockets)
     L.debug('starting tornado io loop')
-    app.listen(8000)
+    LOOP_LAG.start()
+    # the storage is loaded once the port is open, /readyz reports it
+    tornado.ioloop.IOLoop.current().spawn_callback(get_dispatcher)
+    tornado.ioloop.IOLoop.current().spawn_callback(warmup, dispatch)
+    SELF_TEST.start(get_storage, runner=worker in (None, 0))
     tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,212 @@
+
+'''Prometheus metrics of the websocket commands, the storage and the caches
+
+Metrics are kept in this process and exposed in the Prometheus text format
+by the /metrics endpoint. With WORKER_POOL=process, storage side metrics
+(caches, circuit loads) of the workers are not included.
+
+Each websocket request has a Trace, in a context variable so that storage
+calls, encoding and writes made on its behalf add up their time in the
+compute, serialize and send phases of the command.
+'''
+
+import os
+import time
+import string
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+# commands slower than this are logged with their trace
+SLOW_COMMAND_SECONDS = float(os.getenv('SLOW_COMMAND_SECONDS', 1))
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.label_names, key), value)
+                    for key, value in sorted(self.values.items())]
+
+    def exposition(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        lines += ['{}{} {}'.format(name, labels, repr(float(value))) for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), callback=None):
+        '''callback: function returning {label values tuple: value}, read at exposition time'''
+        super().__init__(name, description, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        return [(self.name, format_labels(self.label_names, key), value)
+                for key, value in sorted(self.callback().items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.))
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append((self.name + '_bucket',
+                                    format_labels(self.label_names, key, [('le', le)]), count))
+                samples.append((self.name + '_sum', format_labels(self.label_names, key), total))
+                samples.append((self.name + '_count', format_labels(self.label_names, key), counts[-1]))
+        return samples
+
+
+def exposition():
+    return '\n'.join(metric.exposition() for metric in REGISTRY) + '\n'
+
+
+command_seconds = Histogram('ngv_viewer_command_seconds',
+                            'Websocket command latency, total and by phase', ['cmd', 'phase'])
+sent_bytes = Counter('ngv_viewer_sent_bytes_total', 'Bytes written to websocket clients', ['cmd'])
+requests_in_flight = Gauge('ngv_viewer_requests_in_flight', 'Websocket commands being processed', ['cmd'])
+storage_in_flight = Gauge('ngv_viewer_storage_calls_in_flight', 'Storage calls running or queued', ['method'])
+connections = Gauge('ngv_viewer_connections', 'Open websocket connections')
+cache_requests = Counter('ngv_viewer_cache_requests_total', 'Cache lookups by key family and result',
+                         ['cache', 'family', 'result'])
+circuit_load_seconds = Histogram('ngv_viewer_circuit_load_seconds', 'Time to open a circuit')
+
+
+class Trace():
+    '''Phases of a websocket command, observed once the command and its streams are done'''
+    def __init__(self, cmd, cmdid, trace_id=None):
+        self.cmd = cmd
+        self.cmdid = cmdid
+        self.trace_id = cmdid if trace_id is None else trace_id
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.holds = 1
+        self.lock = threading.Lock()
+        self.on_finish = []
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.) + seconds
+
+    def hold(self):
+        '''Keep the trace open until a matching release, for streams outliving the command'''
+        with self.lock:
+            self.holds += 1
+
+    def release(self):
+        with self.lock:
+            self.holds -= 1
+            if self.holds:
+                return
+        self.finish()
+
+    def finish(self):
+        total = time.perf_counter() - self.start
+        command_seconds.observe(total, cmd=self.cmd, phase='total')
+        for phase, seconds in self.phases.items():
+            command_seconds.observe(seconds, cmd=self.cmd, phase=phase)
+        if total > SLOW_COMMAND_SECONDS:
+            L.warning('slow command %s, trace %s: %.3fs %s', self.cmd, self.trace_id, total,
+                      {phase: round(seconds, 4) for phase, seconds in self.phases.items()})
+        for callback in self.on_finish:
+            callback(self, total)
+
+
+current_trace = contextvars.ContextVar('trace', default=None)
+
+
+@contextmanager
+def phase(name):
+    '''Add the time spent in the block to the phase name of the current trace'''
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+def is_digest(part):
+    return len(part) == 40 and all(char in string.hexdigits for char in part)
+
+
+def key_family(key):
+    '''Family of a cache key (see cache.cache_key): its parts after the circuit, without the entity id or digest'''
+    parts = key.split(':')[1:]
+    if parts and (parts[-1].isdigit() or is_digest(parts[-1])):
+        parts = parts[:-1]
+    return ':'.join(parts)
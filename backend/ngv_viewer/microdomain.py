@@ -0,0 +1,94 @@
+
+'''Compact astrocyte microdomain meshes
+
+A packed mesh has its vertices quantized to uint16 relative to its bounding
+box, and triangle indices of the smallest of uint16 and uint32:
+
+    bbox: float32 (2, 3) min and max corners
+    vertices: uint16 (V, 3), position = min + vertices / QUANTIZATION_LEVELS * (max - min)
+    indices: uint16 or uint32 (T, 3)
+
+The quantization error is at most (max - min) / (2 * QUANTIZATION_LEVELS), a
+few nanometers for a microdomain.
+'''
+
+import numpy as np
+
+QUANTIZATION_LEVELS = np.iinfo(np.uint16).max
+# um, vertices of adjacent microdomains closer than this are merged
+MERGE_TOLERANCE = 1e-3
+
+
+def index_dtype(vertex_count):
+    return np.uint16 if vertex_count <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+def quantize(points, low, high):
+    extent = np.where(high > low, high - low, 1.)
+    return np.round((points - low) / extent * QUANTIZATION_LEVELS).astype(np.uint16)
+
+
+def dequantize(mesh):
+    '''float32 (V, 3) vertex positions of a packed mesh'''
+    low, high = mesh['bbox'].astype(np.float64)
+    return (low + mesh['vertices'] / QUANTIZATION_LEVELS * (high - low)).astype(np.float32)
+
+
+def pack_mesh(points, triangles):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    triangles = np.asarray(triangles).reshape(-1, 3)
+    # the float32 bbox sent to the client is the one the vertices are quantized against,
+    # an empty mesh has an empty box at the origin
+    bbox = np.array([points.min(axis=0), points.max(axis=0)]
+                    if len(points) else np.zeros((2, 3)), dtype=np.float32)
+    low, high = bbox.astype(np.float64)
+    return {
+        'bbox': bbox,
+        'vertices': quantize(points, low, high),
+        'indices': triangles.astype(index_dtype(len(points))),
+    }
+
+
+def concat_meshes(meshes):
+    '''Packed meshes in a single batch
+
+    Returns dict:
+        bboxes: float32 (N, 2, 3)
+        vertex_offsets: uint32 (N + 1,) first vertex of each mesh
+        index_offsets: uint32 (N + 1,) first triangle of each mesh
+        vertices: uint16 (V, 3)
+        indices: uint16 or uint32 (T, 3), relative to the first vertex of their mesh
+    '''
+    vertex_counts = [len(mesh['vertices']) for mesh in meshes]
+    dtype = index_dtype(max(vertex_counts, default=0))
+    return {
+        'bboxes': np.array([mesh['bbox'] for mesh in meshes], dtype=np.float32).reshape(-1, 2, 3),
+        'vertex_offsets': np.concatenate([[0], np.cumsum(vertex_counts)]).astype(np.uint32),
+        'index_offsets': np.concatenate([[0], np.cumsum([len(mesh['indices']) for mesh in meshes])]).astype(np.uint32),
+        'vertices': np.concatenate([mesh['vertices'] for mesh in meshes] or [np.empty((0, 3), np.uint16)]),
+        'indices': np.concatenate([mesh['indices'].astype(dtype) for mesh in meshes] or [np.empty((0, 3), dtype)]),
+    }
+
+
+def merge_meshes(domains, tolerance=MERGE_TOLERANCE):
+    '''Single packed mesh of several (points, triangles), vertices shared by domains stored once
+
+    triangle_offsets: uint32 (N + 1,) first triangle of each domain in the merged mesh.
+    No domains give an empty mesh.
+    '''
+    points = np.concatenate([np.asarray(points, dtype=np.float64).reshape(-1, 3) for points, _ in domains]
+                            or [np.empty((0, 3))])
+    vertex_offsets = np.concatenate([[0], np.cumsum([len(points) for points, _ in domains])])
+    triangles = np.concatenate([np.asarray(triangles, dtype=np.int64).reshape(-1, 3) + offset
+                                for (_, triangles), offset in zip(domains, vertex_offsets)]
+                               or [np.empty((0, 3), np.int64)])
+    _, first, inverse = np.unique(np.round(points / tolerance).astype(np.int64), axis=0,
+                                  return_index=True, return_inverse=True)
+    mesh = pack_mesh(points[first], inverse.reshape(-1)[triangles])
+    mesh['triangle_offsets'] = np.concatenate([[0], np.cumsum([len(t) for _, t in domains])]).astype(np.uint32)
+    return mesh
+
+
+def mesh_arrays(mesh):
+    '''{name: (values, dtype)} of the arrays of a packed mesh, see utils.pack_binary'''
+    return {name: (values, values.dtype.name) for name, values in mesh.items()}
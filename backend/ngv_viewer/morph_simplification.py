@@ -1,43 +1,121 @@
-
 import numpy as np
 import os
+import sys
 import logging
-from morph_tool.resampling import resample_linear_density
+
+from .morphology import pack_morphology, unpack_sections, ASTROCYTE_SEC_TYPE_SHORT_NAMES, SOMA_TYPE
 
 L = logging.getLogger(__name__)
 L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
 
-ASTROCYTE_SEC_SHORT_TYPE_DICT = {
-    'soma': 'soma',
-    'basal_dendrite': 'dend',
-    # 'apical_dendrite': 'apic',
-    'axon': 'apic'
-}
+# simplification tolerance (um) of each level of detail, from the coarsest to the finest
+LOD_EPSILONS = [4.0, 1.0, 0.25]
+# camera distance (um) under which the next finer level is used
+LOD_DISTANCES = [1000, 300]
 
-def simplify_neuron(morph, epsilon):
-    L.debug('simplifying morphology ...')
-    n_points_per_micron = 1
-    new_morph = resample_linear_density(morph, n_points_per_micron)
-
-    new_morph_obj = []
-
-    for new_section in new_morph.sections.values():
-        new_points_xyzr = [
-            np.array([*point, diameter])
-            for point, diameter in zip(new_section.points, new_section.diameters)
-        ]
-        new_morph_obj.append({
-           'points': new_points_xyzr,
-           'id': new_section.id,
-           'type': ASTROCYTE_SEC_SHORT_TYPE_DICT[new_section.type.name],
+
+def lod_for_distance(distance):
+    return int(np.sum(distance < np.array(LOD_DISTANCES)))
+
+
+def segment_distances(points, starts, ends):
+    '''Distance of each point to the segment [starts, ends] of the same row'''
+    segments = ends - starts
+    lengths_sq = np.einsum('ij,ij->i', segments, segments)
+    t = np.einsum('ij,ij->i', points - starts, segments)
+    t = np.clip(np.divide(t, lengths_sq, out=np.zeros_like(t), where=lengths_sq > 0), 0, 1)
+    projections = starts + t[:, np.newaxis] * segments
+    return np.linalg.norm(points - projections, axis=1)
+
+
+def rdp_mask(points, section_offsets, epsilon):
+    '''Ramer-Douglas-Peucker simplification of all the sections at once
+
+    Each iteration splits every section interval whose farthest point lies further
+    than epsilon from the interval chord, so the amount of numpy passes is the depth
+    of the RDP recursion rather than the amount of sections.
+
+    Returns a boolean mask of the points to keep, section end points are always kept.
+    '''
+    xyz = np.asarray(points)[:, :3].astype(np.float64)
+    keep = np.zeros(len(xyz), dtype=bool)
+    if not len(xyz):
+        return keep
+    section_offsets = np.asarray(section_offsets, dtype=np.int64)
+    sizes = np.diff(section_offsets)
+    keep[section_offsets[:-1][sizes > 0]] = True
+    keep[section_offsets[1:][sizes > 0] - 1] = True
+
+    while True:
+        kept = np.flatnonzero(keep)
+        # points between two consecutive kept points form an interval of a single section
+        interval = np.searchsorted(kept, np.arange(len(xyz)), side='right') - 1
+        left = kept[interval]
+        right = kept[np.minimum(interval + 1, len(kept) - 1)]
+        distances = segment_distances(xyz, xyz[left], xyz[right])
+        distances[keep] = -1
+
+        max_distances = np.maximum.reduceat(distances, kept)
+        farthest = (distances == max_distances[interval]) & (distances > epsilon)
+        if not farthest.any():
+            return keep
+        # a single point per interval: the first farthest one
+        candidates = np.flatnonzero(farthest)
+        _, first = np.unique(interval[candidates], return_index=True)
+        keep[candidates[first]] = True
+
+
+def simplify_packed(packed, epsilon):
+    '''Packed morphology (see morphology.pack_morphology) simplified with tolerance epsilon'''
+    section_offsets = packed['section_offsets']
+    keep = rdp_mask(packed['points'], section_offsets, epsilon)
+    # the soma outline is kept as is
+    for idx in np.flatnonzero(packed['section_types'] == SOMA_TYPE):
+        keep[section_offsets[idx] : section_offsets[idx + 1]] = True
+
+    kept_before = np.concatenate([[0], np.cumsum(keep)])
+    return dict(
+        packed,
+        points=np.asarray(packed['points'])[keep],
+        section_offsets=kept_before[np.asarray(section_offsets, dtype=np.int64)].astype(np.uint32),
+    )
+
+
+def lod_levels(packed, epsilons=LOD_EPSILONS):
+    '''Simplified copies of a packed morphology, one per level of detail'''
+    return [simplify_packed(packed, epsilon) for epsilon in epsilons]
+
+
+def lod_stats(packed, epsilons=LOD_EPSILONS):
+    '''Points and bytes of the packed arrays of each level of detail'''
+    stats = [{'epsilon': None, 'points': len(packed['points']),
+              'bytes': sum(np.asarray(arr).nbytes for arr in packed.values())}]
+    for epsilon, level in zip(epsilons, lod_levels(packed, epsilons)):
+        stats.append({
+            'epsilon': epsilon,
+            'points': len(level['points']),
+            'bytes': sum(np.asarray(arr).nbytes for arr in level.values()),
         })
+    return stats
 
-    # add soma
-    new_morph_obj.append({
-        'points': new_morph.soma.points,
-        'id': 'soma',
-        'type': ASTROCYTE_SEC_SHORT_TYPE_DICT['soma'],
-    })
 
+def simplify_neuron(morph, epsilon):
+    L.debug('simplifying morphology ...')
+    simplified = simplify_packed(pack_morphology(morph), epsilon)
+    new_morph_obj = unpack_sections(simplified, ASTROCYTE_SEC_TYPE_SHORT_NAMES, as_lists=False)
     L.debug('DONE simplifying morphology ...')
     return new_morph_obj
+
+
+def main(argv):
+    '''Print the size of each level of detail of the given morphology files'''
+    import morphio
+    print('{:<40} {:>8} {:>10} {:>10}'.format('morphology', 'epsilon', 'points', 'bytes'))
+    for path in argv:
+        for level in lod_stats(pack_morphology(morphio.Morphology(path))):
+            print('{:<40} {:>8} {:>10} {:>10}'.format(
+                os.path.basename(path), str(level['epsilon'] or 'full'), level['points'], level['bytes']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,113 @@
+
+import numpy as np
+
+
+# morphio SectionType codes
+SOMA_TYPE = 1
+SEC_TYPE_SHORT_NAMES = {
+    SOMA_TYPE: 'soma',
+    2: 'axon',
+    3: 'dend',
+    4: 'apic',
+}
+# astrocyte processes are stored as basal dendrites and perivascular ones as axons
+ASTROCYTE_SEC_TYPE_SHORT_NAMES = {
+    SOMA_TYPE: 'soma',
+    2: 'apic',
+    3: 'dend',
+}
+
+
+def pack_morphology(morph):
+    '''Structure of arrays representation of a morphio morphology
+
+    The soma is added as the last section, as in the section lists sent to the client.
+
+    Returns dict:
+        points: float32 (N, 4) x, y, z and diameter of all the section points
+        section_offsets: uint32 (S + 1,) first point of each section, last item is N
+        section_types: uint8 (S,) morphio SectionType codes
+        section_parents: int32 (S,) parent section index, -1 for roots
+    '''
+    soma_points = np.asarray(morph.soma.points, dtype=np.float32).reshape(-1, 3)
+    soma_diameters = np.asarray(morph.soma.diameters, dtype=np.float32)
+    points = np.concatenate([
+        np.column_stack([morph.points, morph.diameters]),
+        np.column_stack([soma_points, soma_diameters]),
+    ]).astype(np.float32)
+
+    section_offsets = np.append(morph.section_offsets, len(points)).astype(np.uint32)
+    section_types = np.append(morph.section_types, SOMA_TYPE).astype(np.uint8)
+
+    section_parents = np.full(len(section_types), -1, dtype=np.int32)
+    for parent, children in morph.connectivity.items():
+        section_parents[children] = parent
+
+    return {
+        'points': points,
+        'section_offsets': section_offsets,
+        'section_types': section_types,
+        'section_parents': section_parents,
+    }
+
+
+def concat_morphologies(packed_morphs):
+    '''Concatenate packed morphologies of several cells into one packed batch
+
+    Section offsets and parents are shifted to the batch, roots keep -1 as parent.
+    cell_offsets (uint32, (C + 1,)) holds the first section of each cell.
+    '''
+    section_counts = [len(m['section_types']) for m in packed_morphs]
+    point_counts = [len(m['points']) for m in packed_morphs]
+    section_starts = np.concatenate([[0], np.cumsum(section_counts)]).astype(np.uint32)
+    point_starts = np.concatenate([[0], np.cumsum(point_counts)])
+
+    if not packed_morphs:
+        return {
+            'points': np.empty((0, 4), dtype=np.float32),
+            'section_offsets': np.zeros(1, dtype=np.uint32),
+            'section_types': np.empty(0, dtype=np.uint8),
+            'section_parents': np.empty(0, dtype=np.int32),
+            'cell_offsets': section_starts,
+        }
+
+    parents = []
+    for m, section_start in zip(packed_morphs, section_starts):
+        section_parents = m['section_parents']
+        parents.append(np.where(section_parents < 0, -1, section_parents + section_start))
+
+    return {
+        'points': np.concatenate([m['points'] for m in packed_morphs]),
+        'section_offsets': np.append(
+            np.concatenate([m['section_offsets'][:-1] + start
+                            for m, start in zip(packed_morphs, point_starts)]),
+            point_starts[-1]).astype(np.uint32),
+        'section_types': np.concatenate([m['section_types'] for m in packed_morphs]),
+        'section_parents': np.concatenate(parents).astype(np.int32),
+        'cell_offsets': section_starts,
+    }
+
+
+def unpack_sections(packed, type_names=SEC_TYPE_SHORT_NAMES, as_lists=True):
+    '''Section list (as sent by get_cell_morphology) of a single packed morphology
+
+    With as_lists=False points are kept as float32 rows, as returned by simplify_neuron.
+    '''
+    points = packed['points'].tolist() if as_lists else list(np.asarray(packed['points']))
+    offsets = packed['section_offsets'].tolist()
+    sections = []
+    for idx, sec_type in enumerate(packed['section_types'].tolist()):
+        sec_points = points[offsets[idx]:offsets[idx + 1]]
+        if sec_type == SOMA_TYPE:
+            sections.append({
+                'points': [p[:3] for p in sec_points] if as_lists else np.array(sec_points)[:, :3],
+                'id': 'soma',
+                'type': type_names[SOMA_TYPE],
+            })
+        else:
+            sections.append({
+                'points': sec_points,
+                'id': idx,
+                'type': type_names[sec_type],
+            })
+    return sections
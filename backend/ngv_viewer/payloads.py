@@ -0,0 +1,87 @@
+
+'''Cache of encoded websocket responses, shared by all the connections
+
+Responses are kept as the bytes of their final frames, so a repeated request
+is answered without encoding it again. The cmdid of the request is the only
+part that differs between connections: it is encoded as CMDID and filled in
+when the frames are sent.
+'''
+
+import os
+import json
+import threading
+
+from .cache import LRUCache, cache_key
+from .metrics import phase
+from .utils import NumpyAwareJSONEncoder, pack_binary
+
+PAYLOAD_CACHE_BYTES = int(os.getenv('PAYLOAD_CACHE_BYTES', 512 * 1024 ** 2))
+
+# placeholder for the cmdid of the request in cached frames
+CMDID = '__cmdid__'
+CMDID_TOKEN = json.dumps(CMDID).encode()
+
+payload_cache = LRUCache('payloads', max_bytes=PAYLOAD_CACHE_BYTES)
+
+stats_lock = threading.Lock()
+bytes_saved = 0
+
+
+def payload_key(circuit_path, msg):
+    '''Cache key of the response to a message: circuit, command, arguments and encoding'''
+    data = json.dumps(msg.get('data'), sort_keys=True)
+    encoding = 'binary' if msg.get('binary') else 'json'
+    return cache_key(circuit_path, 'payload', msg['cmd'], data, encoding)
+
+
+def message_frame(cmd, data):
+    '''Text frame of a message, as (parts around the CMDID placeholders, binary)'''
+    with phase('serialize'):
+        payload = json.dumps({'cmd': cmd, 'data': data}, cls=NumpyAwareJSONEncoder).encode()
+    return payload.split(CMDID_TOKEN), False
+
+
+def binary_arrays_frames(cmd, arrays, **meta):
+    '''Binary header and binary frame of named arrays, see WSHandler.send_binary_arrays'''
+    with phase('serialize'):
+        descriptions, data = pack_binary(arrays)
+    return [
+        message_frame('binary_header', dict(meta, cmd=cmd, arrays=descriptions)),
+        ([data], True),
+    ]
+
+
+def frames_size(frames):
+    return sum(len(part) for parts, _ in frames for part in parts)
+
+
+def render(frames, cmdid):
+    '''(payload, binary) of each frame with the cmdid of the request filled in'''
+    cmdid_json = json.dumps(cmdid).encode()
+    return [(cmdid_json.join(parts), binary) for parts, binary in frames]
+
+
+def get_frames(key):
+    global bytes_saved
+    frames = payload_cache.get(key)
+    if frames is not None:
+        with stats_lock:
+            bytes_saved += frames_size(frames)
+    return frames
+
+
+def set_frames(key, frames):
+    payload_cache.set(key, frames, size=frames_size(frames))
+
+
+def drop_circuit(circuit_key):
+    '''Forget the responses of a circuit, when it leaves the circuit cache'''
+    payload_cache.drop_prefix(circuit_key + ':')
+
+
+def payload_stats():
+    stats = payload_cache.stats()
+    requests = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / requests if requests else None
+    stats['bytes_saved'] = bytes_saved
+    return stats
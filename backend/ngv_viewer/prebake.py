@@ -0,0 +1,148 @@
+
+'''Prebake a circuit into memory-mappable, viewer-ready artifacts
+
+    python -m ngv_viewer.prebake [--astrocyte-morphologies] <ngv_config.json> ...
+
+Without circuit configs the circuits listed in config.json are prebaked.
+Artifacts are written in ARTIFACT_DIR, see ngv_viewer.artifacts.
+'''
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+import numpy as np
+
+from .artifacts import save_array, save_manifest, remove_manifest, artifact_dir, artifact_lock, get_artifacts
+from .cell_table import build_cell_table
+from .config import configured_circuits
+from .layers import assign_layers
+from .morph_simplification import simplify_packed
+from .morphology import pack_morphology, concat_morphologies
+from .storage import get_circuit, load_circuit_cells
+from . import adjacency, vasculature
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+ASTROCYTE_MORPH_EPSILON = 0.5
+
+
+def prebake_cells(circuit_path, circuit):
+    cells = load_circuit_cells(circuit)
+    table = build_cell_table(cells)
+    save_array(circuit_path, 'positions', table['positions'])
+
+    props = {}
+    for idx, (prop, prop_info) in enumerate(table['props'].items()):
+        codes_name = 'prop_codes_{}'.format(idx)
+        save_array(circuit_path, codes_name, prop_info['codes'])
+        props[prop] = {
+            'values': prop_info['values'],
+            'codes': codes_name,
+        }
+    return cells, props
+
+
+def prebake_astrocytes(circuit_path, circuit, cells):
+    ids = np.asarray(circuit.astrocytes.ids())
+    positions = circuit.astrocytes.positions().to_numpy(dtype=np.float32)
+    save_array(circuit_path, 'astrocyte_ids', ids)
+    save_array(circuit_path, 'astrocyte_positions', positions)
+    save_array(circuit_path, 'astrocyte_layers', assign_layers(cells[['x', 'y', 'z']].to_numpy(),
+                                                               cells['layer'].to_numpy(), positions))
+    orientations = circuit.astrocytes.orientations(group=list(ids))
+    save_array(circuit_path, 'astrocyte_orientations', np.stack(list(orientations)).astype(np.float32))
+    return ids
+
+
+def prebake_astrocyte_morphologies(circuit_path, circuit, ids):
+    packed_morphs = []
+    for astrocyte_id in ids:
+        morph = circuit.astrocytes.morph.get(int(astrocyte_id), extension='h5')
+        packed_morphs.append(simplify_packed(pack_morphology(morph), ASTROCYTE_MORPH_EPSILON))
+    batch = concat_morphologies(packed_morphs)
+    for name in ['points', 'section_offsets', 'section_types', 'section_parents', 'cell_offsets']:
+        save_array(circuit_path, 'astrocyte_morph_' + name, batch[name])
+
+
+def prebake_vasculature(circuit_path, circuit):
+    bbox = vasculature.bounding_box(circuit.vasculature)
+    tiles = vasculature.build_tiles(circuit.vasculature, bbox)
+    for name in vasculature.TILE_ARRAYS:
+        save_array(circuit_path, 'vasculature_' + name, tiles[name])
+    return vasculature.bbox_dict(bbox)
+
+
+def prebake_adjacency(circuit_path, circuit):
+    built = adjacency.build_adjacency(circuit.neuroglial_connectome)
+    for name in adjacency.ADJACENCY_ARRAYS:
+        save_array(circuit_path, 'adjacency_' + name, built[name])
+
+
+def prebake(circuit_path, astrocyte_morphologies=False):
+    L.info('prebaking %s into %s', circuit_path, artifact_dir(circuit_path))
+    start = time.time()
+    # readers ignore the artifacts until the new manifest is written
+    remove_manifest(circuit_path)
+
+    circuit = get_circuit(circuit_path)
+    cells, props = prebake_cells(circuit_path, circuit)
+    L.info('cells done (%.1fs)', time.time() - start)
+
+    ids = prebake_astrocytes(circuit_path, circuit, cells)
+    L.info('astrocytes done (%.1fs)', time.time() - start)
+
+    if astrocyte_morphologies:
+        prebake_astrocyte_morphologies(circuit_path, circuit, ids)
+        L.info('astrocyte morphologies done (%.1fs)', time.time() - start)
+
+    prebake_adjacency(circuit_path, circuit)
+    L.info('neuroglial adjacency done (%.1fs)', time.time() - start)
+
+    vasculature_bbox = prebake_vasculature(circuit_path, circuit)
+    L.info('vasculature tiles done (%.1fs)', time.time() - start)
+
+    save_manifest(circuit_path, {
+        'circuit_path': circuit_path,
+        'count': len(cells),
+        'columns': cells.columns.tolist(),
+        'props': props,
+        'vasculature_bbox': vasculature_bbox,
+        'astrocyte_count': len(ids),
+        'created': time.time(),
+    })
+    L.info('prebaked %s in %.1fs', circuit_path, time.time() - start)
+
+
+def ensure_prebaked(circuit_path):
+    '''Artifacts of a circuit, prebaked by the first process asking for them'''
+    artifacts = get_artifacts(circuit_path)
+    if artifacts is not None:
+        return artifacts
+    with artifact_lock(circuit_path):
+        # another process may have prebaked it while this one was waiting for the lock
+        artifacts = get_artifacts(circuit_path)
+        if artifacts is None:
+            prebake(circuit_path)
+            artifacts = get_artifacts(circuit_path)
+    return artifacts
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Prebake circuits for ngv-viewer')
+    parser.add_argument('circuits', nargs='*', help='ngv_config.json paths, configured circuits by default')
+    parser.add_argument('--astrocyte-morphologies', action='store_true',
+                        help='also prebake simplified morphologies of all the astrocytes')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    for circuit_path in args.circuits or configured_circuits():
+        with artifact_lock(circuit_path):
+            prebake(circuit_path, astrocyte_morphologies=args.astrocyte_morphologies)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,122 @@
+
+'''Background warming of the storage caches with what the client will ask next
+
+Selecting an astrocyte is followed by requests for its morphology,
+microdomain, synapses and the morphologies of its efferent neurons, one
+round trip at a time. When get_astrocyte_props or get_efferent_neurons
+arrives, the Prefetcher of the connection loads them into the caches, one
+step at a time through the dispatcher at bulk priority, so that it doesn't
+hold back interactive storage calls. Selecting another astrocyte cancels the
+pending steps. warmup loads the circuits and astrocytes listed in config.json
+(see config.warmup_list) at startup.
+
+Workers of a process pool have caches of their own, only the shared redis tier
+can be warmed for them: without redis both are disabled by default.
+'''
+
+import os
+import asyncio
+import logging
+import contextvars
+
+from .config import warmup_list
+from .dispatcher import WORKER_POOL
+from .metrics import Counter
+from .redis_client import rc
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+# whether the caches warmed by a storage call are read by the other workers
+SHARED_CACHES = WORKER_POOL != 'process' or rc is not None
+PREFETCH = bool(int(os.getenv('PREFETCH', int(SHARED_CACHES))))
+WARMUP = bool(int(os.getenv('WARMUP', int(SHARED_CACHES))))
+# efferent neuron morphologies loaded for a selected astrocyte
+PREFETCH_NEURONS = int(os.getenv('PREFETCH_NEURONS', 8))
+
+prefetch_steps = Counter('ngv_viewer_prefetch_steps_total', 'Prefetch steps by kind and result',
+                         ['step', 'result'])
+
+
+def astrocyte_steps(circuit_path, astrocyte_id):
+    '''(name, storage method, args) warming the data of an astrocyte, in the order the client asks for it'''
+    yield 'astrocyte_morph', 'get_astrocyte_morph', (circuit_path, astrocyte_id)
+    yield 'astrocyte_microdomain', 'get_astrocyte_microdomain', (circuit_path, astrocyte_id)
+    yield 'efferent_neurons', 'get_efferent_neurons', (circuit_path, astrocyte_id)
+    yield 'astrocyte_synapses', 'get_astrocyte_synapse_index', (circuit_path, astrocyte_id)
+
+
+async def run_step(call, name, method, args):
+    '''Result of a prefetch step, None when it failed: prefetching is best effort
+
+    call: coroutine function running a storage method, e.g. Dispatcher.call
+    '''
+    try:
+        result = await call(method, *args)
+    except asyncio.CancelledError:
+        prefetch_steps.inc(step=name, result='cancelled')
+        raise
+    except Exception as e:
+        L.debug('prefetch %s%s failed: %s', method, args, e)
+        prefetch_steps.inc(step=name, result='error')
+        return None
+    prefetch_steps.inc(step=name, result='done')
+    return result
+
+
+async def prefetch_astrocyte(call, circuit_path, astrocyte_id, neurons=PREFETCH_NEURONS):
+    efferent_neurons = None
+    for name, method, args in astrocyte_steps(circuit_path, astrocyte_id):
+        result = await run_step(call, name, method, args)
+        if name == 'efferent_neurons':
+            efferent_neurons = result
+    if efferent_neurons is None:
+        return
+    # one at a time, so that a cancellation stops at the next neuron
+    for gid in list(efferent_neurons[:neurons]):
+        await run_step(call, 'cell_morph', 'get_packed_morphologies', (circuit_path, [int(gid)]))
+
+
+class Prefetcher():
+    '''Prefetching of the astrocyte last selected on a connection'''
+    def __init__(self, call):
+        '''call: coroutine function running a storage method at bulk priority'''
+        self.call = call
+        self.target = None
+        self.task = None
+
+    def astrocyte(self, circuit_path, astrocyte_id):
+        target = (circuit_path, astrocyte_id)
+        if not PREFETCH or target == self.target:
+            return
+        self.cancel()
+        L.debug('prefetching astrocyte %s', astrocyte_id)
+        self.target = target
+        # in a context of its own, not timed in the trace of the request that started it
+        self.task = contextvars.Context().run(
+            asyncio.ensure_future, prefetch_astrocyte(self.call, circuit_path, astrocyte_id))
+
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            L.debug('cancelling prefetch of astrocyte %s', self.target[1])
+            self.task.cancel()
+        self.task = None
+        self.target = None
+
+
+async def warmup(call):
+    '''Load the circuits and astrocytes of config.warmup_list, so that first clicks hit the caches
+
+    call: coroutine function running a storage method, e.g. Dispatcher.call
+    '''
+    circuits = warmup_list()
+    if not circuits or not WARMUP:
+        return
+    for circuit_path, astrocyte_ids in circuits:
+        L.info('warming up %s', circuit_path)
+        for name, method in [('circuit_metadata', 'get_circuit_metadata'),
+                             ('astrocytes_somas', 'get_astrocytes_somas')]:
+            await run_step(call, name, method, (circuit_path, ))
+        for astrocyte_id in astrocyte_ids:
+            await prefetch_astrocyte(call, circuit_path, astrocyte_id)
+    L.info('warmup done')
@@ -0,0 +1,247 @@
+
+'''Cell selection queries, evaluated over the columnar cell table
+
+A query is a small JSON expression, evaluated into a boolean mask of the
+neurons with vectorized operations:
+
+    {'and': [query, ...]}, {'or': [query, ...]}, {'not': query}
+    {'prop': 'layer', 'in': ['4', '5']}, {'prop': 'layer', 'eq': '4'}
+    {'prop': 'x', 'gte': 100, 'lt': 200}     gt, gte, lt, lte on positions and numeric properties,
+                                             in and eq on properties only
+    {'box': {'min': [x, y, z], 'max': [x, y, z]}}
+    {'sphere': {'center': [x, y, z], 'radius': r}}
+    {'efferent_to': astrocyte_id}            neurons contacted by the astrocyte
+    {'microdomain': astrocyte_id}            neurons inside the astrocyte microdomain
+    {'ids': [id, ...]}
+
+normalize gives the canonical form of a query, which results are cached by: eq
+is rewritten as in, values compared as strings, and only the keys of the
+operator are kept.
+'''
+
+import json
+import hashlib
+
+import numpy as np
+
+from .cell_table import POSITION_COLUMNS
+from . import spatial
+
+RANGE_OPERATORS = {
+    'gt': np.greater,
+    'gte': np.greater_equal,
+    'lt': np.less,
+    'lte': np.less_equal,
+}
+# tolerance of the point in microdomain test, in um
+MICRODOMAIN_EPSILON = 1e-3
+
+
+def number(value, name):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('{} must be a number, got {!r}'.format(name, value))
+    return value
+
+
+def integer(value, name):
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError('{} must be an integer, got {!r}'.format(name, value))
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('{} must be an integer, got {!r}'.format(name, value))
+
+
+def scalar(value, name):
+    if not isinstance(value, (str, int, float)):
+        raise ValueError('{} must be a string or a number, got {!r}'.format(name, value))
+    return str(value)
+
+
+def point(value, name):
+    if not isinstance(value, list) or len(value) != 3:
+        raise ValueError('{} must be [x, y, z], got {!r}'.format(name, value))
+    for coordinate in value:
+        number(coordinate, name)
+    return value
+
+
+def operand_list(value, name):
+    if not isinstance(value, list) or not value:
+        raise ValueError('{} must be a non empty list, got {!r}'.format(name, value))
+    return value
+
+
+def normalize(query):
+    '''Canonical form of a query: operands of and/or and value lists sorted
+
+    Raises ValueError when the query is malformed, so that evaluate only gets valid queries.
+    '''
+    if not isinstance(query, dict) or len(query) == 0:
+        raise ValueError('query must be a non empty object, got {!r}'.format(query))
+    if 'and' in query and 'or' in query:
+        raise ValueError('query can not have both and and or, nest them')
+    if 'and' in query or 'or' in query:
+        op = 'and' if 'and' in query else 'or'
+        operands = [normalize(operand) for operand in operand_list(query[op], op)]
+        return {op: sorted(operands, key=lambda operand: json.dumps(operand, sort_keys=True))}
+    if 'not' in query:
+        return {'not': normalize(query['not'])}
+    if 'prop' in query:
+        prop = query['prop']
+        if not isinstance(prop, str):
+            raise ValueError('prop must be a property name, got {!r}'.format(prop))
+        if 'in' in query or 'eq' in query:
+            if prop in POSITION_COLUMNS:
+                raise ValueError('position {} only takes {}'.format(prop, list(RANGE_OPERATORS)))
+            values = query['in'] if 'in' in query else [query['eq']]
+            if not isinstance(values, list):
+                raise ValueError('in must be a list of values, got {!r}'.format(values))
+            return {'prop': prop, 'in': sorted(set(scalar(value, prop) for value in values))}
+        ranges = {op: float(number(query[op], '{} {}'.format(prop, op))) for op in RANGE_OPERATORS if op in query}
+        if not ranges:
+            raise ValueError('prop {} needs in, eq or one of {}'.format(prop, list(RANGE_OPERATORS)))
+        return dict(ranges, prop=prop)
+    if 'box' in query:
+        if not isinstance(query['box'], dict):
+            raise ValueError('box must be {{min, max}}, got {!r}'.format(query['box']))
+        return {'box': {'min': point(query['box'].get('min'), 'box min'),
+                        'max': point(query['box'].get('max'), 'box max')}}
+    if 'sphere' in query:
+        if not isinstance(query['sphere'], dict):
+            raise ValueError('sphere must be {{center, radius}}, got {!r}'.format(query['sphere']))
+        return {'sphere': {'center': point(query['sphere'].get('center'), 'sphere center'),
+                           'radius': number(query['sphere'].get('radius'), 'sphere radius')}}
+    if 'efferent_to' in query or 'microdomain' in query:
+        op = 'efferent_to' if 'efferent_to' in query else 'microdomain'
+        return {op: integer(query[op], op)}
+    if 'ids' in query:
+        if not isinstance(query['ids'], list):
+            raise ValueError('ids must be a list, got {!r}'.format(query['ids']))
+        return {'ids': sorted(set(integer(gid, 'ids') for gid in query['ids']))}
+    raise ValueError('unknown query {}'.format(list(query)))
+
+
+def query_key(query):
+    '''Digest of the normalized query, equivalent queries share it'''
+    normalized = json.dumps(normalize(query), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def value_codes(values, selected):
+    '''Codes of the selected values of a property, compared as strings'''
+    selected = set(map(str, selected))
+    return np.array([code for code, value in enumerate(values) if str(value) in selected], dtype=np.int64)
+
+
+def prop_mask(table, query):
+    '''Mask of a normalized prop query'''
+    prop = query['prop']
+    if prop in POSITION_COLUMNS:
+        column = table['positions'][:, POSITION_COLUMNS.index(prop)]
+        mask = np.ones(len(column), dtype=bool)
+        for op, compare in RANGE_OPERATORS.items():
+            if op in query:
+                mask &= compare(column, query[op])
+        return mask
+
+    if prop not in table['props']:
+        raise ValueError('unknown property {}'.format(prop))
+    prop_info = table['props'][prop]
+    codes = np.asarray(prop_info['codes'])
+    if 'in' in query:
+        return np.isin(codes, value_codes(prop_info['values'], query['in']))
+
+    # ranges are evaluated once per distinct value, then looked up by code
+    try:
+        values = np.asarray(prop_info['values'], dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError('range on non numeric property {}'.format(prop))
+    matching = np.ones(len(values), dtype=bool)
+    for op, compare in RANGE_OPERATORS.items():
+        if op in query:
+            matching &= compare(values, query[op])
+    # missing values (code -1) pick the trailing False
+    return np.append(matching, False)[codes]
+
+
+def ids_mask(count, ids):
+    mask = np.zeros(count, dtype=bool)
+    ids = np.asarray(ids, dtype=np.int64)
+    mask[ids[(ids >= 0) & (ids < count)]] = True
+    return mask
+
+
+def inside_convex(points, vertices, triangles, epsilon=MICRODOMAIN_EPSILON):
+    '''Mask of the points inside the convex polyhedron of vertices and triangles'''
+    vertices = np.asarray(vertices, dtype=np.float64)
+    triangles = np.asarray(triangles, dtype=np.int64)
+    low, high = vertices.min(axis=0), vertices.max(axis=0)
+    # only the points in the bounding box are tested against the faces
+    mask = np.all((points >= low) & (points <= high), axis=1)
+
+    a, b, c = (vertices[triangles[:, i]] for i in range(3))
+    normals = np.cross(b - a, c - a)
+    # triangle winding is not reliable, normals are turned away from the centroid
+    normals *= np.sign(np.einsum('ij,ij->i', normals, a - vertices.mean(axis=0)))[:, None]
+    offsets = np.einsum('ij,ij->i', normals, a)
+    norms = np.linalg.norm(normals, axis=1)
+    valid = norms > 0
+
+    candidates = np.flatnonzero(mask)
+    distances = (np.asarray(points[candidates], dtype=np.float64) @ normals[valid].T - offsets[valid]) / norms[valid]
+    mask[candidates] = np.all(distances <= epsilon, axis=1)
+    return mask
+
+
+def evaluate(query, table, storage, circuit_path):
+    '''Boolean mask of the neurons of table matching query'''
+    count = table['count']
+    if 'and' in query:
+        mask = np.ones(count, dtype=bool)
+        for operand in query['and']:
+            mask &= evaluate(operand, table, storage, circuit_path)
+        return mask
+    if 'or' in query:
+        mask = np.zeros(count, dtype=bool)
+        for operand in query['or']:
+            mask |= evaluate(operand, table, storage, circuit_path)
+        return mask
+    if 'not' in query:
+        return ~evaluate(query['not'], table, storage, circuit_path)
+    if 'prop' in query:
+        return prop_mask(table, query)
+    if 'box' in query or 'sphere' in query:
+        grid = storage.get_spatial_index(circuit_path, 'neurons')
+        if 'box' in query:
+            cells = spatial.query_box(grid, query['box']['min'], query['box']['max'])
+        else:
+            cells = spatial.query_sphere(grid, query['sphere']['center'], query['sphere']['radius'])
+        return ids_mask(count, cells['ids'])
+    if 'efferent_to' in query:
+        return ids_mask(count, storage.get_efferent_neurons(circuit_path, query['efferent_to']))
+    if 'microdomain' in query:
+        microdomain = storage.get_astrocyte_microdomain(circuit_path, query['microdomain'])
+        return inside_convex(table['positions'], microdomain['vertices'], microdomain['indexes'])
+    if 'ids' in query:
+        return ids_mask(count, query['ids'])
+    raise ValueError('unknown query {}'.format(list(query)))
+
+
+def to_bitset(mask):
+    '''Bit i (little endian within each byte) set when cell i matches'''
+    return np.packbits(mask, bitorder='little')
+
+
+def bitset_ids(bitset, count):
+    '''Sorted ids of the cells set in a bitset'''
+    return np.flatnonzero(np.unpackbits(bitset, count=count, bitorder='little')).astype(np.uint32)
+
+
+def result_format(selected, total, requested=None):
+    '''Requested format, or the smaller of the sorted ids and the bitset'''
+    if requested in ['ids', 'bitset']:
+        return requested
+    if requested is not None:
+        raise ValueError('unknown query result format {}'.format(requested))
+    return 'ids' if selected * 4 < (total + 7) // 8 else 'bitset'
@@ -1,28 +1,101 @@
 
 import os
-import json
+import logging
 
 import redis
 
+from .cache import LRUCache
+from .metrics import cache_requests, key_family
+from .serialization import dumps, loads, FORMAT_VERSION
+from .version import VERSION
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
 
 REDIS_HOST = os.getenv('REDIS_HOST')
+REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 32))
+# seconds, 0 to keep keys until redis evicts them
+REDIS_TTL = int(os.getenv('REDIS_TTL', 7 * 24 * 3600))
 
-if REDIS_HOST is not None and REDIS_HOST is not '':
-    rc = redis.StrictRedis(host=REDIS_HOST)
+# entries written by another app or serialization version are never read back
+KEY_PREFIX = 'ngv-viewer:{}:{}:'.format(VERSION, FORMAT_VERSION)
+
+if REDIS_HOST is not None and REDIS_HOST != '':
+    pool = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, max_connections=REDIS_MAX_CONNECTIONS)
+    rc = redis.StrictRedis(connection_pool=pool)
 else:
     rc = None
-    local_cache = dict()
 
 
 class RedisClient():
+    '''Two level cache: in-process LRU hot tier, then redis shared by all the backend replicas
+
+    Redis errors are logged and treated as cache misses.
+    '''
+    def __init__(self, name='default', max_bytes=None, client=None):
+        self.local_cache = LRUCache(name, max_bytes=max_bytes)
+        self.rc = rc if client is None else client
+
     def get(self, key):
-        if rc is not None:
-            return rc.get(key)
-        else:
-            return local_cache.get(key)
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        '''Values of keys, None for missing ones. Redis is queried once for all local misses'''
+        values = [self.local_cache.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        for key, value in zip(keys, values):
+            if value is not None:
+                self.count(key, 'local_hit')
+        if self.rc is None or not missing:
+            self.count_misses(keys, values, missing)
+            return values
+
+        try:
+            blobs = self.rc.mget([KEY_PREFIX + keys[i] for i in missing])
+        except redis.RedisError as e:
+            L.warning('redis get failed: %s', e)
+            self.count_misses(keys, values, missing)
+            return values
+
+        for i, blob in zip(missing, blobs):
+            if blob is None:
+                continue
+            try:
+                values[i] = loads(blob)
+            except ValueError as e:
+                L.warning('can not decode cached %s: %s', keys[i], e)
+                continue
+            self.local_cache.set(keys[i], values[i])
+            self.count(keys[i], 'redis_hit')
+        self.count_misses(keys, values, missing)
+        return values
+
+    def count(self, key, result):
+        cache_requests.inc(cache=self.local_cache.name, family=key_family(key), result=result)
+
+    def count_misses(self, keys, values, missing):
+        for i in missing:
+            if values[i] is None:
+                self.count(keys[i], 'miss')
 
     def set(self, key, val):
-        if rc is not None:
-            rc.set(key, val)
-        else:
-            local_cache[key] = val
+        self.set_many({key: val})
+
+    def set_many(self, items):
+        for key, val in items.items():
+            self.local_cache.set(key, val)
+        if self.rc is None:
+            return
+
+        try:
+            pipe = self.rc.pipeline(transaction=False)
+            for key, val in items.items():
+                pipe.set(KEY_PREFIX + key, dumps(val), ex=REDIS_TTL or None)
+            pipe.execute()
+        except (redis.RedisError, TypeError) as e:
+            L.warning('redis set failed: %s', e)
+
+    def stats(self):
+        return self.local_cache.stats()
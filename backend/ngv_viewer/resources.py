@@ -0,0 +1,159 @@
+
+'''Immutable HTTP resources of a circuit build
+
+Per entity data is also served over plain HTTP GET, addressed by the build
+hash of the circuit (see cache.build_hash), so that browsers, nginx and CDNs
+can cache it forever:
+
+    /resources/<build>/<kind>/<id>.<json|bin>
+
+A new build of a circuit gets a new hash, hence new URLs, and the responses of
+a URL never change. ETags are derived from the URL only, so conditional
+requests are answered without loading anything. A build resolved less than
+CIRCUIT_MTIME_TTL ago is not even checked against its circuit config, see
+resolved, the others are resolved in an executor. Bodies are encoded once, and
+gzipped once when that makes them smaller, then kept in an LRU cache of
+RESOURCE_CACHE_BYTES. bin bodies are arrays packed by utils.pack_binary,
+described by the X-Binary-Arrays header.
+'''
+
+import os
+import gzip
+import json
+import hashlib
+import logging
+
+from .artifacts import ARTIFACT_DIR, MANIFEST
+from .cache import LRUCache, build_hash, key_hash, memoized_circuit_key
+from .config import configured_circuits
+from .utils import NumpyAwareJSONEncoder, pack_binary
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+RESOURCE_CACHE_BYTES = int(os.getenv('RESOURCE_CACHE_BYTES', 256 * 1024 ** 2))
+# smaller bodies are not worth a Content-Encoding
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+CONTENT_TYPES = {
+    'json': 'application/json; charset=UTF-8',
+    'bin': 'application/octet-stream',
+}
+
+resource_cache = LRUCache('resources', max_bytes=RESOURCE_CACHE_BYTES)
+
+# build hash -> circuit path, of the builds whose metadata this process has sent
+builds = {}
+
+
+def register(circuit_path):
+    '''Build hash of a circuit, remembered to resolve its resource URLs'''
+    build = build_hash(circuit_path)
+    builds[build] = circuit_path
+    return build
+
+
+def is_build(circuit_path, build):
+    try:
+        return circuit_path is not None and build_hash(circuit_path) == build
+    except FileNotFoundError:
+        return False
+
+
+def candidates(build):
+    '''Circuits which can have a build hash registered by another worker'''
+    yield from configured_circuits()
+    manifest_path = os.path.join(ARTIFACT_DIR, build, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            yield json.load(manifest_file).get('circuit_path')
+
+
+def resolved(build):
+    '''Circuit path of a build hash from the memoized mtime of its config, None when resolve is needed'''
+    circuit_path = builds.get(build)
+    key = memoized_circuit_key(circuit_path) if circuit_path is not None else None
+    if key is not None and key_hash(key) == build:
+        return circuit_path
+    return None
+
+
+def resolve(build):
+    '''Circuit path of a build hash, None when it is unknown or not the current build of its circuit
+
+    Builds registered by another worker are found from the configured circuits or
+    the manifests of the prebaked artifacts. Reads GPFS, not to be run on the IOLoop.
+    '''
+    if is_build(builds.get(build), build):
+        return builds[build]
+    builds.pop(build, None)
+    for circuit_path in candidates(build):
+        if is_build(circuit_path, build):
+            builds[build] = circuit_path
+            return circuit_path
+    return None
+
+
+def etags(path):
+    '''Strong ETags of the identity and gzip representations of the resource at path'''
+    digest = hashlib.sha1(path.encode()).hexdigest()
+    return '"{}"'.format(digest), '"{}-gz"'.format(digest)
+
+
+def parse_range(header, size):
+    '''(start, end) of a single bytes range, end excluded, None to send the whole body
+
+    Raises ValueError when the range can not be satisfied.
+    '''
+    unit, _, ranges = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges or '-' not in ranges:
+        return None
+    first, last = (part.strip() for part in ranges.split('-', 1))
+    try:
+        if not first:
+            # suffix range: the last bytes of the body
+            start, end = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None
+    if start >= size or start >= end:
+        raise ValueError('range {} not satisfiable for {} bytes'.format(header, size))
+    return start, end
+
+
+def json_body(data):
+    return json.dumps(data, cls=NumpyAwareJSONEncoder).encode()
+
+
+def binary_body(arrays):
+    '''Body of named arrays, {name: (values, dtype)}, and the header describing them'''
+    descriptions, data = pack_binary(arrays)
+    return data, {'X-Binary-Arrays': json.dumps(descriptions)}
+
+
+def make_resource(body, encoding, headers=None):
+    '''Encoded resource, with its gzipped body when smaller'''
+    gzipped = None
+    if len(body) >= GZIP_MIN_BYTES:
+        gzipped = gzip.compress(body, GZIP_LEVEL)
+        if len(gzipped) >= len(body):
+            gzipped = None
+    return {
+        'body': body,
+        'gzip': gzipped,
+        'content_type': CONTENT_TYPES[encoding],
+        'headers': headers or {},
+    }
+
+
+def get_resource(path):
+    return resource_cache.get(path)
+
+
+def set_resource(path, resource):
+    size = len(resource['body']) + len(resource['gzip'] or b'')
+    resource_cache.set(path, resource, size=size)
@@ -0,0 +1,235 @@
+
+'''Prioritized scheduling of the requests of a websocket connection
+
+Requests are interactive (a click waiting for its answer) or bulk (large
+streams and batches of entities), from BULK_COMMANDS or the 'priority' of the
+message. Requests of a connection run concurrently, the scheduler decides:
+
+- which waiting storage call gets a free slot: interactive ones first, and
+  bulk ones never take the last INTERACTIVE_SLOTS slots,
+- which stream writes its next chunk: one chunk at a time, interactive
+  streams first, and streams of the same class in turn, so that chunks of
+  concurrent streams are interleaved rather than sent one stream after the
+  other. Single frame responses are written right away.
+
+A message with a 'supersede' key cancels the request of the connection
+still running with the same key, e.g. the props of the previously clicked
+astrocyte.
+
+Requests and their streams are tracked by an id of the scheduler, the cmdid of
+a message only addresses them for 'cancel': clients can send many requests
+without a cmdid, or with the same one.
+'''
+
+import os
+import asyncio
+import itertools
+import logging
+import contextvars
+from collections import deque
+from contextlib import asynccontextmanager
+
+from .metrics import Counter
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITIES = {'interactive': INTERACTIVE, 'bulk': BULK}
+
+BULK_COMMANDS = {
+    'get_circuit_cells',
+    'get_circuit_cell_positions',
+    'get_circuit_prop_index',
+    'get_circuit_prop_values',
+    'get_cell_morphologies',
+    'get_astrocyte_microdomains',
+    'get_vasculature_tiles',
+}
+
+# storage call slots of a connection that only interactive requests can take
+INTERACTIVE_SLOTS = int(os.getenv('INTERACTIVE_SLOTS', 1))
+
+current_priority = contextvars.ContextVar('priority', default=INTERACTIVE)
+# scheduler id of the request handled by the current task, the key of its stream
+current_request = contextvars.ContextVar('request', default=None)
+
+cancelled_requests = Counter('ngv_viewer_cancelled_requests_total', 'Requests cancelled before completion',
+                             ['cmd', 'reason'])
+
+
+def message_priority(msg):
+    '''Priority class of a message, its 'priority' or the one of its command'''
+    if msg.get('priority') in PRIORITIES:
+        return PRIORITIES[msg['priority']]
+    return BULK if msg['cmd'] in BULK_COMMANDS else INTERACTIVE
+
+
+class Waiters():
+    '''Futures waiting for their turn, by priority class then in arrival order'''
+    def __init__(self):
+        self.queues = (deque(), deque())
+
+    async def wait(self, priority, on_cancel):
+        '''Wait to be woken up, on_cancel gives back what was handed over to a cancelled waiter'''
+        future = asyncio.get_event_loop().create_future()
+        self.queues[priority].append((future, priority))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                on_cancel(priority)
+            raise
+
+    def pop(self, allowed):
+        '''First waiting (future, priority) with allowed(priority), None when there is none'''
+        for queue in self.queues:
+            while queue and queue[0][0].done():
+                queue.popleft()
+            if queue and allowed(queue[0][1]):
+                return queue.popleft()
+        return None
+
+    def ahead(self, priority):
+        '''Amount of waiters served before a new one of priority'''
+        return sum(len(queue) for queue in self.queues[:priority + 1])
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+
+class PrioritySemaphore():
+    '''Semaphore handing free slots to interactive waiters first, keeping reserved slots for them'''
+    def __init__(self, value, reserved=INTERACTIVE_SLOTS):
+        self.free = value
+        # at least one slot for bulk requests
+        self.bulk_limit = max(value - reserved, 1)
+        self.bulk_held = 0
+        self.waiters = Waiters()
+
+    def can_take(self, priority):
+        return self.free > 0 and (priority == INTERACTIVE or self.bulk_held < self.bulk_limit)
+
+    def take(self, priority):
+        self.free -= 1
+        self.bulk_held += priority == BULK
+
+    async def acquire(self, priority):
+        if not self.waiters.ahead(priority) and self.can_take(priority):
+            self.take(priority)
+            return
+        await self.waiters.wait(priority, self.release)
+
+    def release(self, priority):
+        self.free += 1
+        self.bulk_held -= priority == BULK
+        waiter = self.waiters.pop(self.can_take)
+        if waiter is not None:
+            future, waiter_priority = waiter
+            self.take(waiter_priority)
+            future.set_result(None)
+
+
+class Turns():
+    '''Chunk writes of the streams of a connection, one at a time'''
+    def __init__(self):
+        self.busy = False
+        self.waiters = Waiters()
+
+    async def acquire(self, priority):
+        if not self.busy:
+            self.busy = True
+            return
+        await self.waiters.wait(priority, self.release)
+
+    def release(self, priority=None):
+        waiter = self.waiters.pop(lambda _: True)
+        if waiter is None:
+            self.busy = False
+        else:
+            waiter[0].set_result(None)
+
+
+class Scheduler():
+    '''Running requests of a connection, their storage call slots and stream turns
+
+    command_label maps the command of a message to its metrics label.
+    '''
+    def __init__(self, storage_slots, streams, command_label=str):
+        self.slots = PrioritySemaphore(storage_slots)
+        self.command_label = command_label
+        self.turns = Turns()
+        self.streams = streams
+        self.request_ids = itertools.count()
+        # request id -> task
+        self.tasks = {}
+        # supersede key -> request id
+        self.superseding = {}
+
+    def start(self, msg, coro):
+        '''Run the coroutine handling msg, cancelling the request it supersedes'''
+        request = next(self.request_ids)
+        key = msg.get('supersede')
+        if key is not None:
+            superseded = self.superseding.get(key)
+            if superseded is not None:
+                self.cancel_request(superseded, reason='superseded')
+            self.superseding[key] = request
+        # the task copies the context it is created in
+        context = contextvars.copy_context()
+        context.run(current_request.set, request)
+        task = context.run(asyncio.ensure_future, coro)
+        task.cmd = self.command_label(msg['cmd'])
+        task.cmdid = msg.get('cmdid')
+        self.tasks[request] = task
+        task.add_done_callback(lambda task: self.done(request, task))
+        return task
+
+    def done(self, request, task):
+        # superseding keeps the request id, a stream started by the request can still be running
+        if self.tasks.get(request) is task:
+            del self.tasks[request]
+        if not task.cancelled() and task.exception() is not None:
+            L.error('request %s failed', task.cmdid, exc_info=task.exception())
+
+    def cancel_request(self, request, reason='cancelled'):
+        '''Cancel a running request and its stream'''
+        task = self.tasks.pop(request, None)
+        if task is not None and not task.done():
+            L.debug('cancelling request %s (%s)', task.cmdid, reason)
+            cancelled_requests.inc(cmd=task.cmd, reason=reason)
+            task.cancel()
+        self.streams.cancel(request)
+
+    def cancel(self, cmdid, reason='cancelled'):
+        '''Cancel the running requests with a cmdid and their streams'''
+        if cmdid is None:
+            return
+        for request, task in list(self.tasks.items()):
+            if task.cmdid == cmdid:
+                self.cancel_request(request, reason=reason)
+        self.streams.cancel_cmdid(cmdid)
+
+    def cancel_all(self):
+        for request in list(self.tasks):
+            self.cancel_request(request, reason='closed')
+        self.streams.cancel_all()
+
+    @asynccontextmanager
+    async def turn(self):
+        '''Turn of the current request to write a stream chunk'''
+        priority = current_priority.get()
+        await self.turns.acquire(priority)
+        try:
+            yield
+        finally:
+            self.turns.release()
+
+    def stats(self):
+        return {
+            'running': len(self.tasks),
+            'storage_waiting': len(self.slots.waiters),
+            'free_storage_slots': self.slots.free,
+            'stream_waiting': len(self.turns.waiters),
+        }
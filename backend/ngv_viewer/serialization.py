@@ -0,0 +1,144 @@
+
+import io
+import os
+import json
+import zlib
+import struct
+
+import numpy as np
+
+
+MAGIC = b'NGV'
+# bump when the binary layout changes, it is part of the redis key prefix
+FORMAT_VERSION = 1
+
+FLAG_ZLIB = 1
+
+# zlib level, 0 disables compression
+COMPRESSION_LEVEL = int(os.getenv('REDIS_COMPRESSION', 1))
+COMPRESSION_MIN_SIZE = 1024
+
+
+class Encoder():
+    '''Splits an object into a JSON skeleton and a list of numpy arrays
+
+    Supported: JSON types, numpy arrays and scalars, pandas DataFrames,
+    dicts with non string keys and lists of equally shaped arrays.
+    '''
+    def __init__(self):
+        self.arrays = []
+
+    def array_ref(self, arr):
+        if arr.dtype == object:
+            return {'__objects__': self.encode(arr.tolist())}
+        self.arrays.append(np.ascontiguousarray(arr))
+        return {'__ndarray__': len(self.arrays) - 1}
+
+    def encode(self, obj):
+        if isinstance(obj, np.ndarray):
+            return self.array_ref(obj)
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if hasattr(obj, 'columns') and hasattr(obj, 'index'):
+            return {'__dataframe__': {
+                'columns': [self.encode(c) for c in obj.columns],
+                'data': [self.encode_column(obj[c]) for c in obj.columns],
+                'index': self.encode_column(obj.index),
+                'index_name': obj.index.name,
+            }}
+        if isinstance(obj, dict):
+            if all(isinstance(k, str) for k in obj):
+                return {k: self.encode(v) for k, v in obj.items()}
+            return {'__items__': [[self.encode(k), self.encode(v)] for k, v in obj.items()]}
+        if isinstance(obj, (list, tuple)):
+            if obj and all(isinstance(item, np.ndarray) for item in obj):
+                first = obj[0]
+                if all(item.shape == first.shape and item.dtype == first.dtype for item in obj):
+                    return {'__ndlist__': self.array_ref(np.stack(obj))}
+            return [self.encode(item) for item in obj]
+        return obj
+
+    def encode_column(self, column):
+        if str(column.dtype) == 'category':
+            return {'__categorical__': {
+                'codes': self.array_ref(column.cat.codes.to_numpy()),
+                'categories': self.encode_column(column.cat.categories),
+            }}
+        values = column.to_numpy()
+        if values.dtype.kind in 'biuf':
+            return self.array_ref(values)
+        return {'__objects__': self.encode(values.tolist())}
+
+
+class Decoder():
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def decode(self, obj):
+        if isinstance(obj, list):
+            return [self.decode(item) for item in obj]
+        if not isinstance(obj, dict):
+            return obj
+        if '__ndarray__' in obj:
+            return self.arrays[obj['__ndarray__']]
+        if '__objects__' in obj:
+            return np.array(self.decode(obj['__objects__']), dtype=object)
+        if '__ndlist__' in obj:
+            return list(self.decode(obj['__ndlist__']))
+        if '__items__' in obj:
+            return {self.decode(k): self.decode(v) for k, v in obj['__items__']}
+        if '__dataframe__' in obj:
+            return self.decode_dataframe(obj['__dataframe__'])
+        return {k: self.decode(v) for k, v in obj.items()}
+
+    def decode_column(self, obj):
+        import pandas as pd
+        if isinstance(obj, dict) and '__categorical__' in obj:
+            categorical = obj['__categorical__']
+            return pd.Categorical.from_codes(self.decode(categorical['codes']),
+                                             self.decode_column(categorical['categories']))
+        return self.decode(obj)
+
+    def decode_dataframe(self, obj):
+        import pandas as pd
+        columns = [self.decode(c) for c in obj['columns']]
+        index = pd.Index(self.decode_column(obj['index']), name=obj['index_name'])
+        data = {column: self.decode_column(values) for column, values in zip(columns, obj['data'])}
+        return pd.DataFrame(data, index=index, columns=columns)
+
+
+def dumps(obj, compression_level=COMPRESSION_LEVEL):
+    '''Binary encoding of obj: header, JSON skeleton and npy blobs of its arrays'''
+    encoder = Encoder()
+    skeleton = json.dumps(encoder.encode(obj)).encode()
+
+    buffer = io.BytesIO()
+    buffer.write(struct.pack('<II', len(skeleton), len(encoder.arrays)))
+    buffer.write(skeleton)
+    for arr in encoder.arrays:
+        np.lib.format.write_array(buffer, arr, allow_pickle=False)
+    payload = buffer.getvalue()
+
+    flags = 0
+    if compression_level and len(payload) > COMPRESSION_MIN_SIZE:
+        payload = zlib.compress(payload, compression_level)
+        flags |= FLAG_ZLIB
+    return MAGIC + struct.pack('<BB', FORMAT_VERSION, flags) + payload
+
+
+def loads(data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not an ngv-viewer serialized object')
+    version, flags = struct.unpack_from('<BB', data, len(MAGIC))
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported serialization format version {}'.format(version))
+    payload = data[len(MAGIC) + 2:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+
+    skeleton_size, array_count = struct.unpack_from('<II', payload)
+    buffer = io.BytesIO(payload)
+    buffer.seek(8)
+    skeleton = json.loads(buffer.read(skeleton_size))
+    arrays = [np.lib.format.read_array(buffer, allow_pickle=False) for _ in range(array_count)]
+    return Decoder(arrays).decode(skeleton)
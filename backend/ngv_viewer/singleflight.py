@@ -0,0 +1,128 @@
+
+'''Coalescing of concurrent identical storage calls
+
+The first caller of a key computes the value, callers arriving while it runs
+wait for it and share its result (or exception). Across processes and replicas
+a redis lock per key serializes the computations: the next holder of the lock
+finds the value the previous one has cached. Without redis, or when the lock
+can't be taken, calls are only coalesced within the process.
+'''
+
+import os
+import logging
+import threading
+from functools import wraps
+
+import redis
+
+from .cache import cache_key
+from .redis_client import rc, KEY_PREFIX
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+# seconds a redis lock is held at most, and waited for at most
+SINGLEFLIGHT_LOCK_TIMEOUT = int(os.getenv('SINGLEFLIGHT_LOCK_TIMEOUT', 300))
+
+
+class Flight():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    def __init__(self, client=None):
+        self.rc = client
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.deduplicated = 0
+        self.remote_waits = 0
+        self.lock_errors = 0
+
+    def do(self, key, fn, shared=True):
+        '''Result of fn(), computed once for all the concurrent calls with key
+
+        With shared, the computation is also serialized across processes with a redis lock.
+        '''
+        with self.lock:
+            self.calls += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                self.deduplicated += 1
+
+        if not leader:
+            L.debug('waiting for in-flight %s', key)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            if shared and self.rc is not None:
+                flight.result = self.locked(key, fn)
+            else:
+                flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def locked(self, key, fn):
+        '''fn() under the redis lock of key, without the lock when redis fails'''
+        lock = self.rc.lock(KEY_PREFIX + 'lock:' + key, timeout=SINGLEFLIGHT_LOCK_TIMEOUT)
+        try:
+            acquired = lock.acquire(blocking=False)
+            if not acquired:
+                with self.lock:
+                    self.remote_waits += 1
+                L.debug('waiting for %s computed by another process', key)
+                acquired = lock.acquire(blocking=True, blocking_timeout=SINGLEFLIGHT_LOCK_TIMEOUT)
+        except redis.RedisError as e:
+            L.warning('redis lock failed: %s', e)
+            acquired = False
+        if not acquired:
+            with self.lock:
+                self.lock_errors += 1
+            return fn()
+
+        try:
+            return fn()
+        finally:
+            try:
+                lock.release()
+            except redis.RedisError as e:
+                L.warning('redis unlock failed: %s', e)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'deduplicated': self.deduplicated,
+                'in_flight': len(self.flights),
+                'remote_waits': self.remote_waits,
+                'lock_errors': self.lock_errors,
+            }
+
+
+flights = SingleFlight(rc)
+
+
+def single_flight(op, shared=True):
+    '''Coalesce concurrent calls of a Storage method, keyed by circuit, op and arguments'''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, circuit_path, *args):
+            return flights.do(cache_key(circuit_path, 'flight', op, *args),
+                              lambda: method(self, circuit_path, *args), shared)
+        return wrapper
+    return decorator
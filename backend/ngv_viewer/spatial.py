@@ -0,0 +1,142 @@
+
+'''Uniform grid spatial index over cell positions
+
+The index is a dict of arrays (so that it goes through the serialization layer
+and the caches as is): points are sorted by grid cell, so each grid cell is a
+contiguous slice of ids and positions, and region queries only test the points
+of the grid cells overlapping the region.
+'''
+
+import numpy as np
+
+# average amount of points per grid cell the grid resolution is chosen for
+POINTS_PER_CELL = 64
+# seed of the shuffle the level of detail samples come from, fixed to keep samples stable
+SAMPLE_SEED = 0
+
+
+def build_grid(positions, ids=None, points_per_cell=POINTS_PER_CELL):
+    '''Spatial index of positions, float32 (N, 3)
+
+    Returns dict:
+        origin: float32 (3,) min corner of the grid
+        cell_size: float32 (3,) size of a grid cell
+        dims: int64 (3,) amount of grid cells along each axis
+        cell_offsets: uint32 (C + 1,) first point of each grid cell, C-ordered
+        ids: uint32 (N,) ids of the points, sorted by grid cell
+        positions: float32 (N, 3) positions of the points, sorted by grid cell
+    '''
+    positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+    ids = np.arange(len(positions)) if ids is None else np.asarray(ids)
+    if len(positions):
+        origin = positions.min(axis=0)
+        extent = np.maximum(positions.max(axis=0) - origin, 1e-3)
+    else:
+        origin = np.zeros(3, dtype=np.float32)
+        extent = np.ones(3, dtype=np.float32)
+
+    dims, cell_size = grid_shape(extent, len(positions), points_per_cell)
+    cells = np.ravel_multi_index(cell_coords(origin, cell_size, dims, positions).T, dims)
+    # shuffle first so that the leading points of a grid cell are a random sample of it
+    shuffle = np.random.default_rng(SAMPLE_SEED).permutation(len(positions))
+    order = shuffle[np.argsort(cells[shuffle], kind='stable')]
+    cell_offsets = np.searchsorted(cells[order], np.arange(np.prod(dims) + 1))
+
+    return {
+        'origin': origin.astype(np.float32),
+        'cell_size': cell_size,
+        'dims': dims,
+        'cell_offsets': cell_offsets.astype(np.uint32),
+        'ids': ids[order].astype(np.uint32),
+        'positions': positions[order],
+    }
+
+
+def grid_shape(extent, count, points_per_cell=POINTS_PER_CELL):
+    '''(dims, cell_size) of a grid of about cubic cells over extent, for count points'''
+    cell_count = max(count / points_per_cell, 1)
+    side = (np.prod(extent) / cell_count) ** (1 / 3)
+    dims = np.clip(np.ceil(extent / side), 1, None).astype(np.int64)
+    # slightly larger cells so that the max corner falls in the last cell
+    cell_size = (extent / dims * (1 + 1e-6)).astype(np.float32)
+    return dims, cell_size
+
+
+def cell_coords(origin, cell_size, dims, points):
+    '''Grid cell coordinates of points, clipped to the grid'''
+    coords = np.floor((np.asarray(points, dtype=np.float32) - origin) / cell_size).astype(np.int64)
+    return np.clip(coords, 0, np.asarray(dims) - 1)
+
+
+def cells_in_box(grid, box_min, box_max):
+    '''Flat indices of the grid cells overlapping the box'''
+    box_min, box_max = np.asarray(box_min, dtype=np.float32), np.asarray(box_max, dtype=np.float32)
+    if (box_max < grid['origin']).any() or (box_min > grid['origin'] + grid['cell_size'] * grid['dims']).any():
+        return np.empty(0, dtype=np.int64)
+    lo, hi = cell_coords(grid['origin'], grid['cell_size'], grid['dims'], [box_min, box_max])
+    ranges = np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(lo, hi)], indexing='ij')
+    return np.ravel_multi_index([r.ravel() for r in ranges], grid['dims'])
+
+
+def cells_in_frustum(grid, planes):
+    '''Flat indices of the grid cells overlapping the frustum, see query_frustum'''
+    planes = np.asarray(planes, dtype=np.float32).reshape(-1, 4)
+    cells = np.arange(np.prod(grid['dims']))
+    cell_min = grid['origin'] + np.stack(np.unravel_index(cells, grid['dims']), axis=1) * grid['cell_size']
+    cell_max = cell_min + grid['cell_size']
+    visible = np.ones(len(cells), dtype=bool)
+    for normal, d in zip(planes[:, :3], planes[:, 3]):
+        # a grid cell is out when its corner furthest along the plane normal is out
+        furthest = np.where(normal >= 0, cell_max, cell_min)
+        visible &= furthest @ normal + d >= 0
+    return cells[visible]
+
+
+def candidates(grid, cells, sample=None):
+    '''Indices, in the sorted arrays of the grid, of the points of cells
+
+    With sample, at most that many points are taken from each grid cell.
+    '''
+    starts = grid['cell_offsets'][cells].astype(np.int64)
+    ends = grid['cell_offsets'][cells + 1].astype(np.int64)
+    if sample is not None:
+        ends = np.minimum(ends, starts + sample)
+    sizes = ends - starts
+    # concatenated aranges of all the slices
+    shifts = np.repeat(starts - np.concatenate([[0], np.cumsum(sizes)[:-1]]), sizes)
+    return np.arange(sizes.sum()) + shifts
+
+
+def result(grid, indices):
+    '''Ids (sorted) and positions of the points at indices of the grid'''
+    ids = grid['ids'][indices]
+    order = np.argsort(ids, kind='stable')
+    return {
+        'ids': ids[order],
+        'positions': grid['positions'][indices][order],
+    }
+
+
+def query_box(grid, box_min, box_max, sample=None):
+    '''Points inside the axis aligned box [box_min, box_max]'''
+    indices = candidates(grid, cells_in_box(grid, box_min, box_max), sample)
+    positions = grid['positions'][indices]
+    inside = np.all((positions >= box_min) & (positions <= box_max), axis=1)
+    return result(grid, indices[inside])
+
+
+def query_sphere(grid, center, radius, sample=None):
+    '''Points closer than radius to center'''
+    center = np.asarray(center, dtype=np.float32)
+    indices = candidates(grid, cells_in_box(grid, center - radius, center + radius), sample)
+    distances_sq = np.sum((grid['positions'][indices] - center) ** 2, axis=1)
+    return result(grid, indices[distances_sq <= radius * radius])
+
+
+def query_frustum(grid, planes, sample=None):
+    '''Points inside the frustum given as planes (a, b, c, d), inside being a x + b y + c z + d >= 0'''
+    planes = np.asarray(planes, dtype=np.float32).reshape(-1, 4)
+    indices = candidates(grid, cells_in_frustum(grid, planes), sample)
+    positions = grid['positions'][indices]
+    inside = np.all(positions @ planes[:, :3].T + planes[:, 3] >= 0, axis=1)
+    return result(grid, indices[inside])
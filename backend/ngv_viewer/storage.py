@@ -1,154 +1,290 @@
 
 import os
+import time
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 import archngv
-from archngv.spatial import BoundingBox
 
 from .redis_client import RedisClient
+from .cache import (LRUCache, cache_key, circuit_key,
+                    CIRCUIT_CACHE_SIZE, CIRCUIT_DATA_CACHE_BYTES, ENTITY_CACHE_BYTES)
 
-from .morph_simplification import simplify_neuron
+from .artifacts import get_artifacts, load_array, save_array, PREBAKE_ON_DEMAND
+from .cell_table import build_cell_table, table_from_artifacts, table_frame, table_metadata
+from .layers import assign_layers
+from .metrics import cache_requests, circuit_load_seconds
+from .microdomain import pack_mesh, merge_meshes
+from . import adjacency, spatial, vasculature
+from .query import evaluate, normalize, query_key, to_bitset
+from .singleflight import flights, single_flight
+from .morph_simplification import simplify_neuron, simplify_packed, lod_levels, LOD_EPSILONS
+from .morphology import pack_morphology, concat_morphologies, unpack_sections, ASTROCYTE_SEC_TYPE_SHORT_NAMES
 
 L = logging.getLogger(__name__)
 L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
 
-L.debug('creating cache client')
-cache = RedisClient()
-L.debug('cache client has been created')
+L.debug('creating cache clients')
+# whole circuit data (cell tables) and per entity data (morphologies, microdomains)
+# have separate budgets so that browsing morphologies doesn't evict cell tables
+circuit_data_cache = RedisClient('circuit data', max_bytes=CIRCUIT_DATA_CACHE_BYTES)
+cache = RedisClient('entities', max_bytes=ENTITY_CACHE_BYTES)
+L.debug('cache clients have been created')
 
-SEC_SHORT_TYPE_DICT = {
-    'soma': 'soma',
-    'basal_dendrite': 'dend',
-    'apical_dendrite': 'apic',
-    'axon': 'axon'
-}
+# amount of threads loading the morphologies of a single batch, 1 to load them in the calling thread
+MORPH_LOAD_WORKERS = int(os.getenv('MORPH_LOAD_WORKERS', 4))
+morph_load_executor = ThreadPoolExecutor(MORPH_LOAD_WORKERS) if MORPH_LOAD_WORKERS > 1 else None
 
-circuit_cache = {}
+# circuit objects are opaque, so they are bounded by count rather than by size
+circuit_cache = LRUCache('circuits', max_items=CIRCUIT_CACHE_SIZE)
+# opens the circuit of a config, only replaced by the benchmarks, see synthetic.use_synthetic_circuits
+circuit_factory = archngv.NGVCircuit
 
 def get_circuit(circuit_path):
-    # TODO: limit amount of circuits
-    global circuit_cache
-    if circuit_path in circuit_cache:
+    key = circuit_key(circuit_path)
+    circuit = circuit_cache.get(key)
+    if circuit is not None:
         L.debug('Using cached circuit for {}'.format(circuit_path))
-        return circuit_cache[circuit_path]
+        cache_requests.inc(cache='circuits', family='circuit', result='local_hit')
+        return circuit
+    cache_requests.inc(cache='circuits', family='circuit', result='miss')
+
+    # circuit objects can't be shared between processes, so only coalesced in this one
+    return flights.do('circuit:' + key, lambda: open_circuit(key, circuit_path), shared=False)
+
 
-    L.debug('Creating ngv_circuit circuit for {}'.format(circuit_path))
-    circuit = archngv.NGVCircuit(circuit_path)
-    circuit_cache[circuit_path] = circuit
+def open_circuit(key, circuit_path):
+    circuit = circuit_cache.get(key)
+    if circuit is None:
+        L.debug('Creating ngv_circuit circuit for {}'.format(circuit_path))
+        start = time.perf_counter()
+        circuit = circuit_factory(circuit_path)
+        circuit_load_seconds.observe(time.perf_counter() - start)
+        circuit_cache.set(key, circuit, size=0)
     return circuit
 
+CELL_COLUMNS_TO_DROP = [
+    '@dynamics:holding_current', '@dynamics:threshold_current',
+    'etype', 'exc_mini_frequency', 'hypercolumn', 'inh_mini_frequency',
+    'me_combo', 'model_template', 'model_type', 'morph_class',
+    'morphology','mtype','orientation','orientation_w','orientation_x',
+    'orientation_y', 'orientation_z', 'region', 'synapse_class',
+]
+
+SYNAPSE_LOCATION_PROPS = [
+    'efferent_center_x', 'efferent_center_y', 'efferent_center_z',
+]
+
+
+def load_circuit_cells(circuit):
+    neuron_ids = circuit.neurons.ids()
+    return circuit.neurons.get(neuron_ids).drop(columns=CELL_COLUMNS_TO_DROP, errors='ignore')
+
+
+def vasculature_bounding_box(circuit):
+    '''Bounding box of the vasculature segments, read in chunks'''
+    return vasculature.bbox_dict(vasculature.bounding_box(circuit.vasculature))
+
+
+def prebaked_artifacts(circuit_path):
+    '''Artifacts of a circuit, prebaked on first use with PREBAKE_ON_DEMAND'''
+    if PREBAKE_ON_DEMAND:
+        from .prebake import ensure_prebaked
+        return ensure_prebaked(circuit_path)
+    return get_artifacts(circuit_path)
+
+
+def cache_stats():
+    return {
+        'circuits': circuit_cache.stats(),
+        'circuit_data': circuit_data_cache.stats(),
+        'entities': cache.stats(),
+    }
+
+
 class Storage():
+    @single_flight('cell_table')
+    def get_cell_table(self, circuit_path):
+        '''Compact columnar cell table, see cell_table'''
+        artifacts = prebaked_artifacts(circuit_path)
+        if artifacts is not None:
+            return table_from_artifacts(artifacts)
+
+        table = circuit_data_cache.get(cache_key(circuit_path, 'circuit:table'))
+        if table is None:
+            L.debug('building cell table')
+            table = build_cell_table(load_circuit_cells(get_circuit(circuit_path)))
+            circuit_data_cache.set(cache_key(circuit_path, 'circuit:table'), table)
+        return table
+
     def get_circuit_cells(self, circuit_path):
         L.debug('getting cells')
+        return table_frame(self.get_cell_table(circuit_path))
+
+    @single_flight('circuit_metadata', shared=False)
+    def get_circuit_metadata(self, circuit_path):
+        metadata = table_metadata(self.get_cell_table(circuit_path))
+        metadata['bbox'] = self.get_full_vasculature_bounding_box(circuit_path)
+        return metadata
+
+    def get_circuit_cell_positions(self, circuit_path):
+        '''Flat x, y, z array of all the cell positions'''
+        return self.get_cell_table(circuit_path)['positions'].reshape(-1)
+
+    def get_circuit_prop_values(self, circuit_path, prop):
+        return self.get_cell_table(circuit_path)['props'][prop]['values']
+
+    def get_circuit_prop_index(self, circuit_path, prop):
+        '''Index of each cell value of prop in get_circuit_prop_values, -1 for missing values'''
+        return self.get_cell_table(circuit_path)['props'][prop]['codes']
+
+    @single_flight('spatial_index')
+    def get_spatial_index(self, circuit_path, kind):
+        '''Grid spatial index (see spatial.build_grid) of the neurons or the astrocytes'''
+        key = cache_key(circuit_path, 'spatial:{}'.format(kind))
+        grid = circuit_data_cache.get(key)
+        if grid is None:
+            L.debug('building %s spatial index', kind)
+            if kind == 'astrocytes':
+                somas = self.get_astrocytes_somas(circuit_path)
+                grid = spatial.build_grid(somas['positions'], somas['ids'])
+            else:
+                grid = spatial.build_grid(self.get_circuit_cell_positions(circuit_path))
+            circuit_data_cache.set(key, grid)
+        return grid
+
+    def query_region(self, circuit_path, kind, region, sample=None):
+        '''Ids and positions of the neurons or astrocytes in a region
+
+        region is one of {'box': {'min', 'max'}}, {'sphere': {'center', 'radius'}}
+        or {'frustum': planes}, see the spatial module.
+        With sample, at most that many cells are taken from each grid cell.
+        '''
+        grid = self.get_spatial_index(circuit_path, kind)
+        if 'box' in region:
+            return spatial.query_box(grid, region['box']['min'], region['box']['max'], sample)
+        if 'sphere' in region:
+            return spatial.query_sphere(grid, region['sphere']['center'], region['sphere']['radius'], sample)
+        if 'frustum' in region:
+            return spatial.query_frustum(grid, region['frustum'], sample)
+        raise ValueError('unknown region {}'.format(list(region)))
+
+    def query_cells(self, circuit_path, query):
+        '''Neurons matching a selection query, see the query module
+
+        Returns dict:
+            count: amount of matching neurons
+            total: amount of neurons
+            bitset: uint8 (ceil(total / 8),) packed mask, see query.to_bitset
+        '''
+        key = cache_key(circuit_path, 'query', query_key(query))
+        selection = cache.get(key)
+        if selection is not None:
+            return selection
+
+        table = self.get_cell_table(circuit_path)
+        mask = evaluate(normalize(query), table, self, circuit_path)
+        selection = {'count': int(mask.sum()), 'total': table['count'], 'bitset': to_bitset(mask)}
+        cache.set(key, selection)
+        return selection
+
+    def get_packed_morphologies(self, circuit_path, gids, lod=None):
+        '''List of packed morphologies (see morphology.pack_morphology) of gids
+
+        With lod, morphologies are simplified to that level of detail, see morph_simplification.
+        '''
+        key_family = 'cell:morph' if lod is None else 'cell:morph:lod{}'.format(lod)
+        keys = [cache_key(circuit_path, key_family, gid) for gid in gids]
+        # one round trip to the shared cache for the whole batch
+        packed_morphs = cache.get_many(keys)
+        missing = [gid for gid, packed in zip(gids, packed_morphs) if packed is None]
+        if not missing:
+            L.debug('using cached morphologies')
+            return packed_morphs
+
+        if lod is None:
+            circuit = get_circuit(circuit_path)
+            def load(gid):
+                return pack_morphology(circuit.neurons.morph.get(gid, transform=True, extension='asc'))
+
+            L.debug('loading %s morphologies', len(missing))
+            map_fn = map if morph_load_executor is None else morph_load_executor.map
+            loaded = dict(zip(missing, map_fn(load, missing)))
+        else:
+            full_morphs = self.get_packed_morphologies(circuit_path, missing)
+            loaded = {
+                gid: simplify_packed(packed, LOD_EPSILONS[lod])
+                for gid, packed in zip(missing, full_morphs)
+            }
+        cache.set_many({key: loaded[gid] for gid, key in zip(gids, keys) if gid in loaded})
+        return [loaded[gid] if packed is None else packed for gid, packed in zip(gids, packed_morphs)]
+
+    def get_cell_orientations(self, circuit_path, gids):
+        '''float32 (N, 3, 3) rotation matrices of gids, fetched in one query'''
+        if not len(gids):
+            return np.empty((0, 3, 3), dtype=np.float32)
         circuit = get_circuit(circuit_path)
-        cells = cache.get('circuit:cells')
-        if cells is None:
-            neuron_ids = circuit.neurons.ids()
-            columns_to_drop = [
-                '@dynamics:holding_current', '@dynamics:threshold_current',
-                'etype', 'exc_mini_frequency', 'hypercolumn', 'inh_mini_frequency',
-                'me_combo', 'model_template', 'model_type', 'morph_class',
-                'morphology','mtype','orientation','orientation_w','orientation_x',
-                'orientation_y', 'orientation_z', 'region', 'synapse_class',
-            ]
-            cells = circuit.neurons.get(neuron_ids).drop(columns=columns_to_drop, axis=1, errors='ignore')
-            cache.set('circuit:cells', cells)
-        L.debug('getting cells done')
-        return cells
+        orientations = circuit.neurons.orientations(group=list(gids))
+        return np.stack(list(orientations.loc[list(gids)])).astype(np.float32)
 
     def get_cell_morphology(self, circuit_path, gids):
         L.debug('getting cell morph for %s', gids)
-        circuit = get_circuit(circuit_path)
-        cells = {}
-        for gid in gids:
-            cell_morph = cache.get('cell:morph:{}'.format(gid))
-            if cell_morph is None:
-                cell = circuit.neurons.morph.get(gid, transform=True, extension='asc')
-                morphology = [
-                    {
-                        'points': [p + [d] for (p, d) in zip(
-                            section.points.tolist(), section.diameters.tolist(),
-                        )],
-                        'id': section.id,
-                        'type': SEC_SHORT_TYPE_DICT[section.type.name]
-                    }
-                    for section in cell.sections
-                ]
-
-                # add soma
-                morphology.append({
-                    'points': cell.soma.points,
-                    'id': 'soma',
-                    'type': SEC_SHORT_TYPE_DICT['soma']
-                })
-
-                cache.set('cell:morph:{}'.format(gid), morphology)
-            else:
-                L.debug('using cached morphology')
-                morphology = cell_morph
-
-            orientation = circuit.neurons.orientations(group=gid)
-            cells[gid] = {
-                'sections': morphology,
-                'orientation': orientation
+        packed_morphs = self.get_packed_morphologies(circuit_path, gids)
+        orientations = self.get_cell_orientations(circuit_path, gids)
+        cells = {
+            gid: {
+                'sections': unpack_sections(packed),
+                'orientation': orientation,
             }
+            for gid, packed, orientation in zip(gids, packed_morphs, orientations)
+        }
         L.debug('getting cell morph for %s done', gids)
         return {'cells': cells}
 
-    def get_astrocytes_layers(self, circuit):
+    def get_cell_morphologies(self, circuit_path, gids, lod=None):
+        '''Morphologies of gids packed in a single batch, see morphology.concat_morphologies'''
+        L.debug('getting packed cell morph for %s', gids)
+        batch = concat_morphologies(self.get_packed_morphologies(circuit_path, gids, lod))
+        batch['gids'] = np.asarray(gids, dtype=np.uint32)
+        batch['orientations'] = self.get_cell_orientations(circuit_path, gids)
+        return batch
+
+    @single_flight('astrocytes_layers')
+    def get_astrocytes_layers(self, circuit_path):
+        '''Layer of each astrocyte, computed once per circuit and persisted as an artifact'''
         L.debug('getting astrocytes layers')
-        def bounding_box(points):
-            x_coordinates, y_coordinates, z_coordinates = zip(*points)
-            return {
-                'max_point': [ max(x_coordinates), max(y_coordinates), max(z_coordinates) ],
-                'min_point': [ min(x_coordinates), min(y_coordinates), min(z_coordinates) ],
-            }
-        # taken from https://bbpcode.epfl.ch/browse/code/molecularsystems/ArchNGV/tree/archngv/spatial/bounding_box.py?h=refs/heads/master#n114
-        def points_in_rectangle(points, min_point, max_point):
-            """
-            Args:
-                points: array[float, (N, M)]
-                min_point: array[float, (M,)]
-                max_point: array[float, (M, )]
-
-            Returns: array[bool, (N,)]
-            """
-            greater_or_equal = (min_point < points) | np.isclose(min_point, points)
-            smaller_or_equal = (points < max_point) | np.isclose(max_point, points)
-            return np.all(np.logical_and(smaller_or_equal, greater_or_equal), axis=1)
-
-        def points_inside(points, bbox_dict):
-            """ Returns a boolean mask of the points included in the
-            bounding box
-            """
-            return points_in_rectangle(np.array(points), bbox_dict['min_point'], bbox_dict['max_point'])
-
-        all_neurons = circuit.neurons.get()
-        layers = all_neurons['layer'].unique()
-
-        all_astrocyte_positions_array = circuit.astrocytes.positions().values
-        masks_array = []
-        new_value_names = []
-
-        for layer in layers:
-            neurons_in_layer = all_neurons[all_neurons['layer'] == layer]
-            positions_in_layer = circuit.neurons.positions(neurons_in_layer.index)
-            bbox = bounding_box(positions_in_layer.to_numpy())
-            astrocytes_inside_layer = points_inside(all_astrocyte_positions_array, bbox)
-            masks_array.append(astrocytes_inside_layer)
-            new_value_names.append(layer)
-
-        layers_column = np.select(masks_array, new_value_names, default=np.nan)
-        return layers_column
+        key = cache_key(circuit_path, 'astrocyte:layers')
+        layers = circuit_data_cache.get(key)
+        if layers is not None:
+            return layers
+
+        layers = load_array(circuit_path, 'astrocyte_layers')
+        if layers is None:
+            L.debug('computing astrocytes layers')
+            circuit = get_circuit(circuit_path)
+            cells = self.get_circuit_cells(circuit_path)
+            layers = assign_layers(cells[['x', 'y', 'z']].to_numpy(), cells['layer'].to_numpy(),
+                                   circuit.astrocytes.positions().values)
+            save_array(circuit_path, 'astrocyte_layers', layers)
+        circuit_data_cache.set(key, layers)
+        return layers
 
+    @single_flight('astrocytes_somas', shared=False)
     def get_astrocytes_somas(self, circuit_path):
         L.debug('getting astrocytes %s', circuit_path)
+        artifacts = prebaked_artifacts(circuit_path)
+        if artifacts is not None:
+            return { 'positions': artifacts.array('astrocyte_positions'),
+                     'ids': artifacts.array('astrocyte_ids'),
+                     'layers': artifacts.array('astrocyte_layers') }
         circuit = get_circuit(circuit_path)
         positions = circuit.astrocytes.positions()
         ids = circuit.astrocytes.ids()
         soma_positions = positions.values
-        layers = self.get_astrocytes_layers(circuit)
+        layers = self.get_astrocytes_layers(circuit_path)
         return { 'positions': soma_positions,
                  'ids': ids,
                  'layers': layers }
@@ -159,18 +295,52 @@ class Storage():
         astro = circuit.astrocytes.get(astrocyte_id)
         return {'morphology': astro.morphology}
 
+    @single_flight('efferent_neurons', shared=False)
     def get_efferent_neurons(self, circuit_path, astrocyte_id):
         L.debug('getting efferent neurons for astrocyte %s', astrocyte_id)
+        loaded = self.loaded_neuroglial_adjacency(circuit_path)
+        if loaded is not None:
+            return adjacency.neighbours(loaded, 'astrocytes', [astrocyte_id])[1]
         circuit = get_circuit(circuit_path)
         ng_conn = circuit.neuroglial_connectome
         eff_neurons_ids = ng_conn.efferent_nodes(astrocyte_id, unique=True)
         L.debug('connected neurons %s', len(eff_neurons_ids))
         return eff_neurons_ids
 
+    def loaded_neuroglial_adjacency(self, circuit_path):
+        '''Neuroglial adjacency when prebaked or already built, None otherwise'''
+        artifacts = prebaked_artifacts(circuit_path)
+        if artifacts is not None and artifacts.has('adjacency_astrocyte_offsets'):
+            return {name: artifacts.array('adjacency_' + name) for name in adjacency.ADJACENCY_ARRAYS}
+        return circuit_data_cache.get(cache_key(circuit_path, 'neuroglial:adjacency'))
+
+    @single_flight('neuroglial_adjacency')
+    def get_neuroglial_adjacency(self, circuit_path):
+        '''Astrocyte to neurons and neuron to astrocytes CSR adjacency, see adjacency.build_adjacency'''
+        loaded = self.loaded_neuroglial_adjacency(circuit_path)
+        if loaded is not None:
+            return loaded
+        L.debug('building neuroglial adjacency')
+        built = adjacency.build_adjacency(get_circuit(circuit_path).neuroglial_connectome)
+        circuit_data_cache.set(cache_key(circuit_path, 'neuroglial:adjacency'), built)
+        return built
+
+    def query_neuroglial(self, circuit_path, direction, ids, op):
+        '''Neighbours of many astrocytes or neurons, see adjacency.set_operation'''
+        return adjacency.set_operation(self.get_neuroglial_adjacency(circuit_path), direction, ids, op)
+
+    @single_flight('astrocyte_morph')
     def get_astrocyte_morph(self, circuit_path, astrocyte_id):
         L.debug('getting morphology for astrocyte  %s', astrocyte_id)
-        morph_dict = cache.get('astrocyte:morph:{}'.format(astrocyte_id))
-        if morph_dict is None:
+        morph_dict = cache.get(cache_key(circuit_path, 'astrocyte:morph', astrocyte_id))
+        if morph_dict is not None:
+            L.debug('using cached morphology')
+            return morph_dict
+
+        artifacts = prebaked_artifacts(circuit_path)
+        if artifacts is not None and artifacts.has('astrocyte_morph_points'):
+            morph_dict = self.get_prebaked_astrocyte_morph(artifacts, astrocyte_id)
+        else:
             circuit = get_circuit(circuit_path)
             astrocyte_morph = circuit.astrocytes.morph.get(astrocyte_id, extension="h5")
             simplified_morph = simplify_neuron(astrocyte_morph, epsilon=0.5)
@@ -179,58 +349,195 @@ class Storage():
                 'orientation': circuit.astrocytes.orientations(group=astrocyte_id),
                 'position': circuit.astrocytes.positions(group=astrocyte_id).to_list(),
             }
-            cache.set('astrocyte:morph:{}'.format(astrocyte_id), morph_dict)
-        else:
-            L.debug('using cached morphology')
+        cache.set(cache_key(circuit_path, 'astrocyte:morph', astrocyte_id), morph_dict)
         return morph_dict
 
+    @single_flight('astrocyte_morph_lods')
+    def get_astrocyte_morph_lods(self, circuit_path, astrocyte_id):
+        '''Packed morphology of each level of detail of an astrocyte, all computed at once'''
+        key = cache_key(circuit_path, 'astrocyte:morph:lod', astrocyte_id)
+        levels = cache.get(key)
+        if levels is None:
+            circuit = get_circuit(circuit_path)
+            astrocyte_morph = circuit.astrocytes.morph.get(astrocyte_id, extension='h5')
+            levels = lod_levels(pack_morphology(astrocyte_morph))
+            cache.set(key, levels)
+        return levels
+
+    def get_astrocyte_morph_lod(self, circuit_path, astrocyte_id, lod):
+        L.debug('getting morphology lod %s for astrocyte %s', lod, astrocyte_id)
+        packed = self.get_astrocyte_morph_lods(circuit_path, astrocyte_id)[lod]
+        circuit = get_circuit(circuit_path)
+        return dict(
+            packed,
+            orientation=np.asarray(circuit.astrocytes.orientations(group=astrocyte_id), dtype=np.float32),
+            position=np.asarray(circuit.astrocytes.positions(group=astrocyte_id), dtype=np.float32),
+        )
+
+    def get_prebaked_astrocyte_morph(self, artifacts, astrocyte_id):
+        astrocyte_ids = artifacts.array('astrocyte_ids')
+        idx = int(np.searchsorted(astrocyte_ids, astrocyte_id))
+        if idx == len(astrocyte_ids) or astrocyte_ids[idx] != astrocyte_id:
+            raise ValueError('unknown astrocyte {}'.format(astrocyte_id))
+        cell_offsets = artifacts.array('astrocyte_morph_cell_offsets')
+        first_section, last_section = cell_offsets[idx], cell_offsets[idx + 1]
+        section_offsets = artifacts.array('astrocyte_morph_section_offsets')[first_section : last_section + 1]
+        packed = {
+            'points': artifacts.array('astrocyte_morph_points')[section_offsets[0] : section_offsets[-1]],
+            'section_offsets': section_offsets - section_offsets[0],
+            'section_types': artifacts.array('astrocyte_morph_section_types')[first_section : last_section],
+        }
+        return {
+            'sections': unpack_sections(packed, ASTROCYTE_SEC_TYPE_SHORT_NAMES, as_lists=False),
+            'orientation': np.array(artifacts.array('astrocyte_orientations')[idx]),
+            'position': artifacts.array('astrocyte_positions')[idx].tolist(),
+        }
+
+    def load_microdomain(self, circuit_path, astrocyte_id):
+        '''(points, triangles) arrays of the microdomain of an astrocyte'''
+        microdomains = get_circuit(circuit_path).astrocytes.microdomains
+        return microdomains.domain_points(astrocyte_id), microdomains.domain_triangles(astrocyte_id)
+
+    @single_flight('astrocyte_microdomain')
     def get_astrocyte_microdomain(self, circuit_path, astrocyte_id):
         L.debug('getting microdomain for astrocyte  %s', astrocyte_id)
-        microdomain_dict = cache.get('astrocyte:microdomain:{}'.format(astrocyte_id))
+        microdomain_dict = cache.get(cache_key(circuit_path, 'astrocyte:microdomain', astrocyte_id))
         if microdomain_dict is None:
-            circuit = get_circuit(circuit_path)
-            microdomains = circuit.astrocytes.microdomains
-            indexes = microdomains.domain_triangles(astrocyte_id)
-            points = microdomains.domain_points(astrocyte_id)
+            points, indexes = self.load_microdomain(circuit_path, astrocyte_id)
             microdomain_dict = {
                 'indexes': indexes.tolist(),
                 'vertices': points.tolist(),
             }
 
-            cache.set('astrocyte:microdomain:{}'.format(astrocyte_id), microdomain_dict)
+            cache.set(cache_key(circuit_path, 'astrocyte:microdomain', astrocyte_id), microdomain_dict)
         else:
             L.debug('using cached microdomain')
         return microdomain_dict
 
-    def get_astrocyte_synapses(self, circuit_path, astrocyte_id, efferent_neuron_id):
-        L.debug('getting synapses for astrocyte %s', astrocyte_id)
+    def get_astrocyte_microdomain_mesh(self, circuit_path, astrocyte_id):
+        '''Packed microdomain mesh of an astrocyte, see microdomain.pack_mesh'''
+        return self.get_astrocyte_microdomain_meshes(circuit_path, [astrocyte_id])[0]
+
+    def get_astrocyte_microdomain_meshes(self, circuit_path, astrocyte_ids):
+        '''List of packed microdomain meshes of astrocyte_ids'''
+        keys = [cache_key(circuit_path, 'astrocyte:microdomain:mesh', astrocyte_id) for astrocyte_id in astrocyte_ids]
+        meshes = cache.get_many(keys)
+        missing = [astrocyte_id for astrocyte_id, mesh in zip(astrocyte_ids, meshes) if mesh is None]
+        if not missing:
+            L.debug('using cached microdomain meshes')
+            return meshes
+
+        L.debug('loading %s microdomain meshes', len(missing))
+        loaded = {
+            astrocyte_id: pack_mesh(*self.load_microdomain(circuit_path, astrocyte_id))
+            for astrocyte_id in missing
+        }
+        cache.set_many({key: loaded[astrocyte_id] for astrocyte_id, key in zip(astrocyte_ids, keys)
+                        if astrocyte_id in loaded})
+        return [loaded[astrocyte_id] if mesh is None else mesh for astrocyte_id, mesh in zip(astrocyte_ids, meshes)]
+
+    @single_flight('merged_microdomain_mesh')
+    def get_merged_microdomain_mesh(self, circuit_path, astrocyte_ids):
+        '''Packed mesh of the microdomains of astrocyte_ids, see microdomain.merge_meshes
+
+        astrocytes: uint32 sorted ids, in the order of triangle_offsets.
+        '''
+        astrocyte_ids = sorted(set(int(astrocyte_id) for astrocyte_id in astrocyte_ids))
+        digest = hashlib.sha1(','.join(map(str, astrocyte_ids)).encode()).hexdigest()
+        key = cache_key(circuit_path, 'astrocyte:microdomain:merged', digest)
+        mesh = cache.get(key)
+        if mesh is None:
+            L.debug('merging %s microdomains', len(astrocyte_ids))
+            mesh = merge_meshes([self.load_microdomain(circuit_path, astrocyte_id) for astrocyte_id in astrocyte_ids])
+            mesh['astrocytes'] = np.array(astrocyte_ids, dtype=np.uint32)
+            cache.set(key, mesh)
+        else:
+            L.debug('using cached merged microdomain mesh')
+        return mesh
+
+    @single_flight('astrocyte_synapse_index')
+    def get_astrocyte_synapse_index(self, circuit_path, astrocyte_id):
+        '''Synapses of an astrocyte grouped by efferent neuron, loaded once and cached
+
+        Returns dict:
+            target_nodes: uint32 (T,) sorted efferent neuron ids
+            target_offsets: uint32 (T + 1,) first synapse of each efferent neuron
+            ids: uint32 (N,) synapse ids
+            locations: float32 (N, 3) synapse locations
+        '''
+        key = cache_key(circuit_path, 'astrocyte:synapses', astrocyte_id)
+        index = cache.get(key)
+        if index is not None:
+            return index
+
+        L.debug('building synapse index for astrocyte %s', astrocyte_id)
         circuit = get_circuit(circuit_path)
-        location_props = [
-            'efferent_center_x', 'efferent_center_y', 'efferent_center_z',
-        ]
-        target_props = [
-            '@target_node',
-        ]
-        efferent_neurons = self.get_efferent_neurons(circuit_path, astrocyte_id)
         ng_conn = circuit.neuroglial_connectome
-        synapses_info = ng_conn.astrocyte_synapses_properties(astrocyte_id, location_props + target_props)
-        synapse_ids_of_one_eff_neuron = synapses_info[synapses_info['@target_node'] == efferent_neuron_id]
-        ids = synapse_ids_of_one_eff_neuron.index.to_numpy()
-        synapse_locations = synapse_ids_of_one_eff_neuron[location_props].to_numpy()
-        L.debug('connected synapses %s', len(synapse_locations))
-        return { 'locations': synapse_locations,
-                 'ids': ids }
+        synapses_info = ng_conn.astrocyte_synapses_properties(astrocyte_id, SYNAPSE_LOCATION_PROPS + ['@target_node'])
+        targets = synapses_info['@target_node'].to_numpy()
+        # stable, synapses of a neuron keep their order
+        order = np.argsort(targets, kind='stable')
+        target_nodes, first = np.unique(targets[order], return_index=True)
+        index = {
+            'target_nodes': target_nodes.astype(np.uint32),
+            'target_offsets': np.append(first, len(order)).astype(np.uint32),
+            'ids': synapses_info.index.to_numpy()[order].astype(np.uint32),
+            'locations': synapses_info[SYNAPSE_LOCATION_PROPS].to_numpy(dtype=np.float32)[order],
+        }
+        cache.set(key, index)
+        return index
 
+    def get_astrocyte_synapses(self, circuit_path, astrocyte_id, efferent_neuron_id):
+        L.debug('getting synapses for astrocyte %s', astrocyte_id)
+        index = self.get_astrocyte_synapse_index(circuit_path, astrocyte_id)
+        idx = int(np.searchsorted(index['target_nodes'], efferent_neuron_id))
+        if idx < len(index['target_nodes']) and index['target_nodes'][idx] == efferent_neuron_id:
+            start, end = index['target_offsets'][idx], index['target_offsets'][idx + 1]
+        else:
+            start = end = 0
+        L.debug('connected synapses %s', end - start)
+        return { 'locations': index['locations'][start:end],
+                 'ids': index['ids'][start:end] }
+
+    @single_flight('vasculature_bbox', shared=False)
     def get_full_vasculature_bounding_box(self, circuit_path):
         L.debug('getting full vasculature bounding box')
-        circuit = get_circuit(circuit_path)
-        vasculature_points = circuit.vasculature.morph.points
-        bbox = BoundingBox.from_points(vasculature_points)
-        max_list = bbox.max_point.tolist()
-        min_list = bbox.min_point.tolist()
-
-        bbox_dict = {
-            'max': { 'x': max_list[0], 'y': max_list[1], 'z': max_list[2] },
-            'min': { 'x': min_list[0], 'y': min_list[1], 'z': min_list[2] },
-        }
-        return bbox_dict
+        artifacts = prebaked_artifacts(circuit_path)
+        if artifacts is not None:
+            return artifacts.manifest['vasculature_bbox']
+
+        key = cache_key(circuit_path, 'vasculature:bbox')
+        bbox = circuit_data_cache.get(key)
+        if bbox is None:
+            bbox = vasculature_bounding_box(get_circuit(circuit_path))
+            circuit_data_cache.set(key, bbox)
+        return bbox
+
+    @single_flight('vasculature_tiles')
+    def get_vasculature_tiles(self, circuit_path):
+        '''Spatial tiles of the vasculature segments, see vasculature.build_tiles'''
+        artifacts = prebaked_artifacts(circuit_path)
+        if artifacts is not None and artifacts.has('vasculature_segments'):
+            return {name: artifacts.array('vasculature_' + name) for name in vasculature.TILE_ARRAYS}
+
+        key = cache_key(circuit_path, 'vasculature:tiles')
+        tiles = circuit_data_cache.get(key)
+        if tiles is None:
+            L.debug('building vasculature tiles')
+            bbox = self.get_full_vasculature_bounding_box(circuit_path)
+            tiles = vasculature.build_tiles(get_circuit(circuit_path).vasculature,
+                                            [[bbox[corner][axis] for axis in 'xyz'] for corner in ['min', 'max']])
+            circuit_data_cache.set(key, tiles)
+        return tiles
+
+    def get_vasculature_tile_index(self, circuit_path):
+        index = vasculature.tile_index(self.get_vasculature_tiles(circuit_path))
+        index['bbox'] = self.get_full_vasculature_bounding_box(circuit_path)
+        return index
+
+    def query_vasculature_tiles(self, circuit_path, region):
+        '''Ids of the non empty vasculature tiles overlapping a region, see vasculature.tiles_in_region'''
+        return vasculature.tiles_in_region(self.get_vasculature_tiles(circuit_path), region)
+
+    def get_vasculature_tile(self, circuit_path, tile, lod=None):
+        return vasculature.get_tile(self.get_vasculature_tiles(circuit_path), tile, lod)
@@ -0,0 +1,91 @@
+
+'''Chunked streaming of large arrays over a websocket connection
+
+Arrays are split in chunks of about STREAM_CHUNK_BYTES, each chunk is written
+only once the previous one has been flushed to the socket, so that a slow
+client doesn't make the server buffer the whole array. Streams run as tasks
+keyed by the scheduler id of their request, to be cancelled with it, by the
+cmdid of the client or when the connection closes.
+'''
+
+import os
+import json
+import asyncio
+import logging
+from functools import partial
+
+import numpy as np
+
+from .metrics import current_trace
+from .scheduler import current_request
+from .utils import NumpyAwareJSONEncoder, BINARY_DTYPES
+
+L = logging.getLogger(__name__)
+L.setLevel(logging.DEBUG if os.getenv('DEBUG', False) else logging.INFO)
+
+STREAM_CHUNK_BYTES = int(os.getenv('STREAM_CHUNK_BYTES', 256 * 1024))
+# amount of leading items the JSON size of an item is estimated from
+JSON_SAMPLE_SIZE = 64
+
+
+def item_bytes(values, dtype=None):
+    '''Size of an item of values on the wire, binary as dtype or JSON without dtype'''
+    if dtype is not None:
+        return BINARY_DTYPES[dtype].itemsize * int(np.prod(np.shape(values)[1:]))
+    sample = values[:JSON_SAMPLE_SIZE]
+    if not len(sample):
+        return 1
+    return len(json.dumps(sample, cls=NumpyAwareJSONEncoder)) / len(sample)
+
+
+def iter_chunks(values, dtype=None, start=0, chunk_bytes=STREAM_CHUNK_BYTES):
+    '''(offset, chunk) of values from start, chunks of at least one item'''
+    chunk_size = max(int(chunk_bytes / max(item_bytes(values, dtype), 1)), 1)
+    for offset in range(start, len(values), chunk_size):
+        yield offset, values[offset : offset + chunk_size]
+
+
+class Streams():
+    '''Running streams of a connection, by request id, see scheduler.current_request'''
+    def __init__(self):
+        self.tasks = {}
+
+    def start(self, cmdid, coro):
+        request = current_request.get()
+        # a new request with the same cmdid supersedes the running one
+        self.cancel_cmdid(cmdid)
+        self.cancel(request)
+        task = asyncio.ensure_future(coro)
+        task.cmdid = cmdid
+        self.tasks[request] = task
+        task.add_done_callback(partial(self.done, request))
+        # the request is only complete once its stream is
+        trace = current_trace.get()
+        if trace is not None:
+            trace.hold()
+            task.add_done_callback(lambda _: trace.release())
+        return task
+
+    def done(self, request, task):
+        if self.tasks.get(request) is task:
+            del self.tasks[request]
+        if not task.cancelled() and task.exception() is not None:
+            L.error('stream %s failed', task.cmdid, exc_info=task.exception())
+
+    def cancel(self, request):
+        task = self.tasks.pop(request, None)
+        if task is not None:
+            L.debug('cancelling stream %s', task.cmdid)
+            task.cancel()
+
+    def cancel_cmdid(self, cmdid):
+        '''Cancel the streams of a cmdid, none for requests without one'''
+        if cmdid is None:
+            return
+        for request, task in list(self.tasks.items()):
+            if task.cmdid == cmdid:
+                self.cancel(request)
+
+    def cancel_all(self):
+        for request in list(self.tasks):
+            self.cancel(request)
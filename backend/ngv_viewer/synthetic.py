@@ -0,0 +1,294 @@
+
+'''Synthetic NGV circuits, to run the viewer and its benchmarks off-cluster
+
+A synthetic circuit config is a JSON file with a "synthetic" section holding
+the generator parameters, see write_config. Once use_synthetic_circuits has been
+called, get_circuit opens configs as SyntheticCircuit, which implements the part
+of the archngv.NGVCircuit API used by the storage, with deterministic random
+data. The server only does so when started by
+
+    python -m ngv_viewer.synthetic
+
+which the load test uses, the server of ngv_viewer.main only opens archngv circuits.
+'''
+
+import sys
+import json
+
+import numpy as np
+import pandas as pd
+
+DEFAULTS = {
+    'neurons': 10000,
+    'astrocytes': 1000,
+    'synapses_per_astrocyte': 2000,
+    'efferent_neurons_per_astrocyte': 200,
+    'sections': 50,
+    'points_per_section': 20,
+    'vasculature_points': 100000,
+    'seed': 0,
+}
+
+LAYERS = ['1', '2', '3', '4', '5', '6']
+MTYPES = ['L1_DAC', 'L23_PC', 'L4_SS', 'L5_TPC', 'L6_IPC']
+# um, extent of the circuit, layers are slabs along y
+SIZE = np.array([1000., 2000., 1000.])
+# points of a synthetic vessel, a random walk of VESSEL_STEP um steps
+VESSEL_POINTS = 50
+VESSEL_STEP = 5.
+
+
+def write_config(path, **params):
+    '''Write a synthetic circuit config, params override DEFAULTS'''
+    unknown = set(params) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('unknown synthetic circuit parameters {}'.format(sorted(unknown)))
+    with open(path, 'w') as config_file:
+        json.dump({'synthetic': dict(DEFAULTS, **params)}, config_file)
+    return path
+
+
+def synthetic_params(circuit_path):
+    '''Generator parameters of a synthetic circuit config, None for other circuits'''
+    try:
+        with open(circuit_path) as config_file:
+            config = json.load(config_file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(config, dict) or 'synthetic' not in config:
+        return None
+    return dict(DEFAULTS, **config['synthetic'])
+
+
+def open_circuit(circuit_path):
+    params = synthetic_params(circuit_path)
+    if params is None:
+        raise ValueError('{} is not a synthetic circuit config'.format(circuit_path))
+    return SyntheticCircuit(params)
+
+
+def use_synthetic_circuits():
+    '''Open the circuits of this process as synthetic circuits, see storage.get_circuit'''
+    from . import storage
+    storage.circuit_factory = open_circuit
+
+
+def random_rotations(rng, count):
+    '''(count, 3, 3) rotations around the y axis'''
+    angles = rng.uniform(0, 2 * np.pi, count)
+    cos, sin = np.cos(angles), np.sin(angles)
+    rotations = np.zeros((count, 3, 3))
+    rotations[:, 0, 0] = cos
+    rotations[:, 0, 2] = sin
+    rotations[:, 1, 1] = 1
+    rotations[:, 2, 0] = -sin
+    rotations[:, 2, 2] = cos
+    return rotations
+
+
+class Soma():
+    def __init__(self, points, diameters):
+        self.points = points
+        self.diameters = diameters
+
+
+class Morphology():
+    '''Random binary tree with the morphio immutable Morphology attributes used by pack_morphology'''
+    def __init__(self, seed, sections, points_per_section, section_type=3):
+        rng = np.random.default_rng(seed)
+        parents = np.concatenate([[-1], (np.arange(1, sections) - 1) // 2])
+        section_points = []
+        for parent in parents:
+            start = np.zeros(3) if parent < 0 else section_points[parent][-1]
+            steps = rng.normal(0, 1, (points_per_section - 1, 3)) + rng.normal(0, 2, 3)
+            section_points.append(np.vstack([start, start + np.cumsum(steps, axis=0)]))
+
+        self.points = np.concatenate(section_points).astype(np.float32)
+        self.diameters = np.full(len(self.points), 1, dtype=np.float32)
+        self.section_offsets = np.arange(sections + 1) * points_per_section
+        self.section_types = np.full(sections, section_type)
+        self.connectivity = {}
+        for child, parent in enumerate(parents):
+            if parent >= 0:
+                self.connectivity.setdefault(int(parent), []).append(child)
+        angles = np.linspace(0, 2 * np.pi, 8, endpoint=False)
+        self.soma = Soma(np.column_stack([np.cos(angles), np.sin(angles), np.zeros(8)]) * 5,
+                         np.full(8, 1, dtype=np.float32))
+
+
+class MorphologyLoader():
+    def __init__(self, params, seed_offset, section_type):
+        self.params = params
+        self.seed_offset = seed_offset
+        self.section_type = section_type
+
+    def get(self, gid, transform=False, extension=None):
+        return Morphology(self.params['seed'] + self.seed_offset + int(gid),
+                          self.params['sections'], self.params['points_per_section'], self.section_type)
+
+
+class Neurons():
+    def __init__(self, params):
+        rng = np.random.default_rng(params['seed'])
+        count = params['neurons']
+        self.positions = rng.uniform(0, 1, (count, 3)) * SIZE
+        layer_codes = np.minimum((self.positions[:, 1] / SIZE[1] * len(LAYERS)).astype(int), len(LAYERS) - 1)
+        self.frame = pd.DataFrame({
+            'x': self.positions[:, 0],
+            'y': self.positions[:, 1],
+            'z': self.positions[:, 2],
+            'layer': np.array(LAYERS)[layer_codes],
+            'mtype': np.array(MTYPES)[rng.integers(0, len(MTYPES), count)],
+            'synapse_class': np.where(rng.uniform(size=count) < 0.8, 'EXC', 'INH'),
+        })
+        self.rotations = random_rotations(rng, count)
+        self.morph = MorphologyLoader(params, 0, section_type=3)
+
+    def ids(self):
+        return np.arange(len(self.frame))
+
+    def get(self, ids):
+        return self.frame.iloc[ids]
+
+    def orientations(self, group):
+        group = np.atleast_1d(group)
+        return pd.Series(list(self.rotations[group]), index=group)
+
+
+class Microdomains():
+    '''Spheres around the astrocyte somas'''
+    def __init__(self, positions, resolution=8):
+        self.positions = positions
+        theta, phi = np.meshgrid(np.linspace(0, np.pi, resolution + 1),
+                                 np.linspace(0, 2 * np.pi, 2 * resolution, endpoint=False), indexing='ij')
+        self.unit_points = np.column_stack([
+            (np.sin(theta) * np.cos(phi)).ravel(),
+            (np.sin(theta) * np.sin(phi)).ravel(),
+            np.cos(theta).ravel(),
+        ])
+        rows, columns = theta.shape
+        triangles = []
+        for row in range(rows - 1):
+            for column in range(columns):
+                a = row * columns + column
+                b = row * columns + (column + 1) % columns
+                triangles.append([a, b + columns, a + columns])
+                triangles.append([a, b, b + columns])
+        self.triangles = np.array(triangles)
+
+    def domain_points(self, astrocyte_id):
+        return self.positions[astrocyte_id] + self.unit_points * 25
+
+    def domain_triangles(self, astrocyte_id):
+        return self.triangles
+
+
+class Astrocytes():
+    def __init__(self, params):
+        rng = np.random.default_rng(params['seed'] + 1)
+        count = params['astrocytes']
+        self.frame = pd.DataFrame(rng.uniform(0, 1, (count, 3)) * SIZE, columns=['x', 'y', 'z'])
+        self.rotations = random_rotations(rng, count)
+        self.morph = MorphologyLoader(params, 10 ** 7, section_type=3)
+        self.microdomains = Microdomains(self.frame.to_numpy())
+
+    def ids(self):
+        return np.arange(len(self.frame))
+
+    def positions(self, group=None):
+        if group is None:
+            return self.frame
+        return self.frame.iloc[group]
+
+    def orientations(self, group=None):
+        if np.isscalar(group):
+            return self.rotations[group]
+        group = self.ids() if group is None else np.asarray(group)
+        return pd.Series(list(self.rotations[group]), index=group)
+
+    def get(self, astrocyte_id):
+        return pd.Series({'morphology': 'astrocyte_{}'.format(astrocyte_id)})
+
+
+class NeuroglialConnectome():
+    '''Synapses of astrocyte i have ids [i * synapses_per_astrocyte, (i + 1) * synapses_per_astrocyte)'''
+    def __init__(self, params):
+        self.params = params
+        self.size = params['astrocytes'] * params['synapses_per_astrocyte']
+
+    def get(self, edge_ids, properties):
+        edge_ids = np.asarray(edge_ids)
+        astrocyte_ids = np.unique(edge_ids // self.params['synapses_per_astrocyte'])
+        frames = [self.astrocyte_synapses_properties(int(astrocyte_id), properties) for astrocyte_id in astrocyte_ids]
+        return pd.concat(frames).loc[edge_ids] if frames else pd.DataFrame(columns=properties)
+
+    def astrocyte_synapses_properties(self, astrocyte_id, props):
+        params = self.params
+        rng = np.random.default_rng(params['seed'] + 2 + int(astrocyte_id))
+        count = params['synapses_per_astrocyte']
+        efferent = rng.choice(params['neurons'], min(params['efferent_neurons_per_astrocyte'], params['neurons']),
+                              replace=False)
+        columns = {
+            'efferent_center_x': rng.uniform(0, SIZE[0], count).astype(np.float32),
+            'efferent_center_y': rng.uniform(0, SIZE[1], count).astype(np.float32),
+            'efferent_center_z': rng.uniform(0, SIZE[2], count).astype(np.float32),
+            '@target_node': efferent[rng.integers(0, len(efferent), count)],
+            '@source_node': np.full(count, astrocyte_id),
+        }
+        index = pd.RangeIndex(astrocyte_id * count, (astrocyte_id + 1) * count)
+        return pd.DataFrame({prop: columns[prop] for prop in props}, index=index)
+
+    def efferent_nodes(self, astrocyte_id, unique=True):
+        targets = self.astrocyte_synapses_properties(astrocyte_id, ['@target_node'])['@target_node'].to_numpy()
+        return np.unique(targets) if unique else targets
+
+
+class VasculatureMorphology():
+    def __init__(self, points):
+        self.points = points
+
+
+class Vasculature():
+    '''Random walk vessels, with the node population API of the vasculature: a node per segment'''
+    def __init__(self, params):
+        rng = np.random.default_rng(params['seed'] + 3)
+        vessels = max(params['vasculature_points'] // VESSEL_POINTS, 1)
+        starts = rng.uniform(0, 1, (vessels, 1, 3)) * SIZE
+        steps = rng.normal(0, VESSEL_STEP / np.sqrt(3), (vessels, VESSEL_POINTS - 1, 3))
+        points = np.clip(np.concatenate([starts, starts + np.cumsum(steps, axis=1)], axis=1), 0, SIZE)
+        # vessels get thinner along the walk
+        diameters = rng.lognormal(1.5, 0.5, (vessels, 1)) * np.linspace(1, 0.5, VESSEL_POINTS)
+        self.morph = VasculatureMorphology(points.reshape(-1, 3))
+
+        columns = {}
+        for end, sl in [('start', slice(None, -1)), ('end', slice(1, None))]:
+            for axis, name in enumerate('xyz'):
+                columns['{}_{}'.format(end, name)] = points[:, sl, axis].ravel()
+            columns['{}_diameter'.format(end)] = diameters[:, sl].ravel()
+        self.frame = pd.DataFrame(columns)
+        self.size = len(self.frame)
+
+    def get(self, group=None, properties=None):
+        frame = self.frame if group is None else self.frame.iloc[np.asarray(group)]
+        return frame if properties is None else frame[properties]
+
+
+class SyntheticCircuit():
+    '''Stand-in for archngv.NGVCircuit'''
+    def __init__(self, params):
+        self.params = params
+        self.neurons = Neurons(params)
+        self.astrocytes = Astrocytes(params)
+        self.neuroglial_connectome = NeuroglialConnectome(params)
+        self.vasculature = Vasculature(params)
+
+
+def main(argv):
+    '''Run the server of ngv_viewer.main on synthetic circuits'''
+    use_synthetic_circuits()
+    from .main import serve
+    serve()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
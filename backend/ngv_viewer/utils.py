@@ -9,3 +9,42 @@ class NumpyAwareJSONEncoder(json.JSONEncoder):
         if isinstance(obj, np.ndarray):
             return obj.tolist()
         return json.JSONEncoder.default(self, obj)
+
+
+BINARY_DTYPES = {
+    'float32': np.dtype('<f4'),
+    'uint8': np.dtype('<u1'),
+    'uint16': np.dtype('<u2'),
+    'uint32': np.dtype('<u4'),
+    'int32': np.dtype('<i4'),
+}
+
+
+def to_binary(values, dtype):
+    '''Raw little-endian bytes of values cast to one of BINARY_DTYPES'''
+    return np.ascontiguousarray(values, dtype=BINARY_DTYPES[dtype]).tobytes()
+
+
+def pack_binary(arrays):
+    '''Concatenate named arrays into a single binary frame
+
+    arrays is a dict of name -> (values, dtype). Each array starts at a 4 byte aligned
+    offset so that the client can view it as a typed array without copying.
+    Returns the array descriptions for the binary header and the frame bytes.
+    '''
+    descriptions = []
+    chunks = []
+    byte_offset = 0
+    for name, (values, dtype) in arrays.items():
+        data = to_binary(values, dtype)
+        descriptions.append({
+            'name': name,
+            'dtype': dtype,
+            'shape': list(np.shape(values)),
+            'byte_offset': byte_offset,
+        })
+        padding = -len(data) % 4
+        chunks.append(data + b'\0' * padding)
+        byte_offset += len(data) + padding
+    return descriptions, b''.join(chunks)
+
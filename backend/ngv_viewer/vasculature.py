@@ -0,0 +1,162 @@
+
+'''Spatial tiles of the vasculature segments
+
+The vasculature node population has a node per vessel segment, with the
+positions and diameters of both ends. It is read in chunks of
+SEGMENT_CHUNK_SIZE segments, so that neither the bounding box nor the tiles
+need the whole population as a data frame.
+
+Segments are assigned to the tile of a uniform grid (see spatial.grid_shape)
+their midpoint falls in. Tiles are contiguous slices of the segments, sorted
+thickest first inside each tile, so that each level of detail of a tile is a
+prefix of it: level l keeps the LOD_FRACTIONS[l] thickest segments of the
+whole vasculature, the last level keeps all of them.
+
+The tiles are a dict of arrays:
+    origin: float32 (3,) min corner of the tile grid
+    cell_size: float32 (3,) size of a tile
+    dims: int64 (3,) amount of tiles along each axis
+    tile_offsets: uint32 (T + 1,) first segment of each tile, C-ordered
+    lod_counts: uint32 (T, L) amount of segments of each tile at each level of detail
+    segments: float32 (N, 2, 3) start and end points of the segments
+    radii: float32 (N, 2) start and end radii of the segments
+'''
+
+import numpy as np
+
+from . import spatial
+
+SEGMENT_PROPERTIES = ['start_x', 'start_y', 'start_z', 'end_x', 'end_y', 'end_z',
+                      'start_diameter', 'end_diameter']
+SEGMENT_CHUNK_SIZE = 1000000
+# average amount of segments per tile the tile grid is chosen for
+SEGMENTS_PER_TILE = 4096
+# fraction of the thickest segments kept at each level of detail, coarse first
+LOD_FRACTIONS = [1 / 16, 1 / 4, 1]
+TILE_ARRAYS = ['origin', 'cell_size', 'dims', 'tile_offsets', 'lod_counts', 'segments', 'radii']
+
+
+def iter_segments(vasculature, chunk_size=SEGMENT_CHUNK_SIZE):
+    '''(segments, radii) chunks of the segments of the vasculature node population'''
+    for start in range(0, vasculature.size, chunk_size):
+        ids = np.arange(start, min(start + chunk_size, vasculature.size))
+        frame = vasculature.get(ids, SEGMENT_PROPERTIES)
+        values = frame[SEGMENT_PROPERTIES].to_numpy(dtype=np.float32)
+        yield values[:, :6].reshape(-1, 2, 3), values[:, 6:] / 2
+
+
+def bounding_box(vasculature):
+    '''float32 (2, 3) min and max corners of all the segments'''
+    low = np.full(3, np.inf, dtype=np.float32)
+    high = np.full(3, -np.inf, dtype=np.float32)
+    for segments, _ in iter_segments(vasculature):
+        if len(segments):
+            low = np.minimum(low, segments.min(axis=(0, 1)))
+            high = np.maximum(high, segments.max(axis=(0, 1)))
+    if not np.isfinite(low).all():
+        return np.zeros((2, 3), dtype=np.float32)
+    return np.array([low, high])
+
+
+def bbox_dict(bbox):
+    low, high = np.asarray(bbox).tolist()
+    return {
+        'max': {'x': high[0], 'y': high[1], 'z': high[2]},
+        'min': {'x': low[0], 'y': low[1], 'z': low[2]},
+    }
+
+
+def build_tiles(vasculature, bbox=None, segments_per_tile=SEGMENTS_PER_TILE):
+    '''Tiles of the vasculature, see the module docstring'''
+    bbox = bounding_box(vasculature) if bbox is None else np.asarray(bbox, dtype=np.float32)
+    count = vasculature.size
+    origin = bbox[0]
+    dims, cell_size = spatial.grid_shape(np.maximum(bbox[1] - bbox[0], 1e-3), count, segments_per_tile)
+
+    segments = np.empty((count, 2, 3), dtype=np.float32)
+    radii = np.empty((count, 2), dtype=np.float32)
+    tiles = np.empty(count, dtype=np.int64)
+    offset = 0
+    for chunk_segments, chunk_radii in iter_segments(vasculature):
+        end = offset + len(chunk_segments)
+        segments[offset:end] = chunk_segments
+        radii[offset:end] = chunk_radii
+        midpoints = chunk_segments.mean(axis=1)
+        tiles[offset:end] = np.ravel_multi_index(spatial.cell_coords(origin, cell_size, dims, midpoints).T, dims)
+        offset = end
+
+    thickness = radii.max(axis=1)
+    order = np.lexsort((-thickness, tiles))
+    tile_count = int(np.prod(dims))
+    tile_offsets = np.searchsorted(tiles[order], np.arange(tile_count + 1))
+
+    # thickness thresholds of the levels, a segment is in level l when at least as thick
+    thresholds = [np.quantile(thickness, 1 - fraction) if count and fraction < 1 else -np.inf
+                  for fraction in LOD_FRACTIONS]
+    sorted_tiles = tiles[order]
+    sorted_thickness = thickness[order]
+    lod_counts = np.stack([
+        np.bincount(sorted_tiles[sorted_thickness >= threshold], minlength=tile_count)
+        for threshold in thresholds
+    ], axis=1)
+
+    return {
+        'origin': origin.astype(np.float32),
+        'cell_size': cell_size,
+        'dims': dims,
+        'tile_offsets': tile_offsets.astype(np.uint32),
+        'lod_counts': lod_counts.astype(np.uint32),
+        'segments': segments[order],
+        'radii': radii[order],
+    }
+
+
+def tile_index(tiles):
+    '''Tile grid and segment counts of the non empty tiles, for the client to pick tiles from'''
+    counts = np.diff(tiles['tile_offsets'].astype(np.int64))
+    ids = np.flatnonzero(counts)
+    return {
+        'origin': tiles['origin'],
+        'cell_size': tiles['cell_size'],
+        'dims': tiles['dims'],
+        'lods': len(LOD_FRACTIONS),
+        'tiles': ids.astype(np.uint32),
+        'lod_counts': tiles['lod_counts'][ids],
+    }
+
+
+def tiles_in_region(tiles, region):
+    '''Sorted ids of the non empty tiles overlapping a box, sphere or frustum region, see spatial'''
+    if 'box' in region:
+        ids = spatial.cells_in_box(tiles, region['box']['min'], region['box']['max'])
+    elif 'sphere' in region:
+        center = np.asarray(region['sphere']['center'], dtype=np.float32)
+        radius = region['sphere']['radius']
+        ids = spatial.cells_in_box(tiles, center - radius, center + radius)
+    elif 'frustum' in region:
+        ids = spatial.cells_in_frustum(tiles, region['frustum'])
+    else:
+        raise ValueError('unknown region {}'.format(list(region)))
+    ids = np.unique(ids)
+    offsets = tiles['tile_offsets']
+    return ids[offsets[ids + 1] > offsets[ids]]
+
+
+def get_tile(tiles, tile, lod=None):
+    '''segments and radii of a tile at a level of detail, the finest one by default
+
+    Raises ValueError when the tile is not in the grid or the level is negative.
+    '''
+    tile = int(tile)
+    if not 0 <= tile < len(tiles['tile_offsets']) - 1:
+        raise ValueError('tile {} not in the grid of {} tiles'.format(tile, len(tiles['tile_offsets']) - 1))
+    lod = len(LOD_FRACTIONS) - 1 if lod is None else int(lod)
+    if lod < 0:
+        raise ValueError('level of detail {} is negative'.format(lod))
+    lod = min(lod, len(LOD_FRACTIONS) - 1)
+    start = int(tiles['tile_offsets'][tile])
+    end = start + int(tiles['lod_counts'][tile, lod])
+    return {
+        'segments': tiles['segments'][start:end],
+        'radii': tiles['radii'][start:end],
+    }
@@ -21,7 +21,7 @@ setup(
     ],
     maintainer='Stefano Antonel',
     maintainer_email='stefano.antonel@epfl.ch',
-    tests_require=['pytest', 'pytest-cov'],
+    tests_require=['pytest', 'pytest-cov', 'fakeredis'],
     packages=find_packages(exclude=[]),
     scripts=[],
 )
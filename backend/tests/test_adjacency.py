@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ngv_viewer import adjacency
+
+
+class Connectome():
+    '''Edge population API of the neuroglial connectome, on fixed edges'''
+    def __init__(self, astrocytes, neurons):
+        self.frame = pd.DataFrame({'@source_node': astrocytes, '@target_node': neurons})
+        self.size = len(self.frame)
+
+    def get(self, ids, properties):
+        return self.frame.iloc[ids][properties]
+
+
+@pytest.fixture(scope='module')
+def edges():
+    rng = np.random.default_rng(0)
+    # synapses: many edges per astrocyte-neuron pair
+    return rng.integers(0, 50, 5000), rng.integers(0, 300, 5000)
+
+
+@pytest.fixture(scope='module')
+def pairs(edges):
+    return set(zip(*(ids.tolist() for ids in edges)))
+
+
+@pytest.fixture(scope='module')
+def adj(edges, monkeypatch_module):
+    # small chunks, for pairs duplicated across chunks
+    monkeypatch_module.setattr(adjacency, 'EDGE_CHUNK_SIZE', 700)
+    return adjacency.build_adjacency(Connectome(*edges))
+
+
+@pytest.fixture(scope='module')
+def monkeypatch_module():
+    with pytest.MonkeyPatch.context() as patch:
+        yield patch
+
+
+def brute_neighbours(pairs, direction, cell_id):
+    if direction == 'astrocytes':
+        return sorted(neuron for astrocyte, neuron in pairs if astrocyte == cell_id)
+    return sorted(astrocyte for astrocyte, neuron in pairs if neuron == cell_id)
+
+
+@pytest.mark.parametrize('direction', ['astrocytes', 'neurons'])
+def test_neighbours(adj, pairs, direction):
+    ids = [3, 400, 0, 3, -1, 17]
+    result = adjacency.set_operation(adj, direction, ids, 'neighbours')
+    offsets = result['offsets'].astype(np.int64)
+    assert len(offsets) == len(ids) + 1
+    for i, cell_id in enumerate(ids):
+        assert result['ids'][offsets[i]:offsets[i + 1]].tolist() == brute_neighbours(pairs, direction, cell_id)
+    counts = adjacency.set_operation(adj, direction, ids, 'counts')['counts']
+    np.testing.assert_array_equal(counts, np.diff(offsets))
+
+
+@pytest.mark.parametrize('direction', ['astrocytes', 'neurons'])
+def test_union_and_intersection(adj, pairs, direction):
+    ids = [1, 2, 2, 5]
+    sets = [set(brute_neighbours(pairs, direction, cell_id)) for cell_id in set(ids)]
+    union = adjacency.set_operation(adj, direction, ids, 'union')
+    assert union['ids'].tolist() == sorted(set.union(*sets))
+    assert union['counts'].tolist() == [sum(cell_id in s for s in sets) for cell_id in union['ids']]
+    intersection = adjacency.set_operation(adj, direction, ids, 'intersection')
+    assert intersection['ids'].tolist() == sorted(set.intersection(*sets))
+
+
+def test_empty_connectome():
+    adj = adjacency.build_adjacency(Connectome(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)))
+    np.testing.assert_array_equal(adj['astrocyte_offsets'], [0])
+    result = adjacency.set_operation(adj, 'astrocytes', [0, 1], 'neighbours')
+    np.testing.assert_array_equal(result['offsets'], [0, 0, 0])
+
+
+def test_invalid_direction_and_operation(adj):
+    with pytest.raises(ValueError):
+        adjacency.set_operation(adj, 'synapses', [0], 'union')
+    with pytest.raises(ValueError):
+        adjacency.set_operation(adj, 'astrocytes', [0], 'difference')
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+
+from ngv_viewer.cache import LRUCache, sizeof
+
+
+def test_evicts_least_recently_used_items():
+    cache = LRUCache('items', max_items=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_evicts_by_bytes():
+    cache = LRUCache('bytes', max_bytes=250)
+    evicted = []
+    cache.evict_listeners.append(evicted.append)
+    for key in 'abc':
+        cache.set(key, np.zeros(100, dtype=np.uint8))
+    assert evicted == ['a']
+    assert cache.nbytes == 200
+    # replacing an item accounts for its new size only
+    cache.set('b', np.zeros(10, dtype=np.uint8))
+    assert cache.nbytes == 110
+
+
+def test_larger_than_budget_is_not_cached():
+    cache = LRUCache('small', max_bytes=10)
+    cache.set('big', np.zeros(100, dtype=np.uint8))
+    assert 'big' not in cache
+    assert cache.nbytes == 0
+
+
+def test_explicit_size_and_stats():
+    cache = LRUCache('sized', max_bytes=100)
+    cache.set('a', 'value', size=60)
+    cache.set('b', 'value', size=60)
+    assert list(cache.items) == ['b']
+    assert cache.get('a') is None
+    assert cache.get('b') == 'value'
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['bytes']) == (1, 1, 60)
+
+
+def test_drop_prefix():
+    cache = LRUCache('circuits')
+    cache.set('circuit@1:a', 1)
+    cache.set('circuit@1:b', 2)
+    cache.set('circuit@2:a', 3)
+    cache.drop_prefix('circuit@1:')
+    assert len(cache) == 1
+    assert cache.get('circuit@2:a') == 3
+
+
+def test_sizeof():
+    assert sizeof(np.zeros(10, dtype=np.float64)) == 80
+    assert sizeof({'a': np.zeros(10, dtype=np.uint8)}) > 10
+    assert sizeof([np.zeros(4, dtype=np.uint8)] * 3) > 12
+
+
+def test_circuit_key_memoizes_the_config_mtime(tmp_path, monkeypatch):
+    from ngv_viewer import cache
+    config = tmp_path / 'ngv_config.json'
+    config.write_text('{}')
+    key = cache.circuit_key(str(config))
+    assert cache.circuit_key_fresh(str(config))
+
+    os.utime(config, ns=(0, 12345))
+    # the memoized mtime is used until it is stale
+    assert cache.circuit_key(str(config)) == key
+    monkeypatch.setattr(cache, 'CIRCUIT_MTIME_TTL', 0)
+    assert not cache.circuit_key_fresh(str(config))
+    assert cache.circuit_key(str(config)) == '{}@12345'.format(config)
@@ -0,0 +1,38 @@
+import inspect
+import re
+
+from ngv_viewer import main, metrics
+from ngv_viewer.metrics import Counter, Histogram, key_family
+
+
+def test_commands_are_the_dispatched_ones():
+    source = inspect.getsource(main.WSHandler.handle_message)
+    dispatched = set(re.findall(r"cmd == '(\w+)'", source))
+    for group in re.findall(r"cmd in \[([^\]]+)\]", source):
+        dispatched.update(re.findall(r"'(\w+)'", group))
+    assert dispatched == main.COMMANDS
+
+
+def test_unknown_commands_share_a_label():
+    assert main.command_label('get_astrocyte_morph') == 'get_astrocyte_morph'
+    assert main.command_label('x' * 100) == 'unknown'
+    assert main.command_label('get_astrocyte_morph ') == 'unknown'
+
+
+def test_exposition():
+    counter = Counter('test_requests_total', 'Requests', ['cmd'])
+    counter.inc(cmd='a')
+    counter.inc(2, cmd='a')
+    histogram = Histogram('test_seconds', 'Latency', ['cmd'], buckets=[0.1, 1])
+    histogram.observe(0.5, cmd='a')
+    text = metrics.exposition()
+    assert 'test_requests_total{cmd="a"} 3.0' in text
+    assert 'test_seconds_bucket{cmd="a",le="0.1"} 0.0' in text
+    assert 'test_seconds_bucket{cmd="a",le="+Inf"} 1.0' in text
+    metrics.REGISTRY.remove(counter)
+    metrics.REGISTRY.remove(histogram)
+
+
+def test_key_family_drops_ids_and_digests():
+    assert key_family('/path/config.json@123:astrocyte:morph:12') == 'astrocyte:morph'
+    assert key_family('/path/config.json@123:merged:' + 'a' * 40) == 'merged'
@@ -0,0 +1,51 @@
+import numpy as np
+
+from ngv_viewer import microdomain
+
+
+def cube(offset=0.):
+    points = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.float64) + offset
+    triangles = np.array([[0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5]])
+    return points, triangles
+
+
+def test_quantization_error_is_bounded():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-50, 50, (1000, 3))
+    mesh = microdomain.pack_mesh(points, np.zeros((0, 3), dtype=np.int64))
+    low, high = mesh['bbox'].astype(np.float64)
+    error = np.abs(microdomain.dequantize(mesh) - points)
+    assert mesh['vertices'].dtype == np.uint16
+    assert np.all(error <= (high - low) / (2 * microdomain.QUANTIZATION_LEVELS) + 1e-5)
+
+
+def test_index_dtype():
+    assert microdomain.index_dtype(2 ** 16) == np.uint16
+    assert microdomain.index_dtype(2 ** 16 + 1) == np.uint32
+
+
+def test_concat_meshes():
+    meshes = [microdomain.pack_mesh(*cube()), microdomain.pack_mesh(*cube(2.))]
+    batch = microdomain.concat_meshes(meshes)
+    assert batch['bboxes'].shape == (2, 2, 3)
+    np.testing.assert_array_equal(batch['vertex_offsets'], [0, 8, 16])
+    np.testing.assert_array_equal(batch['index_offsets'], [0, 4, 8])
+    np.testing.assert_array_equal(batch['indices'][4:], meshes[1]['indices'])
+    assert len(microdomain.concat_meshes([])['vertices']) == 0
+
+
+def test_merge_meshes_shares_vertices():
+    # the second cube shares the face x = 1 of the first one
+    mesh = microdomain.merge_meshes([cube(), cube(np.array([1., 0, 0]))])
+    assert len(mesh['vertices']) == 12
+    np.testing.assert_array_equal(mesh['triangle_offsets'], [0, 4, 8])
+    positions = microdomain.dequantize(mesh)[mesh['indices'].astype(np.int64)]
+    expected = np.concatenate([cube()[0][cube()[1]], cube(np.array([1., 0, 0]))[0][cube()[1]]])
+    np.testing.assert_allclose(positions, expected, atol=1e-4)
+
+
+def test_merge_meshes_of_no_domains():
+    mesh = microdomain.merge_meshes([])
+    assert mesh['vertices'].shape == (0, 3)
+    assert mesh['indices'].shape == (0, 3)
+    np.testing.assert_array_equal(mesh['triangle_offsets'], [0])
@@ -0,0 +1,97 @@
+import numpy as np
+
+from ngv_viewer.morph_simplification import rdp_mask, simplify_packed, lod_levels, lod_for_distance, LOD_EPSILONS
+from ngv_viewer.morphology import SOMA_TYPE
+
+
+def rdp(points, epsilon):
+    '''Recursive reference implementation, mask of the kept points of a single section'''
+    keep = np.zeros(len(points), dtype=bool)
+
+    def split(first, last):
+        keep[first] = keep[last] = True
+        if last - first < 2:
+            return
+        start, end = points[first], points[last]
+        segment = end - start
+        inner = points[first + 1 : last]
+        t = np.clip((inner - start) @ segment / max(segment @ segment, 1e-12), 0, 1)
+        distances = np.linalg.norm(inner - (start + t[:, None] * segment), axis=1)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > epsilon:
+            split(first, first + 1 + farthest)
+            split(first + 1 + farthest, last)
+
+    split(0, len(points) - 1)
+    return keep
+
+
+def packed_morph(sections, types):
+    points = np.concatenate(sections)
+    offsets = np.concatenate([[0], np.cumsum([len(section) for section in sections])])
+    return {
+        'points': np.column_stack([points, np.ones(len(points))]).astype(np.float32),
+        'section_offsets': offsets.astype(np.uint32),
+        'section_types': np.asarray(types, dtype=np.uint8),
+        'section_parents': np.full(len(sections), -1, dtype=np.int32),
+    }
+
+
+def random_walk(rng, count):
+    return np.cumsum(rng.normal(size=(count, 3)), axis=0)
+
+
+def test_matches_recursive_rdp():
+    rng = np.random.default_rng(1)
+    sections = [random_walk(rng, count) for count in [2, 5, 40, 200]]
+    offsets = np.concatenate([[0], np.cumsum([len(section) for section in sections])])
+    points = np.concatenate(sections)
+    for epsilon in LOD_EPSILONS:
+        expected = np.concatenate([rdp(section, epsilon) for section in sections])
+        np.testing.assert_array_equal(rdp_mask(points, offsets, epsilon), expected)
+
+
+def test_straight_section_keeps_its_ends():
+    points = np.column_stack([np.arange(10), np.zeros(10), np.zeros(10)])
+    keep = rdp_mask(points, [0, 10], 0.1)
+    assert np.flatnonzero(keep).tolist() == [0, 9]
+
+
+def test_empty():
+    assert len(rdp_mask(np.empty((0, 4)), [0], 1.)) == 0
+
+
+def test_simplify_packed_keeps_the_soma_and_remaps_offsets():
+    rng = np.random.default_rng(2)
+    soma = rng.normal(size=(8, 3))
+    packed = packed_morph([soma, random_walk(rng, 100), random_walk(rng, 50)], [SOMA_TYPE, 3, 2])
+    simplified = simplify_packed(packed, 4.)
+
+    offsets = simplified['section_offsets'].astype(np.int64)
+    assert offsets[-1] == len(simplified['points'])
+    np.testing.assert_array_equal(simplified['points'][:8], packed['points'][:8])
+    assert (np.diff(offsets) >= 2).all()
+    np.testing.assert_array_equal(simplified['section_types'], packed['section_types'])
+
+
+def test_levels_get_finer():
+    rng = np.random.default_rng(3)
+    packed = packed_morph([random_walk(rng, 500)], [3])
+    sizes = [len(level['points']) for level in lod_levels(packed)]
+    assert sizes == sorted(sizes)
+    assert sizes[-1] <= len(packed['points'])
+
+
+def test_lod_for_distance():
+    assert lod_for_distance(5000) == 0
+    assert lod_for_distance(500) == 1
+    assert lod_for_distance(10) == len(LOD_EPSILONS) - 1
+
+
+def test_requested_lod_is_clamped():
+    from ngv_viewer.main import requested_lod
+    assert requested_lod({'lod': -1}) == 0
+    assert requested_lod({'lod': 1}) == 1
+    assert requested_lod({'lod': 99}) == len(LOD_EPSILONS) - 1
+    assert requested_lod({'distance': 1e9}) == lod_for_distance(1e9)
+    assert requested_lod({}) is None
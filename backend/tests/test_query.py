@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ngv_viewer.cell_table import build_cell_table
+from ngv_viewer import query as q
+from ngv_viewer import spatial
+
+
+class Storage():
+    '''Storage methods used by query.evaluate, on a fixed table'''
+    def __init__(self, table):
+        self.grid = spatial.build_grid(table['positions'])
+
+    def get_spatial_index(self, circuit_path, kind):
+        return self.grid
+
+    def get_efferent_neurons(self, circuit_path, astrocyte_id):
+        return np.array([1, 3, 5])
+
+    def get_astrocyte_microdomain(self, circuit_path, astrocyte_id):
+        # unit cube at the origin
+        vertices = [[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)]
+        indexes = [[0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1],
+                   [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3]]
+        return {'vertices': vertices, 'indexes': indexes}
+
+
+@pytest.fixture(scope='module')
+def cells():
+    rng = np.random.default_rng(0)
+    count = 500
+    return pd.DataFrame({
+        'x': rng.uniform(-2, 2, count),
+        'y': rng.uniform(-2, 2, count),
+        'z': rng.uniform(-2, 2, count),
+        'layer': rng.choice(['1', '2', '3'], count),
+        'depth': rng.choice([10., 20., 30.], count),
+    })
+
+
+@pytest.fixture(scope='module')
+def table(cells):
+    return build_cell_table(cells)
+
+
+def select(table, query):
+    return np.flatnonzero(q.evaluate(q.normalize(query), table, Storage(table), 'circuit'))
+
+
+def test_props_and_boolean_operators(cells, table):
+    np.testing.assert_array_equal(select(table, {'prop': 'layer', 'in': ['1', '3']}),
+                                  np.flatnonzero(cells['layer'].isin(['1', '3'])))
+    np.testing.assert_array_equal(select(table, {'prop': 'depth', 'gte': 15, 'lt': 30}),
+                                  np.flatnonzero(cells['depth'] == 20))
+    np.testing.assert_array_equal(
+        select(table, {'and': [{'prop': 'layer', 'eq': '2'}, {'not': {'prop': 'x', 'lt': 0}}]}),
+        np.flatnonzero((cells['layer'] == '2') & (cells['x'] >= 0)))
+    np.testing.assert_array_equal(select(table, {'or': [{'ids': [4, 2]}, {'efferent_to': 0}]}), [1, 2, 3, 4, 5])
+
+
+def test_regions(cells, table):
+    inside = (cells[['x', 'y', 'z']].abs() <= 1).all(axis=1)
+    np.testing.assert_array_equal(select(table, {'box': {'min': [-1, -1, -1], 'max': [1, 1, 1]}}),
+                                  np.flatnonzero(inside))
+    distances = np.linalg.norm(cells[['x', 'y', 'z']].to_numpy(), axis=1)
+    np.testing.assert_array_equal(select(table, {'sphere': {'center': [0, 0, 0], 'radius': 1.5}}),
+                                  np.flatnonzero(distances <= 1.5))
+    in_cube = ((cells[['x', 'y', 'z']] >= 0) & (cells[['x', 'y', 'z']] <= 1)).all(axis=1)
+    np.testing.assert_array_equal(select(table, {'microdomain': 0}), np.flatnonzero(in_cube))
+
+
+def test_equivalent_queries_share_a_key():
+    assert q.query_key({'and': [{'ids': [3, 1]}, {'prop': 'layer', 'in': ['2', '1']}]}) == \
+        q.query_key({'and': [{'prop': 'layer', 'in': ['1', '2', '1']}, {'ids': [1, 3, 3]}]})
+    assert q.normalize({'prop': 'layer', 'eq': 4, 'junk': 1}) == {'prop': 'layer', 'in': ['4']}
+    assert q.query_key({'prop': 'layer', 'eq': '4'}) == q.query_key({'prop': 'layer', 'in': [4]})
+    assert q.normalize({'prop': 'x', 'gte': 1, 'junk': 1}) == {'prop': 'x', 'gte': 1.}
+    assert q.normalize({'box': {'min': [0, 0, 0], 'max': [1, 1, 1], 'junk': 1}}) == \
+        {'box': {'min': [0, 0, 0], 'max': [1, 1, 1]}}
+
+
+@pytest.mark.parametrize('query', [
+    {},
+    [],
+    {'box': {'min': [0, 0, 0]}},
+    {'box': {'min': [0, 0, 0], 'max': ['a', 0, 0]}},
+    {'box': {'min': [0, 0], 'max': [1, 1, 1]}},
+    {'box': [0, 1]},
+    {'sphere': {'center': [0, 0, 0]}},
+    {'sphere': {'center': [0, 0, 0], 'radius': '1'}},
+    {'prop': 'x', 'gt': 'a'},
+    {'prop': 'x'},
+    {'prop': 1, 'eq': 1},
+    {'prop': 'layer', 'in': '1'},
+    {'prop': 'layer', 'eq': [1]},
+    {'prop': 'x', 'eq': 3},
+    {'prop': 'y', 'in': [3]},
+    {'and': [{'ids': [1]}], 'or': [{'ids': [2]}]},
+    {'and': []},
+    {'or': {'ids': [1]}},
+    {'not': {'box': None}},
+    {'ids': [1, None]},
+    {'ids': 'abc'},
+    {'efferent_to': 'a'},
+    {'unknown': 1},
+])
+def test_malformed_queries_raise_value_error(query):
+    with pytest.raises(ValueError):
+        q.normalize(query)
+
+
+def test_result_format():
+    assert q.result_format(1, 1000) == 'ids'
+    assert q.result_format(900, 1000) == 'bitset'
+    with pytest.raises(ValueError):
+        q.result_format(1, 1000, 'csv')
+    mask = np.zeros(20, dtype=bool)
+    mask[[0, 9, 19]] = True
+    np.testing.assert_array_equal(q.bitset_ids(q.to_bitset(mask), 20), [0, 9, 19])
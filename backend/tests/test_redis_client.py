@@ -0,0 +1,99 @@
+import fakeredis
+import numpy as np
+import pytest
+
+from ngv_viewer import redis_client
+from ngv_viewer.redis_client import RedisClient, KEY_PREFIX
+from ngv_viewer.serialization import dumps
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def fake(server):
+    return fakeredis.FakeRedis(server=server)
+
+
+def test_set_get_through_redis(fake):
+    writer = RedisClient('writer', client=fake)
+    reader = RedisClient('reader', client=fake)
+    writer.set('circuit:morph:1', {'points': np.arange(6, dtype=np.float32)})
+
+    assert fake.exists(KEY_PREFIX + 'circuit:morph:1')
+    value = reader.get('circuit:morph:1')
+    np.testing.assert_array_equal(value['points'], np.arange(6, dtype=np.float32))
+    # the redis hit is now in the local tier
+    assert 'circuit:morph:1' in reader.local_cache
+
+
+def test_get_many_single_mget(fake, monkeypatch):
+    writer = RedisClient('writer', client=fake)
+    writer.set_many({'k:1': 1, 'k:2': 2})
+    reader = RedisClient('reader', client=fake)
+    reader.set('k:0', 0)
+
+    calls = []
+    mget = fake.mget
+    monkeypatch.setattr(fake, 'mget', lambda keys: calls.append(keys) or mget(keys))
+    assert reader.get_many(['k:0', 'k:1', 'k:2', 'k:3']) == [0, 1, 2, None]
+    # local hits are not asked to redis, all the others in one round trip
+    assert calls == [[KEY_PREFIX + 'k:1', KEY_PREFIX + 'k:2', KEY_PREFIX + 'k:3']]
+
+
+def test_set_many_pipeline(fake, monkeypatch):
+    pipelines = []
+    pipeline = fake.pipeline
+    monkeypatch.setattr(fake, 'pipeline', lambda **kwargs: pipelines.append(kwargs) or pipeline(**kwargs))
+    RedisClient('writer', client=fake).set_many({'a': 1, 'b': 2, 'c': 3})
+    assert pipelines == [{'transaction': False}]
+    assert fake.mget([KEY_PREFIX + key for key in 'abc']) == [dumps(1), dumps(2), dumps(3)]
+
+
+def test_ttl(fake):
+    RedisClient(client=fake).set('ttl', 1)
+    ttl = fake.ttl(KEY_PREFIX + 'ttl')
+    assert 0 < ttl <= redis_client.REDIS_TTL
+
+
+def test_no_ttl(fake, monkeypatch):
+    monkeypatch.setattr(redis_client, 'REDIS_TTL', 0)
+    RedisClient(client=fake).set('forever', 1)
+    assert fake.ttl(KEY_PREFIX + 'forever') == -1
+
+
+def test_local_tier_evicts_by_bytes(fake):
+    client = RedisClient('local', max_bytes=2500, client=fake)
+    for i in range(3):
+        client.set('arr:{}'.format(i), np.zeros(1000, dtype=np.uint8))
+    assert 'arr:0' not in client.local_cache
+    assert 'arr:2' in client.local_cache
+    assert client.local_cache.nbytes <= 2500
+    assert client.stats()['evictions'] >= 1
+    # evicted locally, still in redis
+    np.testing.assert_array_equal(client.get('arr:0'), np.zeros(1000, dtype=np.uint8))
+
+
+def test_redis_error_is_a_miss(server, fake):
+    client = RedisClient(client=fake)
+    fake.set(KEY_PREFIX + 'down', dumps(1))
+    server.connected = False
+    assert client.get('down') is None
+    # writes still fill the local tier
+    client.set('down', 2)
+    assert client.get('down') == 2
+
+
+def test_undecodable_value_is_a_miss(fake):
+    fake.set(KEY_PREFIX + 'garbage', b'not a serialized object')
+    assert RedisClient(client=fake).get('garbage') is None
+
+
+def test_without_redis():
+    client = RedisClient(client=None)
+    client.rc = None
+    assert client.get('missing') is None
+    client.set('local', 1)
+    assert client.get('local') == 1
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from ngv_viewer import cache, resources
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / 'circuit_config.json'
+    path.write_text('{}')
+    return str(path)
+
+
+def test_resolved_builds_do_not_stat_the_config(config, monkeypatch):
+    build = resources.register(config)
+
+    def stat(path, *args, **kwargs):
+        raise AssertionError('stat of {}'.format(path))
+
+    monkeypatch.setattr(os, 'stat', stat)
+    assert resources.resolved(build) == config
+    assert resources.resolved('0' * 16) is None
+
+
+def test_stale_builds_are_resolved_again(config, monkeypatch):
+    build = resources.register(config)
+    monkeypatch.setattr(cache, 'CIRCUIT_MTIME_TTL', 0)
+    assert resources.resolved(build) is None
+    assert resources.resolve(build) == config
+    # a rebuilt config is a new build
+    os.utime(config, ns=(0, 0))
+    assert resources.resolve(build) is None
+    assert resources.resolve(resources.register(config)) == config
+
+
+def test_parse_range():
+    assert resources.parse_range('bytes=0-9', 100) == (0, 10)
+    assert resources.parse_range('bytes=90-', 100) == (90, 100)
+    assert resources.parse_range('bytes=-10', 100) == (90, 100)
+    assert resources.parse_range('bytes=0-1,5-6', 100) is None
+    with pytest.raises(ValueError):
+        resources.parse_range('bytes=100-', 100)
@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+
+from ngv_viewer.scheduler import (BULK, INTERACTIVE, PrioritySemaphore, Scheduler, Turns, current_request,
+                                  message_priority)
+from ngv_viewer.streaming import Streams
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_message_priority():
+    assert message_priority({'cmd': 'get_circuit_cells'}) == BULK
+    assert message_priority({'cmd': 'get_astrocyte_props'}) == INTERACTIVE
+    assert message_priority({'cmd': 'get_circuit_cells', 'priority': 'interactive'}) == INTERACTIVE
+
+
+def test_priority_semaphore_serves_interactive_first_and_reserves_slots():
+    async def main():
+        semaphore = PrioritySemaphore(2, reserved=1)
+        await semaphore.acquire(BULK)
+        # the last slot is reserved for interactive waiters
+        assert not semaphore.can_take(BULK)
+        await semaphore.acquire(INTERACTIVE)
+        order = []
+
+        async def waiter(name, priority):
+            await semaphore.acquire(priority)
+            order.append(name)
+
+        tasks = [asyncio.ensure_future(waiter(name, priority))
+                 for name, priority in [('bulk', BULK), ('interactive', INTERACTIVE)]]
+        await asyncio.sleep(0)
+        semaphore.release(INTERACTIVE)
+        await asyncio.sleep(0)
+        semaphore.release(BULK)
+        await asyncio.gather(*tasks)
+        return order, semaphore.free
+
+    assert run(main()) == (['interactive', 'bulk'], 0)
+
+
+def test_cancelled_waiter_gives_its_slot_back():
+    async def main():
+        semaphore = PrioritySemaphore(1, reserved=0)
+        await semaphore.acquire(INTERACTIVE)
+        task = asyncio.ensure_future(semaphore.acquire(INTERACTIVE))
+        await asyncio.sleep(0)
+        # handed over, then cancelled before it runs
+        semaphore.release(INTERACTIVE)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return semaphore.free
+
+    assert run(main()) == 1
+
+
+def test_turns_interleave_streams():
+    async def main():
+        turns = Turns()
+        order = []
+
+        async def stream(name, chunks):
+            for chunk in range(chunks):
+                await turns.acquire(INTERACTIVE)
+                order.append((name, chunk))
+                await asyncio.sleep(0)
+                turns.release()
+
+        await asyncio.gather(stream('a', 3), stream('b', 3))
+        return order
+
+    assert run(main()) == [('a', 0), ('b', 0), ('a', 1), ('b', 1), ('a', 2), ('b', 2)]
+
+
+async def request(result, value, delay=0.01):
+    await asyncio.sleep(delay)
+    result.append(value)
+
+
+def test_requests_without_cmdid_run_concurrently():
+    async def main():
+        scheduler = Scheduler(2, Streams())
+        result = []
+        tasks = [scheduler.start({'cmd': 'get_astrocyte_props', 'cmdid': None}, request(result, value))
+                 for value in range(3)]
+        assert len(scheduler.tasks) == 3
+        # cancel without a cmdid addresses no request
+        scheduler.cancel(None)
+        await asyncio.gather(*tasks)
+        return sorted(result), scheduler.tasks
+
+    assert run(main()) == ([0, 1, 2], {})
+
+
+def test_streams_of_requests_without_cmdid():
+    async def main():
+        streams = Streams()
+        scheduler = Scheduler(2, streams)
+        result = []
+
+        async def handle(value):
+            streams.start(None, request(result, value))
+
+        for value in range(3):
+            scheduler.start({'cmd': 'get_circuit_cells', 'cmdid': None}, handle(value))
+        await asyncio.sleep(0)
+        assert len(streams.tasks) == 3
+        scheduler.cancel_all()
+        await asyncio.sleep(0.02)
+        return result, streams.tasks
+
+    assert run(main()) == ([], {})
+
+
+def test_supersede_and_cancel():
+    async def main():
+        scheduler = Scheduler(2, Streams())
+        result = []
+        first = scheduler.start({'cmd': 'get_astrocyte_props', 'cmdid': None, 'supersede': 'props'},
+                                request(result, 'first'))
+        second = scheduler.start({'cmd': 'get_astrocyte_props', 'cmdid': None, 'supersede': 'props'},
+                                 request(result, 'second'))
+        cancelled = scheduler.start({'cmd': 'get_astrocyte_props', 'cmdid': 7}, request(result, 'cancelled'))
+        scheduler.cancel(7)
+        await asyncio.gather(first, second, cancelled, return_exceptions=True)
+        return result, first.cancelled(), cancelled.cancelled()
+
+    assert run(main()) == (['second'], True, True)
+
+
+def test_current_request_of_the_tasks():
+    async def main():
+        scheduler = Scheduler(1, Streams())
+
+        async def handle():
+            return current_request.get()
+
+        return await asyncio.gather(*(scheduler.start({'cmd': 'cancel'}, handle()) for _ in range(3)))
+
+    ids = run(main())
+    assert len(set(ids)) == 3 and None not in ids
@@ -0,0 +1,76 @@
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ngv_viewer.serialization import dumps, loads, MAGIC, FORMAT_VERSION, FLAG_ZLIB
+
+
+def header(blob):
+    return struct.unpack_from('<BB', blob, len(MAGIC))
+
+
+def test_round_trip_arrays():
+    obj = {
+        'points': np.arange(12, dtype=np.float32).reshape(4, 3),
+        'ids': np.array([3, 1, 2], dtype=np.uint32),
+        'nested': [{'value': np.int64(4), 'name': 'a'}, None, 1.5],
+        'sections': [np.zeros(3), np.ones(3)],
+        7: 'non string key',
+    }
+    result = loads(dumps(obj))
+    assert result['points'].dtype == np.float32
+    np.testing.assert_array_equal(result['points'], obj['points'])
+    np.testing.assert_array_equal(result['ids'], obj['ids'])
+    assert result['nested'] == [{'value': 4, 'name': 'a'}, None, 1.5]
+    assert len(result['sections']) == 2
+    np.testing.assert_array_equal(result['sections'][1], np.ones(3))
+    assert result[7] == 'non string key'
+
+
+def test_round_trip_dataframe():
+    frame = pd.DataFrame({
+        'x': np.arange(4, dtype=np.float32),
+        'layer': pd.Categorical(['1', '2', '1', '3']),
+        'mtype': ['a', 'b', 'c', 'd'],
+    }, index=pd.Index([10, 11, 12, 13], name='gid'))
+    result = loads(dumps(frame))
+    pd.testing.assert_frame_equal(result, frame)
+
+
+def test_compressed_only_above_min_size():
+    small = dumps({'a': 1})
+    assert header(small) == (FORMAT_VERSION, 0)
+
+    large = np.zeros(10000, dtype=np.float32)
+    blob = dumps(large)
+    assert header(blob) == (FORMAT_VERSION, FLAG_ZLIB)
+    assert len(blob) < large.nbytes
+    np.testing.assert_array_equal(loads(blob), large)
+    # the payload is a plain zlib stream
+    zlib.decompress(blob[len(MAGIC) + 2:])
+
+    uncompressed = dumps(large, compression_level=0)
+    assert header(uncompressed) == (FORMAT_VERSION, 0)
+    np.testing.assert_array_equal(loads(uncompressed), large)
+
+
+def test_bad_magic():
+    with pytest.raises(ValueError, match='Not an ngv-viewer'):
+        loads(b'XYZ' + dumps({'a': 1})[len(MAGIC):])
+
+
+def test_format_version_mismatch():
+    blob = dumps({'a': 1})
+    other = MAGIC + struct.pack('<BB', FORMAT_VERSION + 1, 0) + blob[len(MAGIC) + 2:]
+    with pytest.raises(ValueError, match='version'):
+        loads(other)
+
+
+def test_object_arrays_are_not_pickled():
+    values = np.array(['a', 'bc', None], dtype=object)
+    result = loads(dumps(values))
+    assert result.dtype == object
+    assert result.tolist() == ['a', 'bc', None]
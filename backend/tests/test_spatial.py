@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from ngv_viewer import spatial
+
+
+@pytest.fixture(scope='module')
+def points():
+    rng = np.random.default_rng(0)
+    return rng.uniform(0, 1000, size=(5000, 3)).astype(np.float32)
+
+
+@pytest.fixture(scope='module')
+def grid(points):
+    return spatial.build_grid(points, ids=np.arange(len(points)) + 100)
+
+
+def test_grid_layout(points, grid):
+    assert grid['cell_offsets'][-1] == len(points)
+    assert len(grid['cell_offsets']) == np.prod(grid['dims']) + 1
+    assert sorted(grid['ids'].tolist()) == list(range(100, 100 + len(points)))
+    np.testing.assert_array_equal(grid['positions'], points[grid['ids'] - 100])
+    # each point is in its grid cell
+    cells = np.ravel_multi_index(
+        spatial.cell_coords(grid['origin'], grid['cell_size'], grid['dims'], grid['positions']).T, grid['dims'])
+    np.testing.assert_array_equal(np.searchsorted(grid['cell_offsets'], np.arange(len(points)), side='right') - 1,
+                                  cells)
+
+
+def test_query_box(points, grid):
+    box_min, box_max = np.array([100, 200, 300]), np.array([400, 700, 500])
+    result = spatial.query_box(grid, box_min, box_max)
+    expected = np.flatnonzero(np.all((points >= box_min) & (points <= box_max), axis=1)) + 100
+    np.testing.assert_array_equal(result['ids'], expected)
+    np.testing.assert_array_equal(result['positions'], points[expected - 100])
+
+
+def test_query_box_outside(grid):
+    assert len(spatial.query_box(grid, [2000, 2000, 2000], [3000, 3000, 3000])['ids']) == 0
+
+
+def test_query_sphere(points, grid):
+    center, radius = np.array([500, 500, 500], dtype=np.float32), 200
+    result = spatial.query_sphere(grid, center, radius)
+    expected = np.flatnonzero(np.sum((points - center) ** 2, axis=1) <= radius ** 2) + 100
+    np.testing.assert_array_equal(result['ids'], expected)
+
+
+def test_query_frustum(points, grid):
+    # x >= 100, x <= 600, y >= 250
+    planes = [[1, 0, 0, -100], [-1, 0, 0, 600], [0, 1, 0, -250]]
+    result = spatial.query_frustum(grid, planes)
+    inside = (points[:, 0] >= 100) & (points[:, 0] <= 600) & (points[:, 1] >= 250)
+    np.testing.assert_array_equal(result['ids'], np.flatnonzero(inside) + 100)
+
+
+def test_sample(grid):
+    full = spatial.query_box(grid, [0, 0, 0], [1000, 1000, 1000])
+    sampled = spatial.query_box(grid, [0, 0, 0], [1000, 1000, 1000], sample=2)
+    assert len(full['ids']) == 5000
+    assert len(sampled['ids']) <= 2 * np.prod(grid['dims'])
+    assert set(sampled['ids']) <= set(full['ids'])
+    # samples are stable
+    np.testing.assert_array_equal(sampled['ids'],
+                                  spatial.query_box(grid, [0, 0, 0], [1000, 1000, 1000], sample=2)['ids'])
+
+
+def test_empty_grid():
+    grid = spatial.build_grid(np.empty((0, 3)))
+    assert len(spatial.query_sphere(grid, [0, 0, 0], 10)['ids']) == 0
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from ngv_viewer import vasculature
+from ngv_viewer.synthetic import DEFAULTS, Vasculature
+
+
+@pytest.fixture(scope='module')
+def population():
+    return Vasculature(dict(DEFAULTS, seed=0, vasculature_points=20000))
+
+
+@pytest.fixture(scope='module')
+def tiles(population):
+    return vasculature.build_tiles(population, segments_per_tile=256)
+
+
+def test_bounding_box(population):
+    bbox = vasculature.bounding_box(population)
+    points = population.frame[vasculature.SEGMENT_PROPERTIES[:6]].to_numpy().reshape(-1, 3)
+    np.testing.assert_allclose(bbox, [points.min(axis=0), points.max(axis=0)], rtol=1e-6)
+
+
+def test_tiles_hold_their_segments_thickest_first(population, tiles):
+    offsets = tiles['tile_offsets'].astype(np.int64)
+    assert offsets[-1] == population.size
+    assert len(offsets) == np.prod(tiles['dims']) + 1
+    for tile in np.flatnonzero(np.diff(offsets))[:20]:
+        segments = tiles['segments'][offsets[tile]:offsets[tile + 1]]
+        coords = np.floor((segments.mean(axis=1) - tiles['origin']) / tiles['cell_size']).astype(np.int64)
+        coords = np.clip(coords, 0, tiles['dims'] - 1)
+        assert np.all(np.ravel_multi_index(coords.T, tiles['dims']) == tile)
+        thickness = tiles['radii'][offsets[tile]:offsets[tile + 1]].max(axis=1)
+        assert np.all(np.diff(thickness) <= 0)
+
+
+def test_levels_of_detail_are_prefixes(tiles):
+    counts = tiles['lod_counts'].astype(np.int64)
+    assert np.all(np.diff(counts, axis=1) >= 0)
+    np.testing.assert_array_equal(counts[:, -1], np.diff(tiles['tile_offsets'].astype(np.int64)))
+    tile = int(np.argmax(counts[:, -1]))
+    coarse, fine = vasculature.get_tile(tiles, tile, 0), vasculature.get_tile(tiles, tile)
+    assert len(coarse['segments']) == counts[tile, 0]
+    np.testing.assert_array_equal(fine['segments'][:len(coarse['segments'])], coarse['segments'])
+    # levels past the last one are the finest
+    assert len(vasculature.get_tile(tiles, tile, 10)['segments']) == counts[tile, -1]
+
+
+@pytest.mark.parametrize('tile, lod', [(-1, None), (10 ** 9, None), (0, -1)])
+def test_get_tile_rejects_invalid_tiles(tiles, tile, lod):
+    with pytest.raises(ValueError):
+        vasculature.get_tile(tiles, tile, lod)
+
+
+def test_tiles_in_region(tiles):
+    low = tiles['origin']
+    high = low + tiles['cell_size'] * tiles['dims']
+    everything = vasculature.tiles_in_region(tiles, {'box': {'min': low, 'max': high}})
+    np.testing.assert_array_equal(everything, np.flatnonzero(np.diff(tiles['tile_offsets'].astype(np.int64))))
+    center = (low + high) / 2
+    sphere = vasculature.tiles_in_region(tiles, {'sphere': {'center': center, 'radius': 10}})
+    assert 0 < len(sphere) < len(everything)
+    with pytest.raises(ValueError):
+        vasculature.tiles_in_region(tiles, {})
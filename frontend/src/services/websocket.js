@@ -14,6 +14,20 @@ const socketState = {
 
 const reconnectTimeout = 2000;
 
+const binaryDTypes = {
+  float32: Float32Array,
+  uint8: Uint8Array,
+  uint16: Uint16Array,
+  uint32: Uint32Array,
+  int32: Int32Array,
+};
+
+function viewBinaryArray(buffer, { dtype, shape, byte_offset: byteOffset = 0 }) {
+  const TypedArray = binaryDTypes[dtype];
+  const length = shape.reduce((size, dim) => size * dim, 1);
+  return new TypedArray(buffer, byteOffset, length);
+}
+
 
 function getSocketUrlFromConfig(conf) {
   const { location } = window;
@@ -37,6 +51,7 @@ class Ws {
     this.messageContext = {};
     this.requestResolvers = new Map();
     this.socket = null;
+    this.binaryHeader = null;
 
     this._initWebSocket();
   }
@@ -46,12 +61,14 @@ class Ws {
    * @param {String} message
    * @param {*} data
    * @param {*} cmdId
+   * @param {Boolean} binary request numeric arrays as binary frames
    */
-  send(message, data, cmdId = null) {
+  send(message, data, cmdId = null, binary = false) {
     switch (this.socket.readyState) {
       case socketState.OPEN: {
         this.socket.send(JSON.stringify({
           data,
+          binary,
           context: this.messageContext,
           cmd: message,
           cmdid: cmdId,
@@ -63,7 +80,7 @@ class Ws {
       case socketState.CLOSING:
       case socketState.CLOSED:
       default: {
-        this.messageQueue.push([message, data, cmdId]);
+        this.messageQueue.push([message, data, cmdId, binary]);
         break;
       }
     }
@@ -92,17 +109,29 @@ class Ws {
   _initWebSocket() {
     const socketUrl = getSocketUrlFromConfig(config);
     this.socket = new WebSocket(socketUrl);
+    this.socket.binaryType = 'arraybuffer';
 
     this.socket.addEventListener('open', () => this._processQueue());
     this.socket.addEventListener('error', e => console.error(e));
     this.socket.addEventListener('close', () => this._reconnect());
 
     this.socket.addEventListener('message', (e) => {
+      if (e.data instanceof ArrayBuffer) {
+        this._processBinary(e.data);
+        return;
+      }
+
       const message = JSON.parse(e.data);
 
+      if (message.cmd === 'binary_header') {
+        // the next frame is a binary one, described by this header
+        this.binaryHeader = message.data;
+        return;
+      }
+
       const cmdId = get(message, 'data.cmdid');
-      if (cmdId) {
-        const requestResolver = this.requestResolvers.get(cmdId);
+      const requestResolver = cmdId && this.requestResolvers.get(cmdId);
+      if (requestResolver) {
         requestResolver(message.data);
         this.requestResolvers.delete(cmdId);
         return;
@@ -112,6 +141,23 @@ class Ws {
     });
   }
 
+  _processBinary(buffer) {
+    const header = this.binaryHeader;
+    this.binaryHeader = null;
+
+    let values;
+    if (header.arrays) {
+      // several named arrays packed in one frame
+      values = {};
+      header.arrays.forEach((arrayDesc) => {
+        values[arrayDesc.name] = viewBinaryArray(buffer, arrayDesc);
+      });
+    } else {
+      values = viewBinaryArray(buffer, header);
+    }
+    eventBus.$emit(`ws:${header.cmd}`, Object.assign({ values }, header));
+  }
+
   _reconnect() {
     setTimeout(() => this._initWebSocket(), reconnectTimeout);
   }
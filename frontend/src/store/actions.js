@@ -279,14 +279,13 @@ const actions = {
     const done = new Promise((resolve) => {
       let idxOffset = 0;
 
-      const processPropIndex = ({ prop: receivedProp, values }) => {
+      const processPropIndex = ({ prop: receivedProp, values, offset }) => {
         if (prop !== receivedProp) {
           throw new Error(`Received ${receivedProp} prop instead of expected ${prop}`);
         }
 
-        values.forEach((value, idx) => {
-          cellProp[prop].index[idxOffset + idx] = value;
-        });
+        // values is a Uint32Array chunk starting at offset
+        cellProp[prop].index.set(values, offset);
         idxOffset += values.length;
 
         const progress = Math.trunc(idxOffset / cells.meta.count * 100);
@@ -303,7 +302,7 @@ const actions = {
       };
 
       store.$on('ws:circuit_prop_index', processPropIndex);
-      socket.send('get_circuit_prop_index', prop);
+      socket.send('get_circuit_prop_index', prop, null, true);
     });
 
     await done;
@@ -317,10 +316,11 @@ const actions = {
     let idxOffset = 0;
 
     const done = new Promise((resolve) => {
-      const processPositions = ({ positions }) => {
-        positions.forEach((val, posIdx) => { cells.positions[posIdx + idxOffset] = val; });
+      const processPositions = ({ values, offset }) => {
+        // values is a Float32Array chunk starting at offset
+        cells.positions.set(values, offset);
 
-        idxOffset += positions.length;
+        idxOffset += values.length;
 
         const progress = Math.trunc(idxOffset / positionsArrSize * 100);
         store.$emit('setCircuitLoadingProgress', {
@@ -335,7 +335,7 @@ const actions = {
       };
 
       store.$on('ws:circuit_cell_positions', processPositions);
-      socket.send('get_circuit_cell_positions');
+      socket.send('get_circuit_cell_positions', null, null, true);
     });
 
     await done;